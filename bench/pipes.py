@@ -0,0 +1,87 @@
+"""
+Benchmarks capture throughput as a function of capture pipe size.
+
+For each pipe size, runs Procstar on a spec of procs that each run
+`tests/int/scripts/general --print NxM`, captured in memory with that pipe
+size.  Reports the elapsed time, the capture throughput, and the mean number of
+voluntary context switches per proc, which counts how often the writer blocked
+on a full pipe.
+
+    python bench/pipes.py --pipe-size 65536 262144 1048576
+"""
+
+import argparse
+import json
+from   pathlib import Path
+import statistics
+import subprocess
+import tempfile
+import time
+
+ROOT = Path(__file__).parents[1]
+EXE = ROOT / "target/release/procstar"
+GENERAL = ROOT / "tests/int/scripts/general"
+
+
+def bench(exe, pipe_size, procs, lines, length):
+    spec = {"procs": {
+        f"print{i}": {
+            "argv": [str(GENERAL), "--print", f"{lines}x{length}"],
+            "fds": [[
+                "stdout",
+                {"capture": {"mode": "memory", "pipe_size": pipe_size}},
+            ]],
+        }
+        for i in range(procs)
+    }}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        spec_path = Path(tmp_dir) / "spec.json"
+        spec_path.write_text(json.dumps(spec))
+        output_path = Path(tmp_dir) / "output.json"
+        start = time.perf_counter()
+        subprocess.run(
+            [str(exe), "--output", str(output_path), str(spec_path)],
+            check=True,
+        )
+        elapsed = time.perf_counter() - start
+        res = json.loads(output_path.read_text())
+
+    size = lines * (length + 1)
+    for proc in res.values():
+        assert len(proc["fds"]["stdout"]["text"]) == size
+    nvcsw = statistics.mean(
+        proc["rusage"]["nvcsw"] for proc in res.values())
+
+    print(
+        f"pipe size {pipe_size:8d}"
+        f"  elapsed {elapsed:7.3f} s"
+        f"  capture {procs * size / elapsed / (1 << 20):8.1f} MiB/s"
+        f"  csw/proc {nvcsw:8.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--exe", metavar="PATH", type=Path, default=EXE,
+        help="path to procstar executable [def: {}]".format(EXE))
+    parser.add_argument(
+        "--pipe-size", metavar="BYTES", type=int, nargs="+",
+        default=[65536, 262144, 1048576],
+        help="pipe sizes to compare [def: 65536 262144 1048576]")
+    parser.add_argument(
+        "--procs", metavar="NUM", type=int, default=4,
+        help="number of procs [def: 4]")
+    parser.add_argument(
+        "--print", metavar="NxM", default="200x1048576",
+        help="lines and line length printed by each proc [def: 200x1048576]")
+    args = parser.parse_args()
+
+    lines, length = ( int(n) for n in args.print.split("x") )
+    for pipe_size in args.pipe_size:
+        bench(args.exe, pipe_size, args.procs, lines, length)
+
+
+if __name__ == "__main__":
+    main()
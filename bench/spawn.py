@@ -0,0 +1,154 @@
+"""
+Benchmarks proc spawn latency as a function of the server's RSS.
+
+Starts a Procstar server for each spawn mode.  For each target size, grows the
+server's RSS to that size by capturing output from a "ballast" proc into
+memory, then times starting `/bin/true` procs: from sending each `POST /procs`
+request until the proc's `started` event arrives on the `GET /events` stream.
+`POST /procs` responds once procs are queued, before they start, so the
+response alone doesn't measure spawn latency.
+
+    python bench/spawn.py --sizes 10M,100M,1G,10G
+
+Spawn latency with `--spawn fork` grows with RSS, as fork copies page tables;
+with `--spawn posix-spawn` and `--spawn zygote` it should stay flat.
+"""
+
+import argparse
+import json
+from   pathlib import Path
+import statistics
+import subprocess
+import time
+import urllib.request
+
+EXE = Path(__file__).parents[1] / "target/release/procstar"
+URL = "http://127.0.0.1:3000"
+
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+def parse_size(size):
+    return int(size[: -1]) * UNITS[size[-1]] if size[-1] in UNITS else int(size)
+
+
+def post(procs):
+    req = urllib.request.Request(
+        URL + "/procs",
+        method="POST",
+        data=json.dumps({"procs": procs}).encode(),
+        headers={"content-type": "application/json"},
+    )
+    with urllib.request.urlopen(req) as rsp:
+        rsp.read()
+
+
+def open_events():
+    """
+    Opens the stream of proc events.
+    """
+    return urllib.request.urlopen(URL + "/events")
+
+
+def wait_started(events, proc_id):
+    """
+    Reads events until `proc_id` starts, or fails to.
+    """
+    for line in events:
+        if line.startswith(b"data: "):
+            event = json.loads(line[len(b"data: ") :])
+            if event["proc_id"] == proc_id:
+                if event["type"] == "started":
+                    return
+                elif event["type"] == "exec_failed":
+                    raise RuntimeError(f"{proc_id} failed: {event['errors']}")
+    raise RuntimeError("event stream ended")
+
+
+def get_rss(pid):
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+
+def wait_for_server(timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(URL + "/metrics") as rsp:
+                rsp.read()
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def grow(pid, size, i):
+    """
+    Grows the server's RSS to at least `size`.
+    """
+    rss = get_rss(pid)
+    if rss < size:
+        post({
+            f"ballast{i}": {
+                "argv": ["/usr/bin/head", "-c", str(size - rss), "/dev/zero"],
+                "fds": [["stdout", {"capture": {"mode": "memory"}}]],
+            }
+        })
+        while get_rss(pid) < size * 0.95:
+            time.sleep(0.1)
+
+
+def bench(exe, spawn, sizes, count):
+    server = subprocess.Popen([str(exe), "--serve", "--spawn", spawn])
+    try:
+        wait_for_server()
+        events = open_events()
+        for i, size in enumerate(sizes):
+            grow(server.pid, size, i)
+            times = []
+            for j in range(count):
+                proc_id = f"true-{i}-{j}"
+                start = time.perf_counter()
+                post({proc_id: {"argv": ["/bin/true"]}})
+                wait_started(events, proc_id)
+                times.append(time.perf_counter() - start)
+            times.sort()
+            print(
+                f"{spawn:12s} {get_rss(server.pid) / (1 << 20):10.0f} MiB"
+                f"  median {statistics.median(times) * 1e3:7.3f} ms"
+                f"  p90 {times[int(0.9 * len(times))] * 1e3:7.3f} ms"
+                f"  p99 {times[int(0.99 * len(times))] * 1e3:7.3f} ms"
+            )
+        events.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--exe", metavar="PATH", type=Path, default=EXE,
+        help="path to procstar executable [def: {}]".format(EXE))
+    parser.add_argument(
+        "--sizes", metavar="SIZES", default="10M,100M,1G",
+        help="comma-separated server RSS sizes [def: 10M,100M,1G]")
+    parser.add_argument(
+        "--count", metavar="NUM", type=int, default=200,
+        help="number of spawns per size [def: 200]")
+    parser.add_argument(
+        "--spawn", metavar="MODE", nargs="+", default=["fork", "posix-spawn", "zygote"],
+        help="spawn modes to compare [def: fork posix-spawn zygote]")
+    args = parser.parse_args()
+
+    sizes = [ parse_size(s) for s in args.sizes.split(",") ]
+    for spawn in args.spawn:
+        bench(args.exe, spawn, sizes, args.count)
+
+
+if __name__ == "__main__":
+    main()
+
+
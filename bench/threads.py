@@ -0,0 +1,147 @@
+"""
+Benchmarks capture throughput and HTTP latency as a function of the number of
+runtime threads.
+
+Starts a Procstar server for each thread count.  Starts procs that each write
+`--size` bytes to stdout, captured in memory, and while they run, times `GET
+/procs/:id` requests for a small proc from several client threads.  Reports the
+aggregate capture throughput and the HTTP request latency.
+
+    python bench/threads.py --threads 1 2 4 8
+"""
+
+import argparse
+import json
+from   pathlib import Path
+import statistics
+import subprocess
+import threading
+import time
+import urllib.request
+
+EXE = Path(__file__).parents[1] / "target/release/procstar"
+URL = "http://127.0.0.1:3000"
+
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+def parse_size(size):
+    return int(size[: -1]) * UNITS[size[-1]] if size[-1] in UNITS else int(size)
+
+
+def request(method, path, jso=None):
+    req = urllib.request.Request(
+        URL + path,
+        method=method,
+        data=None if jso is None else json.dumps(jso).encode(),
+        headers={"content-type": "application/json"},
+    )
+    with urllib.request.urlopen(req) as rsp:
+        return json.loads(rsp.read())
+
+
+def wait_for_server(timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            request("GET", "/metrics")
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def get_running():
+    return request("GET", "/metrics")["data"]["metrics"]["queue"]["running"]
+
+
+def time_gets(done, times):
+    """
+    Times requests for the small proc, until `done` is set.
+    """
+    while not done.is_set():
+        start = time.perf_counter()
+        request("GET", "/procs/small")
+        times.append(time.perf_counter() - start)
+
+
+def bench(exe, threads, procs, size, clients):
+    server = subprocess.Popen(
+        [str(exe), "--serve", "--threads", str(threads)],
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_server()
+        request("POST", "/procs", {"procs": {
+            "small": {
+                "argv": ["/bin/echo", "Hello, world."],
+                "fds": [["stdout", {"capture": {"mode": "memory"}}]],
+            },
+        }})
+
+        done = threading.Event()
+        times = []
+        getters = [
+            threading.Thread(target=time_gets, args=(done, times))
+            for _ in range(clients)
+        ]
+        for getter in getters:
+            getter.start()
+
+        start = time.perf_counter()
+        request("POST", "/procs", {"procs": {
+            f"big{i}": {
+                "argv": ["/usr/bin/head", "-c", str(size), "/dev/zero"],
+                "fds": [["stdout", {"capture": {"mode": "memory"}}]],
+            }
+            for i in range(procs)
+        }})
+        # The queue counts procs as running until their output is drained.
+        while get_running() > 0:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        done.set()
+        for getter in getters:
+            getter.join()
+
+        times.sort()
+        print(
+            f"threads {threads:3d}"
+            f"  capture {procs * size / elapsed / (1 << 20):8.0f} MiB/s"
+            f"  GET median {statistics.median(times) * 1e3:7.3f} ms"
+            f"  p99 {times[int(0.99 * len(times))] * 1e3:7.3f} ms"
+            f"  ({len(times)} GETs)"
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--exe", metavar="PATH", type=Path, default=EXE,
+        help="path to procstar executable [def: {}]".format(EXE))
+    parser.add_argument(
+        "--threads", metavar="NUM", type=int, nargs="+", default=[1, 2, 4, 8],
+        help="runtime thread counts to compare [def: 1 2 4 8]")
+    parser.add_argument(
+        "--procs", metavar="NUM", type=int, default=8,
+        help="number of capturing procs [def: 8]")
+    parser.add_argument(
+        "--size", metavar="SIZE", default="64M",
+        help="bytes written by each capturing proc [def: 64M]")
+    parser.add_argument(
+        "--clients", metavar="NUM", type=int, default=4,
+        help="number of concurrent HTTP clients [def: 4]")
+    args = parser.parse_args()
+
+    for threads in args.threads:
+        bench(args.exe, threads, args.procs, parse_size(args.size), args.clients)
+        # Let the port free up.
+        time.sleep(0.5)
+
+
+if __name__ == "__main__":
+    main()
@@ -66,6 +66,101 @@ class AsyncClient:
             return rsp.json()["data"]["procs"][proc_id]
 
 
+    async def get_procs(
+            self, *,
+            state=None, exit_code=None, labels=(), after=None, limit=None
+    ):
+        """
+        Returns results of procs that match all of the given conditions.
+
+        :param state:
+          "running" or "exited".
+        :param labels:
+          Label selectors, as "key", "!key", "key=value", or "key!=value".
+        :param after:
+          Returns procs after this proc ID only.
+        :param limit:
+          Returns at most this many procs.
+        :return:
+          Proc results by proc ID, and the proc ID after which the next page
+          starts, or none if this is the last.
+        """
+        args = {}
+        if state is not None:
+            args["state"] = state
+        if exit_code is not None:
+            args["exit_code"] = str(exit_code)
+        if len(labels) > 0:
+            args["labels"] = ",".join(labels)
+        if after is not None:
+            args["after"] = after
+        if limit is not None:
+            args["limit"] = str(limit)
+        async with self.__request("GET", "procs", args=args) as rsp:
+            rsp.raise_for_status()
+            data = rsp.json()["data"]
+            return data["procs"], data["next"]
+
+
+    async def wait_proc(self, proc_id, *, timeout=None):
+        """
+        Waits for a proc to complete, up to `timeout` seconds.
+
+        :return:
+          The proc's `status` and `rusage`, which are none if it didn't
+          complete in time.
+        """
+        args = {} if timeout is None else {"timeout": str(timeout)}
+        async with self.__request(
+                "POST", "procs", proc_id, "wait", args=args) as rsp:
+            rsp.raise_for_status()
+            return rsp.json()["data"]["procs"][proc_id]
+
+
+    async def wait_procs(self, proc_ids, *, any=False, timeout=None):
+        """
+        Waits for all, or any, of `proc_ids` to complete, up to `timeout`
+        seconds.
+
+        :return:
+          Whether they completed in time as `complete`, and `procs` giving
+          the `status` and `rusage` of each proc.
+        """
+        args = {"mode": "any" if any else "all"}
+        if timeout is not None:
+            args["timeout"] = str(timeout)
+        jso = {"procs": list(proc_ids)}
+        async with self.__request("POST", "wait", jso=jso, args=args) as rsp:
+            rsp.raise_for_status()
+            return rsp.json()["data"]
+
+
+    async def get_output(
+            self, proc_id, fd, *,
+            offset=None, length=None, after=None, wait=None
+    ):
+        """
+        Returns raw output captured from `fd` of a proc, or a range of it.
+
+        :param after:
+          Returns output past this offset, waiting up to `wait` seconds for
+          it; returns empty bytes if there is none.
+        """
+        args = {}
+        if offset is not None:
+            args["offset"] = str(offset)
+        if length is not None:
+            args["length"] = str(length)
+        if after is not None:
+            args["after"] = str(after)
+        if wait is not None:
+            args["wait"] = str(wait)
+        async with self.__request(
+                "GET", "procs", proc_id, "fds", str(fd), args=args) as rsp:
+            rsp.raise_for_status()
+            return rsp.content
+
+
     async def delete_proc(self, proc_id):
         async with self.__request("DELETE", "procs", proc_id) as rsp:
             rsp.raise_for_status()
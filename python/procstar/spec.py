@@ -92,10 +92,11 @@ class Proc:
 
 
 
-    def __init__(self, argv, *, env=Env(), fds=[]):
-        self.__argv = tuple( str(a) for a in argv )
-        self.__env  = env
-        self.__fds  = dict(fds)
+    def __init__(self, argv, *, env=Env(), fds=[], labels={}):
+        self.__argv     = tuple( str(a) for a in argv )
+        self.__env      = env
+        self.__fds      = dict(fds)
+        self.__labels   = { str(k): str(v) for k, v in dict(labels).items() }
 
 
     def to_jso(self):
@@ -103,6 +104,7 @@ class Proc:
             "argv"  : self.__argv,
             "env"   : self.__env.to_jso(),
             "fds"   : [ (n, f.to_jso()) for n, f in self.__fds.items() ],
+            "labels": self.__labels,
         }
 
 
@@ -1,4 +1,6 @@
 use clap::Parser;
+use std::path::PathBuf;
+use std::time::Duration;
 
 //------------------------------------------------------------------------------
 
@@ -15,6 +17,64 @@ pub struct Args {
     /// write output to a file
     #[arg(short, long)]
     pub output: Option<String>,
+
+    /// track processes with pidfds instead of SIGCHLD
+    #[arg(long)]
+    pub pidfd: bool,
+
+    /// don't let processes inherit fds not in their specs [default: true with
+    /// --serve]
+    #[arg(long)]
+    pub close_fds: Option<bool>,
+
+    /// max number of processes started with HTTP running at once
+    #[arg(long, value_name = "NUM", value_parser = parse_max_running)]
+    pub max_running: Option<usize>,
+
+    /// max number of processes started with HTTP per second
+    #[arg(long, value_name = "RATE", value_parser = parse_max_rate)]
+    pub max_rate: Option<f64>,
+
+    /// max number of processes waiting to start
+    #[arg(long, value_name = "NUM", default_value_t = 10000)]
+    pub max_queue: usize,
+
+    /// number of threads for the runtime; 1 runs everything on the main thread
+    #[arg(long, value_name = "NUM", default_value_t = 1)]
+    pub threads: usize,
+
+    /// how to create processes
+    #[arg(long, value_parser = ["fork", "posix-spawn", "zygote"], default_value = "posix-spawn")]
+    pub spawn: String,
+
+    /// directory for temp files that store captured output [default: $TMPDIR
+    /// or /tmp]
+    #[arg(long, value_name = "DIR")]
+    pub tmpdir: Option<PathBuf>,
+
+    /// default capacity of capture pipes, up to the system max pipe size
+    /// [default: kernel default]
+    #[arg(long, value_name = "BYTES")]
+    pub pipe_size: Option<usize>,
+
+    /// number of recent proc events kept, from which event streams can resume
+    #[arg(long, value_name = "NUM", default_value_t = procstar::events::DEFAULT_LOG_SIZE)]
+    pub event_log_size: usize,
+}
+
+fn parse_max_running(val: &str) -> Result<usize, String> {
+    match val.parse::<usize>() {
+        Ok(num) if num > 0 => Ok(num),
+        _ => Err("must be a positive integer".to_string()),
+    }
+}
+
+fn parse_max_rate(val: &str) -> Result<f64, String> {
+    match val.parse::<f64>() {
+        // The interval between starts must be representable, too.
+        Ok(rate) if rate > 0. && Duration::try_from_secs_f64(1. / rate).is_ok() => Ok(rate),
+        _ => Err("must be a positive number".to_string()),
+    }
 }
 
 pub fn parse() -> Args {
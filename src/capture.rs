@@ -0,0 +1,1171 @@
+use bytes::Bytes;
+use serde::Serialize;
+use std::borrow::Cow;
+use std::collections::VecDeque;
+use std::fs::File;
+use flate2::read::GzDecoder;
+use flate2::write::GzEncoder;
+use lazy_static::lazy_static;
+use std::io::{self, Read, Write};
+use std::os::fd::{AsRawFd, FromRawFd, RawFd};
+use std::os::unix::fs::FileExt;
+use std::path::{Path, PathBuf};
+
+use crate::sys;
+
+//------------------------------------------------------------------------------
+
+/// Server-wide settings for capturing output.
+#[derive(Clone, Debug, Default)]
+pub struct Config {
+    /// Directory for temp files; if none, the system default.
+    pub tmpdir: Option<PathBuf>,
+    /// Default capacity of capture pipes; if none, the kernel default.
+    pub pipe_size: Option<usize>,
+}
+
+impl Config {
+    pub fn tmpdir(&self) -> PathBuf {
+        self.tmpdir.clone().unwrap_or_else(std::env::temp_dir)
+    }
+}
+
+//------------------------------------------------------------------------------
+
+/// A range of captured output that was dropped.
+#[derive(Clone, Copy, Debug, PartialEq, Eq, Serialize)]
+pub struct Truncation {
+    /// Offset in the output of the first dropped byte.
+    pub start: u64,
+    /// Number of dropped bytes.
+    pub length: u64,
+}
+
+/// Bounds on the captured output that is kept: the first `head` bytes and the
+/// last `tail` bytes.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub struct HeadTail {
+    pub head: usize,
+    pub tail: usize,
+}
+
+impl HeadTail {
+    /// Returns bounds from spec options, or none if neither is given.
+    pub fn new(head: Option<usize>, tail: Option<usize>) -> Option<Self> {
+        match (head, tail) {
+            (None, None) => None,
+            (head, tail) => Some(Self {
+                head: head.unwrap_or(0),
+                tail: tail.unwrap_or(0),
+            }),
+        }
+    }
+
+    /// Returns the range the bounds drop from `len` bytes of output, if any.
+    pub fn truncation(&self, len: u64) -> Option<Truncation> {
+        let (head, tail) = (self.head as u64, self.tail as u64);
+        (len > head + tail).then(|| Truncation {
+            start: head,
+            length: len - head - tail,
+        })
+    }
+
+    /// Applies the bounds to complete output `data`.
+    pub fn apply<'a>(&self, data: &'a [u8]) -> (Cow<'a, [u8]>, Option<Truncation>) {
+        let len = data.len();
+        match self.truncation(len as u64) {
+            None => (Cow::Borrowed(data), None),
+            truncation => {
+                let data = [&data[..self.head], &data[len - self.tail..]].concat();
+                (Cow::Owned(data), truncation)
+            }
+        }
+    }
+}
+
+/// Clips the range `start..end` of output so that it contains only output that
+/// was kept, given the range `truncated` that was dropped.  If the range spans
+/// the dropped range, returns only the part before it.
+pub fn clip_range(start: u64, end: u64, truncated: Option<Truncation>) -> (u64, u64) {
+    let (start, end) = match truncated {
+        Some(Truncation { start: drop_start, length }) => {
+            let drop_end = drop_start + length;
+            if start < drop_start {
+                (start, end.min(drop_start))
+            } else {
+                (start.max(drop_end), end)
+            }
+        }
+        None => (start, end),
+    };
+    (start, end.max(start))
+}
+
+/// Reads the range `start..end` of `file`.
+pub fn read_file_range(file: &File, start: u64, end: u64) -> io::Result<Bytes> {
+    let mut data = vec![0; (end - start) as usize];
+    file.read_exact_at(&mut data, start)?;
+    Ok(Bytes::from(data))
+}
+
+//------------------------------------------------------------------------------
+
+/// Output stored as a list of refcounted chunks.  Appending a chunk doesn't
+/// copy earlier output, and cloning or slicing shares chunks.
+#[derive(Clone, Debug, Default)]
+pub struct Chunks {
+    chunks: Vec<Bytes>,
+    len: usize,
+}
+
+impl Chunks {
+    pub fn push(&mut self, chunk: Bytes) {
+        if !chunk.is_empty() {
+            self.len += chunk.len();
+            self.chunks.push(chunk);
+        }
+    }
+
+    pub fn len(&self) -> usize {
+        self.len
+    }
+
+    /// Appends the chunks of `other`, sharing them.
+    pub fn extend(&mut self, other: Chunks) {
+        for chunk in other.chunks {
+            self.push(chunk);
+        }
+    }
+
+    pub fn iter(&self) -> std::slice::Iter<'_, Bytes> {
+        self.chunks.iter()
+    }
+
+    /// Returns the output in `start..end`, sharing chunks.
+    pub fn slice(&self, start: usize, end: usize) -> Self {
+        let mut result = Self::default();
+        let mut offset = 0;
+        for chunk in self.chunks.iter() {
+            let (chunk_start, chunk_end) = (offset, offset + chunk.len());
+            offset = chunk_end;
+            if chunk_end <= start {
+                continue;
+            } else if end <= chunk_start {
+                break;
+            }
+            result.push(chunk.slice(start.max(chunk_start) - chunk_start..end.min(chunk_end) - chunk_start));
+        }
+        result
+    }
+
+    /// Returns the output as one slice.  Copies only if there is more than one
+    /// chunk.
+    pub fn to_cow(&self) -> Cow<'_, [u8]> {
+        match &self.chunks[..] {
+            [] => Cow::Borrowed(&[]),
+            [chunk] => Cow::Borrowed(&chunk[..]),
+            chunks => {
+                let mut data = Vec::with_capacity(self.len);
+                for chunk in chunks {
+                    data.extend_from_slice(chunk);
+                }
+                Cow::Owned(data)
+            }
+        }
+    }
+}
+
+impl From<Vec<u8>> for Chunks {
+    fn from(data: Vec<u8>) -> Self {
+        let mut chunks = Self::default();
+        chunks.push(Bytes::from(data));
+        chunks
+    }
+}
+
+impl HeadTail {
+    /// Applies the bounds to complete output `data`, sharing its chunks.
+    pub fn apply_chunks(&self, data: Chunks) -> (Chunks, Option<Truncation>) {
+        let len = data.len();
+        match self.truncation(len as u64) {
+            None => (data, None),
+            truncation => {
+                let mut result = data.slice(0, self.head);
+                for chunk in data.slice(len - self.tail, len).iter() {
+                    result.push(chunk.clone());
+                }
+                (result, truncation)
+            }
+        }
+    }
+}
+
+//------------------------------------------------------------------------------
+
+/// In-memory storage for captured output, optionally bounded.
+#[derive(Debug, Default)]
+pub struct Buffer {
+    bounds: Option<HeadTail>,
+    /// The first bytes of output; all of it, if unbounded.
+    head: Chunks,
+    /// Ring buffer of the last bytes of output after the head.
+    tail: VecDeque<u8>,
+    /// Total number of bytes of output.
+    len: u64,
+}
+
+impl Buffer {
+    pub fn new(bounds: Option<HeadTail>) -> Self {
+        Self {
+            bounds,
+            ..Default::default()
+        }
+    }
+
+    /// Appends output.
+    pub fn append(&mut self, data: &[u8]) {
+        self.append_chunk(Bytes::copy_from_slice(data));
+    }
+
+    /// Appends a chunk of output, without copying it if unbounded.
+    pub fn append_chunk(&mut self, chunk: Bytes) {
+        self.len += chunk.len() as u64;
+        let HeadTail { head, tail } = match self.bounds {
+            Some(bounds) => bounds,
+            None => {
+                self.head.push(chunk);
+                return;
+            }
+        };
+
+        // Copy the part in the head, rather than keeping a reference, so
+        // that the rest of the chunk can be freed.
+        let num = chunk.len().min(head - self.head.len());
+        self.head.push(Bytes::copy_from_slice(&chunk[..num]));
+        let data = &chunk[num..];
+
+        if data.len() >= tail {
+            self.tail.clear();
+            self.tail.extend(&data[data.len() - tail..]);
+        } else {
+            let excess = (self.tail.len() + data.len()).saturating_sub(tail);
+            self.tail.drain(..excess);
+            self.tail.extend(data);
+        }
+    }
+
+    pub fn is_bounded(&self) -> bool {
+        self.bounds.is_some()
+    }
+
+    /// For `len` more bytes of output, returns how many at the start to
+    /// append, how many after those to skip, and how many at the end to
+    /// append.  Only the appended bytes can appear in contents.
+    pub fn plan_append(&self, len: usize) -> (usize, usize, usize) {
+        match self.bounds {
+            None => (len, 0, 0),
+            Some(HeadTail { head, tail }) => {
+                let start = len.min(head - self.head.len());
+                let end = (len - start).min(tail);
+                (start, len - start - end, end)
+            }
+        }
+    }
+
+    /// Records `len` bytes of output that were skipped, as planned by
+    /// `plan_append()`.
+    pub fn skip(&mut self, len: usize) {
+        if len > 0 {
+            self.len += len as u64;
+            // The next bytes appended fill the tail.
+            self.tail.clear();
+        }
+    }
+
+    /// Total number of bytes of output, including any dropped.
+    pub fn len(&self) -> u64 {
+        self.len
+    }
+
+    /// Discards all output, keeping the bounds.
+    pub fn clear(&mut self) {
+        *self = Self::new(self.bounds);
+    }
+
+    /// Returns the range of output that was dropped, if any.
+    pub fn truncation(&self) -> Option<Truncation> {
+        let dropped = self.len - (self.head.len() + self.tail.len()) as u64;
+        (dropped > 0).then(|| Truncation {
+            start: self.head.len() as u64,
+            length: dropped,
+        })
+    }
+
+    /// Returns the output that was kept, and the range that was dropped, if
+    /// any.
+    pub fn contents(&self) -> (Chunks, Option<Truncation>) {
+        let mut data = self.head.clone();
+        if !self.tail.is_empty() {
+            let (tail0, tail1) = self.tail.as_slices();
+            data.push(Bytes::from([tail0, tail1].concat()));
+        }
+        (data, self.truncation())
+    }
+
+    /// Returns the output in `start..end`, which must have been kept.
+    pub fn read(&self, start: u64, end: u64) -> Chunks {
+        let head_len = self.head.len() as u64;
+        let mut data = self.head.slice(start.min(head_len) as usize, end.min(head_len) as usize);
+        // The tail holds the last bytes of output.
+        let tail_start = self.len - self.tail.len() as u64;
+        if tail_start < end {
+            let range = (start.max(tail_start) - tail_start) as usize..(end - tail_start) as usize;
+            data.push(self.tail.range(range).copied().collect::<Vec<_>>().into());
+        }
+        data
+    }
+}
+
+//------------------------------------------------------------------------------
+
+const TMP_TEMPLATE: &str = "ir-capture-XXXXXXXXXXXX";
+
+/// Creates and opens an unlinked temporary file in `tmpdir`.
+pub fn temp_file(tmpdir: &Path) -> io::Result<File> {
+    // Open a temp file.
+    let template = tmpdir.join(TMP_TEMPLATE);
+    let template = template
+        .to_str()
+        .ok_or_else(|| io::Error::new(io::ErrorKind::InvalidInput, "invalid tmpdir"))?;
+    let (tmp_path, tmp_fd) = sys::mkstemp(template)?;
+    let file = unsafe { File::from_raw_fd(tmp_fd) };
+    // Unlink it.  Since it's unlinked, we don't have to deal with it later.
+    std::fs::remove_file(tmp_path)?;
+    Ok(file)
+}
+
+/// Default size of output kept in memory before spilling to a file.
+pub const DEFAULT_SPILL_SIZE: usize = 1 << 20;
+
+/// Storage for captured output that starts in memory, and moves to an unlinked
+/// temporary file once it grows past a threshold.
+#[derive(Debug)]
+pub struct Spill {
+    /// Size past which output moves to a file.
+    spill_size: usize,
+    /// Bounds on the output returned from `contents()`.
+    bounds: Option<HeadTail>,
+    /// Directory in which to create the file.
+    tmpdir: PathBuf,
+    /// Output, while it's in memory.
+    buf: Chunks,
+    /// The file, once output has spilled.
+    file: Option<File>,
+    /// Total number of bytes of output.
+    len: u64,
+    /// Offset in the file up to which output outside the bounds was freed.
+    freed: u64,
+}
+
+/// Minimum amount of output outside the bounds to free from a spill file at
+/// once.
+const FREE_SIZE: u64 = 1 << 20;
+
+impl Spill {
+    pub fn new(spill_size: usize, bounds: Option<HeadTail>, tmpdir: PathBuf) -> Self {
+        Self {
+            spill_size,
+            bounds,
+            tmpdir,
+            buf: Chunks::default(),
+            file: None,
+            len: 0,
+            freed: 0,
+        }
+    }
+
+    /// Appends a chunk of output.
+    pub fn append_chunk(&mut self, chunk: Bytes) -> io::Result<()> {
+        if self.file.is_none() && self.buf.len() + chunk.len() > self.spill_size {
+            let mut file = temp_file(&self.tmpdir)?;
+            for buf_chunk in self.buf.iter() {
+                file.write_all(buf_chunk)?;
+            }
+            self.buf = Chunks::default();
+            self.file = Some(file);
+        }
+        self.len += chunk.len() as u64;
+        match self.file {
+            Some(ref mut file) => file.write_all(&chunk)?,
+            None => self.buf.push(chunk),
+        }
+
+        if let (Some(HeadTail { head, tail }), Some(ref file)) = (self.bounds, &self.file) {
+            // Free output that has fallen between the head and the tail, if
+            // the filesystem supports it, so that the file doesn't grow
+            // without bound.
+            let start = self.freed.max(head as u64);
+            let end = self.len.saturating_sub(tail as u64);
+            if end >= start + FREE_SIZE {
+                _ = sys::punch_hole(file.as_raw_fd(), start, (end - start) as usize);
+                self.freed = end;
+            }
+        }
+        Ok(())
+    }
+
+    /// True if output has moved to a file.
+    pub fn is_spilled(&self) -> bool {
+        self.file.is_some()
+    }
+
+    /// Total number of bytes of output, including any dropped.
+    pub fn len(&self) -> u64 {
+        self.len
+    }
+
+    /// Returns the range of output that was dropped, if any.
+    pub fn truncation(&self) -> Option<Truncation> {
+        self.bounds.and_then(|bounds| bounds.truncation(self.len))
+    }
+
+    /// Returns the output in `start..end`, which must have been kept.  Reads
+    /// only this range from the file.
+    pub fn read(&self, start: u64, end: u64) -> io::Result<Chunks> {
+        Ok(match self.file {
+            Some(ref file) => {
+                let mut data = Chunks::default();
+                data.push(read_file_range(file, start, end)?);
+                data
+            }
+            None => self.buf.slice(start as usize, end as usize),
+        })
+    }
+
+    /// Returns the output that was kept, and the range that was dropped, if
+    /// any.  Reads only the kept output from the file.
+    pub fn contents(&self) -> io::Result<(Chunks, Option<Truncation>)> {
+        let truncation = self.truncation();
+        let ranges = match truncation {
+            Some(Truncation { start, length }) => vec![(0, start), (start + length, self.len)],
+            None => vec![(0, self.len)],
+        };
+        let mut data = Chunks::default();
+        for (start, end) in ranges {
+            data.extend(self.read(start, end)?);
+        }
+        Ok((data, truncation))
+    }
+}
+
+//------------------------------------------------------------------------------
+
+/// Amount of output compressed into each frame.
+const FRAME_SIZE: usize = 128 << 10;
+
+fn gzip(data: &[u8]) -> io::Result<Vec<u8>> {
+    let mut encoder = GzEncoder::new(Vec::new(), flate2::Compression::fast());
+    encoder.write_all(data)?;
+    encoder.finish()
+}
+
+fn gunzip(data: &[u8], len: usize) -> io::Result<Vec<u8>> {
+    let mut result = Vec::with_capacity(len);
+    GzDecoder::new(data).read_to_end(&mut result)?;
+    Ok(result)
+}
+
+/// Sizes of compressed output, for results.
+#[derive(Clone, Copy, Debug, PartialEq, Eq, Serialize)]
+pub struct CompressionStats {
+    pub method: &'static str,
+    /// Number of bytes of output stored, uncompressed.
+    pub length: u64,
+    /// Number of bytes stored in memory.
+    pub memory: u64,
+    /// Number of bytes stored on disk.
+    pub disk: u64,
+}
+
+/// Where a frame is stored.
+#[derive(Debug)]
+enum FrameData {
+    Memory(Bytes),
+    /// In the file, at an offset and with a length.
+    File(u64, usize),
+}
+
+/// A gzip member holding a range of output.
+#[derive(Debug)]
+struct Frame {
+    /// Offset in the output of the first byte.
+    start: u64,
+    /// Number of bytes of output.
+    len: usize,
+    data: FrameData,
+}
+
+/// Storage for captured output that compresses it with gzip as it arrives, in
+/// independent frames.  Frames are kept in memory or, given a spill size, move
+/// to an unlinked temporary file once they grow past it.  If the output is
+/// bounded, frames that fall entirely outside the bounds are dropped.
+#[derive(Debug)]
+pub struct Compressed {
+    bounds: Option<HeadTail>,
+    /// Size of frames past which they move to a file, and the directory in
+    /// which to create it.
+    spill: Option<(usize, PathBuf)>,
+    frames: VecDeque<Frame>,
+    /// Output not yet compressed, and its offset.
+    pending: Vec<u8>,
+    pending_start: u64,
+    /// The file, once frames have spilled.
+    file: Option<File>,
+    /// Total number of bytes of output.
+    len: u64,
+    /// Number of bytes of frames in memory, and in the file.
+    memory_len: u64,
+    disk_len: u64,
+    /// Size of the file.
+    file_len: u64,
+}
+
+impl Compressed {
+    pub fn new(bounds: Option<HeadTail>, spill: Option<(usize, PathBuf)>) -> Self {
+        Self {
+            bounds,
+            spill,
+            frames: VecDeque::new(),
+            pending: Vec::new(),
+            pending_start: 0,
+            file: None,
+            len: 0,
+            memory_len: 0,
+            disk_len: 0,
+            file_len: 0,
+        }
+    }
+
+    /// Appends a chunk of output.
+    pub fn append_chunk(&mut self, chunk: Bytes) -> io::Result<()> {
+        self.len += chunk.len() as u64;
+        let mut data = &chunk[..];
+        while !data.is_empty() {
+            let num = data.len().min(FRAME_SIZE - self.pending.len());
+            self.pending.extend_from_slice(&data[..num]);
+            data = &data[num..];
+            if self.pending.len() == FRAME_SIZE {
+                self.compress_pending()?;
+            }
+        }
+        Ok(())
+    }
+
+    /// Compresses any remaining output, at EOF.
+    pub fn finish(&mut self) -> io::Result<()> {
+        if !self.pending.is_empty() {
+            self.compress_pending()?;
+        }
+        self.pending = Vec::new();
+        Ok(())
+    }
+
+    fn compress_pending(&mut self) -> io::Result<()> {
+        let data = gzip(&self.pending)?;
+        let start = self.pending_start;
+        let len = self.pending.len();
+        self.pending.clear();
+        self.pending_start += len as u64;
+
+        if let (None, Some((spill_size, tmpdir))) = (&self.file, &self.spill) {
+            if self.memory_len as usize + data.len() > *spill_size {
+                // Move frames to a file.
+                let mut file = temp_file(tmpdir)?;
+                for frame in self.frames.iter_mut() {
+                    if let FrameData::Memory(ref frame_data) = frame.data {
+                        let len = frame_data.len();
+                        file.write_all(frame_data)?;
+                        frame.data = FrameData::File(self.file_len, len);
+                        self.file_len += len as u64;
+                        self.disk_len += len as u64;
+                    }
+                }
+                self.memory_len = 0;
+                self.file = Some(file);
+            }
+        }
+        let data = match self.file {
+            Some(ref mut file) => {
+                file.write_all(&data)?;
+                let offset = self.file_len;
+                self.file_len += data.len() as u64;
+                self.disk_len += data.len() as u64;
+                FrameData::File(offset, data.len())
+            }
+            None => {
+                self.memory_len += data.len() as u64;
+                FrameData::Memory(Bytes::from(data))
+            }
+        };
+        self.frames.push_back(Frame { start, len, data });
+
+        if let Some(HeadTail { head, tail }) = self.bounds {
+            // Drop frames entirely between the head and the tail.
+            let tail_start = self.len.saturating_sub(tail as u64);
+            let (memory_len, disk_len, file) = (&mut self.memory_len, &mut self.disk_len, &self.file);
+            self.frames.retain(|frame| {
+                let drop = frame.start >= head as u64 && frame.start + frame.len as u64 <= tail_start;
+                match (drop, &frame.data) {
+                    (true, FrameData::Memory(ref data)) => *memory_len -= data.len() as u64,
+                    (true, FrameData::File(offset, len)) => {
+                        // Free the frame's space in the file, if the
+                        // filesystem supports it.
+                        if sys::punch_hole(file.as_ref().unwrap().as_raw_fd(), *offset, *len).is_ok() {
+                            *disk_len -= *len as u64;
+                        }
+                    }
+                    (false, _) => {}
+                }
+                !drop
+            });
+        }
+        Ok(())
+    }
+
+    fn decompress(&self, frame: &Frame) -> io::Result<Vec<u8>> {
+        match frame.data {
+            FrameData::Memory(ref data) => gunzip(data, frame.len),
+            FrameData::File(offset, len) => {
+                let data = read_file_range(self.file.as_ref().unwrap(), offset, offset + len as u64)?;
+                gunzip(&data, frame.len)
+            }
+        }
+    }
+
+    /// Total number of bytes of output, including any dropped.
+    pub fn len(&self) -> u64 {
+        self.len
+    }
+
+    /// Returns the range of output that was dropped, if any.
+    pub fn truncation(&self) -> Option<Truncation> {
+        self.bounds.and_then(|bounds| bounds.truncation(self.len))
+    }
+
+    fn is_truncated(&self) -> bool {
+        self.truncation().is_some()
+    }
+
+    /// Returns the output in `start..end`, which must have been kept.
+    /// Decompresses only the frames that overlap this range.
+    pub fn read(&self, start: u64, end: u64) -> io::Result<Chunks> {
+        let mut data = Chunks::default();
+        for frame in self.frames.iter() {
+            let frame_end = frame.start + frame.len as u64;
+            if frame_end <= start {
+                continue;
+            } else if end <= frame.start {
+                break;
+            }
+            let piece = Bytes::from(self.decompress(frame)?);
+            let from = start.max(frame.start) - frame.start;
+            let to = end.min(frame_end) - frame.start;
+            data.push(piece.slice(from as usize..to as usize));
+        }
+        if self.pending_start < end {
+            let from = start.max(self.pending_start) - self.pending_start;
+            let to = end - self.pending_start;
+            data.push(Bytes::copy_from_slice(&self.pending[from as usize..to as usize]));
+        }
+        Ok(data)
+    }
+
+    /// Returns the output that was kept, decompressed, and the range that was
+    /// dropped, if any.
+    pub fn contents(&self) -> io::Result<(Chunks, Option<Truncation>)> {
+        let mut pieces = Vec::with_capacity(self.frames.len() + 1);
+        for frame in self.frames.iter() {
+            pieces.push((frame.start, Bytes::from(self.decompress(frame)?)));
+        }
+        pieces.push((self.pending_start, Bytes::copy_from_slice(&self.pending)));
+
+        let mut data = Chunks::default();
+        let truncation = match self.bounds {
+            Some(HeadTail { head, tail }) if self.is_truncated() => {
+                // Keep only the bytes of each piece within the bounds.
+                let (head, tail_start) = (head as u64, self.len - tail as u64);
+                for (range_start, range_end) in [(0, head), (tail_start, self.len)] {
+                    for (start, piece) in pieces.iter() {
+                        let end = start + piece.len() as u64;
+                        if *start < range_end && range_start < end {
+                            let from = range_start.max(*start) - start;
+                            let to = range_end.min(end) - start;
+                            data.push(piece.slice(from as usize..to as usize));
+                        }
+                    }
+                }
+                Some(Truncation {
+                    start: head,
+                    length: tail_start - head,
+                })
+            }
+            _ => {
+                for (_, piece) in pieces {
+                    data.push(piece);
+                }
+                None
+            }
+        };
+        Ok((data, truncation))
+    }
+
+    /// Returns all output as a gzip stream of frames, without decompressing
+    /// it, or none if output was dropped.
+    pub fn compressed(&self) -> io::Result<Option<Chunks>> {
+        if self.is_truncated() {
+            return Ok(None);
+        }
+        let mut data = Chunks::default();
+        for frame in self.frames.iter() {
+            match frame.data {
+                FrameData::Memory(ref frame_data) => data.push(frame_data.clone()),
+                FrameData::File(offset, len) => {
+                    let mut frame_data = vec![0; len];
+                    self.file.as_ref().unwrap().read_exact_at(&mut frame_data, offset)?;
+                    data.push(Bytes::from(frame_data));
+                }
+            }
+        }
+        if !self.pending.is_empty() {
+            data.push(Bytes::from(gzip(&self.pending)?));
+        }
+        Ok(Some(data))
+    }
+
+    pub fn stats(&self) -> CompressionStats {
+        CompressionStats {
+            method: "gzip",
+            length: self.frames.iter().map(|f| f.len as u64).sum::<u64>()
+                + self.pending.len() as u64,
+            memory: self.memory_len + self.pending.len() as u64,
+            disk: self.disk_len,
+        }
+    }
+}
+
+//------------------------------------------------------------------------------
+
+/// Creates a pipe for capturing output, with capacity at least `size` if given.
+/// The capacity is limited to the system's maximum pipe size.  Growing a pipe
+/// may fail if the user has too many large pipes; the pipe keeps its capacity
+/// in that case.
+///
+/// Returns the read and write fds, and the capacity.
+pub fn pipe(size: Option<usize>) -> io::Result<(RawFd, RawFd, usize)> {
+    let (read_fd, write_fd) = sys::pipe()?;
+    let size = size.map(|size| match *PIPE_MAX_SIZE {
+        Some(max_size) => size.min(max_size),
+        None => size,
+    });
+    let capacity = match size.map(|size| sys::set_pipe_size(write_fd, size)) {
+        Some(Ok(capacity)) => capacity,
+        _ => DEFAULT_PIPE_SIZE,
+    };
+    Ok((read_fd, write_fd, capacity))
+}
+
+lazy_static! {
+    /// The largest pipe capacity we may set, read once, as it rarely changes.
+    static ref PIPE_MAX_SIZE: Option<usize> = sys::pipe_max_size().ok();
+}
+
+/// The kernel's default pipe capacity.
+const DEFAULT_PIPE_SIZE: usize = 65536;
+
+/// The size of reads from a capture pipe, adapted to how much output the proc
+/// produces: the size grows while reads fill the buffer, and shrinks while they
+/// return much less.
+#[derive(Debug)]
+pub struct ReadSize {
+    size: usize,
+    min: usize,
+    max: usize,
+}
+
+impl ReadSize {
+    /// Smallest read size.
+    const MIN: usize = 4096;
+
+    /// Returns an initial read size, for a pipe of `capacity`.  A read can't
+    /// return more than the pipe holds, so this is also the largest size.
+    pub fn new(capacity: usize) -> Self {
+        let max = capacity.max(Self::MIN);
+        Self {
+            size: DEFAULT_PIPE_SIZE.clamp(Self::MIN, max),
+            min: Self::MIN,
+            max,
+        }
+    }
+
+    pub fn get(&self) -> usize {
+        self.size
+    }
+
+    /// Updates the size after a read that returned `len` bytes.
+    pub fn update(&mut self, len: usize) {
+        if len >= self.size {
+            self.size = (self.size * 2).min(self.max);
+        } else if len < self.size / 4 {
+            self.size = (self.size / 2).max(self.min);
+        }
+    }
+}
+
+//------------------------------------------------------------------------------
+
+/// Storage for output the server reads from a capture pipe.
+#[derive(Debug)]
+pub enum Storage {
+    Memory(Buffer),
+    Spill(Spill),
+    Compressed(Compressed),
+}
+
+impl Storage {
+    pub fn append_chunk(&mut self, chunk: Bytes) -> io::Result<()> {
+        match self {
+            Storage::Memory(buf) => Ok(buf.append_chunk(chunk)),
+            Storage::Spill(spill) => spill.append_chunk(chunk),
+            Storage::Compressed(compressed) => compressed.append_chunk(chunk),
+        }
+    }
+
+    /// Finishes storing output, at EOF.
+    pub fn finish(&mut self) -> io::Result<()> {
+        match self {
+            Storage::Compressed(compressed) => compressed.finish(),
+            _ => Ok(()),
+        }
+    }
+
+    pub fn compression(&self) -> Option<CompressionStats> {
+        match self {
+            Storage::Compressed(compressed) => Some(compressed.stats()),
+            _ => None,
+        }
+    }
+
+    pub fn contents(&self) -> io::Result<(Chunks, Option<Truncation>)> {
+        match self {
+            Storage::Memory(buf) => Ok(buf.contents()),
+            Storage::Spill(spill) => spill.contents(),
+            Storage::Compressed(compressed) => compressed.contents(),
+        }
+    }
+
+    /// Total number of bytes of output, including any dropped.
+    pub fn len(&self) -> u64 {
+        match self {
+            Storage::Memory(buf) => buf.len(),
+            Storage::Spill(spill) => spill.len(),
+            Storage::Compressed(compressed) => compressed.len(),
+        }
+    }
+
+    /// Returns the range of output that was dropped, if any.
+    pub fn truncation(&self) -> Option<Truncation> {
+        match self {
+            Storage::Memory(buf) => buf.truncation(),
+            Storage::Spill(spill) => spill.truncation(),
+            Storage::Compressed(compressed) => compressed.truncation(),
+        }
+    }
+
+    /// Returns the output in `start..end`, which must have been kept.
+    pub fn read(&self, start: u64, end: u64) -> io::Result<Chunks> {
+        match self {
+            Storage::Memory(buf) => Ok(buf.read(start, end)),
+            Storage::Spill(spill) => spill.read(start, end),
+            Storage::Compressed(compressed) => compressed.read(start, end),
+        }
+    }
+
+    /// Returns all output as a gzip stream, without decompressing it, if the
+    /// output is stored compressed and none was dropped.
+    pub fn gzipped(&self) -> io::Result<Option<Chunks>> {
+        match self {
+            Storage::Compressed(compressed) => compressed.compressed(),
+            _ => Ok(None),
+        }
+    }
+}
+
+//------------------------------------------------------------------------------
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+
+    fn append_all(buf: &mut Buffer, data: &[u8], chunk: usize) {
+        for piece in data.chunks(chunk) {
+            buf.append(piece);
+        }
+    }
+
+    fn flatten((data, truncation): (Chunks, Option<Truncation>)) -> (Vec<u8>, Option<Truncation>) {
+        (data.to_cow().into_owned(), truncation)
+    }
+
+    fn owned((data, truncation): (Cow<[u8]>, Option<Truncation>)) -> (Vec<u8>, Option<Truncation>) {
+        (data.into_owned(), truncation)
+    }
+
+    #[test]
+    fn unbounded() {
+        let mut buf = Buffer::new(None);
+        append_all(&mut buf, b"Hello, world.", 3);
+        assert_eq!(flatten(buf.contents()), (b"Hello, world.".to_vec(), None));
+    }
+
+    #[test]
+    fn unbounded_shares_chunks() {
+        let chunk = Bytes::from(b"Hello, world.".to_vec());
+        let mut buf = Buffer::new(None);
+        buf.append_chunk(chunk.clone());
+        buf.append_chunk(chunk.clone());
+        let (contents, _) = buf.contents();
+        assert_eq!(contents.len(), 26);
+        for c in contents.iter() {
+            assert_eq!(c.as_ptr(), chunk.as_ptr());
+        }
+    }
+
+    #[test]
+    fn chunks_slice() {
+        let data = (0..100u8).collect::<Vec<_>>();
+        let mut chunks = Chunks::default();
+        for piece in data.chunks(7) {
+            chunks.push(Bytes::copy_from_slice(piece));
+        }
+        for (start, end) in [(0, 100), (0, 0), (3, 4), (5, 60), (7, 14), (99, 100)] {
+            let slice = chunks.slice(start, end);
+            assert_eq!(slice.len(), end - start);
+            assert_eq!(slice.to_cow(), &data[start..end]);
+        }
+
+        let (bounded, truncation) = HeadTail { head: 10, tail: 5 }.apply_chunks(chunks);
+        assert_eq!(
+            (bounded.to_cow().into_owned(), truncation),
+            owned(HeadTail { head: 10, tail: 5 }.apply(&data))
+        );
+    }
+
+    #[test]
+    fn head_tail() {
+        let data = (0..100u8).collect::<Vec<_>>();
+        for chunk in [1, 7, 30, 100] {
+            let mut buf = Buffer::new(HeadTail::new(Some(10), Some(20)));
+            append_all(&mut buf, &data, chunk);
+            let (contents, truncation) = flatten(buf.contents());
+            assert_eq!(contents[..10], data[..10]);
+            assert_eq!(contents[10..], data[80..]);
+            assert_eq!(truncation, Some(Truncation { start: 10, length: 70 }));
+            assert_eq!(buf.len(), 100);
+
+            assert_eq!(
+                owned(HeadTail::new(Some(10), Some(20)).unwrap().apply(&data)),
+                (contents, truncation)
+            );
+        }
+    }
+
+    #[test]
+    fn head_tail_short() {
+        let mut buf = Buffer::new(HeadTail::new(Some(10), Some(20)));
+        append_all(&mut buf, b"Hello, world.", 4);
+        assert_eq!(flatten(buf.contents()), (b"Hello, world.".to_vec(), None));
+    }
+
+    #[test]
+    fn tail_only() {
+        let mut buf = Buffer::new(HeadTail::new(None, Some(6)));
+        append_all(&mut buf, b"Hello, world.", 5);
+        let (contents, truncation) = flatten(buf.contents());
+        assert_eq!(&contents[..], b"world.");
+        assert_eq!(truncation, Some(Truncation { start: 0, length: 7 }));
+    }
+
+    #[test]
+    fn plan_append() {
+        let data = (0..100u8).collect::<Vec<_>>();
+        for chunk in [1, 7, 30, 100] {
+            let bounds = HeadTail::new(Some(10), Some(20));
+            let mut buf = Buffer::new(bounds);
+            for piece in data.chunks(chunk) {
+                let (start, skip, end) = buf.plan_append(piece.len());
+                assert_eq!(start + skip + end, piece.len());
+                buf.append(&piece[..start]);
+                buf.skip(skip);
+                buf.append(&piece[piece.len() - end..]);
+            }
+            assert_eq!(flatten(buf.contents()), owned(bounds.unwrap().apply(&data)));
+        }
+    }
+
+    #[test]
+    fn spill() {
+        let data = (0..100u8).collect::<Vec<_>>();
+        let mut spill = Spill::new(40, None, std::env::temp_dir());
+        append_all_spill(&mut spill, &data[..40]);
+        assert!(!spill.is_spilled());
+        append_all_spill(&mut spill, &data[40..]);
+        assert!(spill.is_spilled());
+        assert_eq!(flatten(spill.contents().unwrap()), (data, None));
+    }
+
+    #[test]
+    fn spill_head_tail() {
+        let data = (0..100u8).collect::<Vec<_>>();
+        for len in [20, 100] {
+            let bounds = HeadTail::new(Some(10), Some(5));
+            let mut spill = Spill::new(40, bounds, std::env::temp_dir());
+            append_all_spill(&mut spill, &data[..len]);
+            assert_eq!(
+                flatten(spill.contents().unwrap()),
+                owned(bounds.unwrap().apply(&data[..len]))
+            );
+        }
+    }
+
+    #[test]
+    fn spill_frees_dropped() {
+        let data = (0..8_000_000u32).map(|i| (i % 251) as u8).collect::<Vec<_>>();
+        let bounds = HeadTail::new(Some(1000), Some(2000));
+        let mut spill = Spill::new(4096, bounds, std::env::temp_dir());
+        for piece in data.chunks(65536) {
+            spill.append_chunk(Bytes::copy_from_slice(piece)).unwrap();
+        }
+        assert_eq!(
+            flatten(spill.contents().unwrap()),
+            owned(bounds.unwrap().apply(&data))
+        );
+        // Output between the head and the tail was freed from the file.
+        assert!(spill.freed >= data.len() as u64 - 2000 - FREE_SIZE);
+    }
+
+    fn append_all_spill(spill: &mut Spill, data: &[u8]) {
+        for piece in data.chunks(7) {
+            spill.append_chunk(Bytes::copy_from_slice(piece)).unwrap();
+        }
+    }
+
+    #[test]
+    fn read_size() {
+        let mut size = ReadSize::new(1 << 20);
+        assert_eq!(size.get(), 65536);
+        // Full reads grow the size, up to the pipe capacity.
+        for _ in 0..8 {
+            size.update(size.get());
+        }
+        assert_eq!(size.get(), 1 << 20);
+        // Partial reads don't change it.
+        size.update(size.get() / 2);
+        assert_eq!(size.get(), 1 << 20);
+        // Small reads shrink it, down to the minimum.
+        for _ in 0..16 {
+            size.update(100);
+        }
+        assert_eq!(size.get(), 4096);
+
+        assert_eq!(ReadSize::new(4096).get(), 4096);
+    }
+
+    fn append_all_compressed(compressed: &mut Compressed, data: &[u8], chunk: usize) {
+        for piece in data.chunks(chunk) {
+            compressed.append_chunk(Bytes::copy_from_slice(piece)).unwrap();
+        }
+    }
+
+    #[test]
+    fn compressed() {
+        let data = (0..1000000u32).flat_map(|i| (i % 251).to_le_bytes()).collect::<Vec<_>>();
+        for spill in [None, Some((1000, std::env::temp_dir()))] {
+            let mut compressed = Compressed::new(None, spill.clone());
+            append_all_compressed(&mut compressed, &data, 65536);
+            assert_eq!(flatten(compressed.contents().unwrap()), (data.clone(), None));
+            compressed.finish().unwrap();
+            assert_eq!(flatten(compressed.contents().unwrap()), (data.clone(), None));
+
+            let stats = compressed.stats();
+            assert_eq!(stats.length, data.len() as u64);
+            assert!(stats.memory + stats.disk < data.len() as u64 / 10);
+            assert_eq!(stats.disk > 0, spill.is_some());
+
+            // The frames make up one gzip stream.
+            let gz = compressed.compressed().unwrap().unwrap().to_cow().into_owned();
+            let mut result = Vec::new();
+            flate2::read::MultiGzDecoder::new(&gz[..]).read_to_end(&mut result).unwrap();
+            assert_eq!(result, data);
+        }
+    }
+
+    #[test]
+    fn compressed_head_tail() {
+        let data = (0..1000000u32).flat_map(|i| i.to_le_bytes()).collect::<Vec<_>>();
+        for (head, tail) in [(10, 20), (300000, 0), (0, 500000), (2000000, 2000000)] {
+            let bounds = HeadTail::new(Some(head), Some(tail));
+            let mut compressed = Compressed::new(bounds, None);
+            append_all_compressed(&mut compressed, &data, 100000);
+            assert_eq!(
+                flatten(compressed.contents().unwrap()),
+                owned(bounds.unwrap().apply(&data))
+            );
+            // Frames outside the bounds are dropped.
+            assert!(compressed.stats().length <= (head + tail + 2 * FRAME_SIZE) as u64);
+        }
+
+        // Frames dropped from the file are freed.
+        let bounds = HeadTail::new(Some(10), Some(20));
+        let mut compressed = Compressed::new(bounds, Some((0, std::env::temp_dir())));
+        append_all_compressed(&mut compressed, &data, 100000);
+        let stats = compressed.stats();
+        assert!(stats.memory as usize <= FRAME_SIZE);
+        assert!(stats.disk < compressed.file_len / 4);
+    }
+
+    #[test]
+    fn clip_range_truncated() {
+        let truncated = Some(Truncation { start: 10, length: 70 });
+        assert_eq!(clip_range(0, 100, None), (0, 100));
+        assert_eq!(clip_range(0, 100, truncated), (0, 10));
+        assert_eq!(clip_range(5, 8, truncated), (5, 8));
+        assert_eq!(clip_range(20, 90, truncated), (80, 90));
+        assert_eq!(clip_range(20, 50, truncated), (80, 80));
+        assert_eq!(clip_range(95, 100, truncated), (95, 100));
+    }
+
+    #[test]
+    fn read_range() {
+        let data = (0..1000000u32).flat_map(|i| i.to_le_bytes()).collect::<Vec<_>>();
+        let ranges = [(0, 4000000), (0, 10), (3, 300001), (131000, 400000), (3999990, 4000000)];
+        for bounds in [None, HeadTail::new(Some(10), Some(20)), HeadTail::new(Some(200000), Some(300000))] {
+            let mut storages = vec![
+                Storage::Memory(Buffer::new(bounds)),
+                Storage::Spill(Spill::new(1000, bounds, std::env::temp_dir())),
+                Storage::Compressed(Compressed::new(bounds, None)),
+            ];
+            for storage in storages.iter_mut() {
+                for piece in data.chunks(65536) {
+                    storage.append_chunk(Bytes::copy_from_slice(piece)).unwrap();
+                }
+                assert_eq!(storage.len(), data.len() as u64);
+                for (start, end) in ranges {
+                    let (start, end) = clip_range(start, end, storage.truncation());
+                    let read = storage.read(start, end).unwrap();
+                    assert_eq!(read.to_cow(), &data[start as usize..end as usize]);
+                }
+            }
+        }
+    }
+}
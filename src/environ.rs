@@ -1,26 +1,83 @@
-use std::collections::BTreeMap;
+use std::collections::{BTreeMap, HashMap};
+use std::ffi::{CStr, CString};
+use std::os::unix::ffi::OsStrExt;
+use std::sync::Arc;
 
 use crate::spec;
 
 //------------------------------------------------------------------------------
 
-pub type Env = BTreeMap<String, String>; // FIXME: Use OsString instead?
+/// Env var name.  Not necessarily UTF-8.
+pub type Name = Arc<[u8]>;
 
-//------------------------------------------------------------------------------
+/// A process environment, mapping names to `NAME=val` strings.  Strings of
+/// inherited vars are shared with the snapshot they come from.
+pub type Env = BTreeMap<Name, Arc<CStr>>;
 
-pub fn build(start_env: std::env::Vars, spec: &spec::Env) -> Env {
-    start_env
-        .filter(|(env_var, _)| match &spec.inherit {
-            spec::EnvInherit::None => false,
-            spec::EnvInherit::All => true,
-            spec::EnvInherit::Vars(vars) => vars.contains(env_var),
-        })
-        .chain(
-            (&spec.vars)
-                .into_iter()
-                .map(|(n, v)| (n.clone(), v.clone())),
+/// Formats a `NAME=val` string.
+fn format_var(name: &[u8], val: &[u8]) -> Result<Arc<CStr>, std::ffi::NulError> {
+    let mut var = Vec::with_capacity(name.len() + 1 + val.len());
+    var.extend_from_slice(name);
+    var.push(b'=');
+    var.extend_from_slice(val);
+    Ok(Arc::from(CString::new(var)?))
+}
+
+/// Snapshot of this process's environment, taken once and shared by the envs
+/// of all procs that inherit from it.
+#[derive(Clone, Default)]
+pub struct Snapshot {
+    vars: HashMap<Name, Arc<CStr>>,
+}
+
+impl Snapshot {
+    /// Takes a snapshot of the current environment.
+    pub fn new() -> Self {
+        Self::from_vars(
+            std::env::vars_os().map(|(n, v)| (n.as_bytes().to_vec(), v.as_bytes().to_vec())),
         )
-        .collect()
+    }
+
+    pub fn from_vars<T>(vars: T) -> Self
+    where
+        T: IntoIterator<Item = (Vec<u8>, Vec<u8>)>,
+    {
+        Self {
+            vars: vars
+                .into_iter()
+                // The environment can't contain nul characters.
+                .filter_map(|(n, v)| format_var(&n, &v).ok().map(|var| (Name::from(n), var)))
+                .collect(),
+        }
+    }
+
+    pub fn len(&self) -> usize {
+        self.vars.len()
+    }
+}
+
+/// Builds a proc's env from the inherited vars in `snapshot`, overlaid with the
+/// vars in `spec`.
+///
+/// Fails if a var in `spec` contains a nul character.
+pub fn build(snapshot: &Snapshot, spec: &spec::Env) -> Result<Env, std::ffi::NulError> {
+    let mut env = match &spec.inherit {
+        spec::EnvInherit::None => Env::new(),
+        spec::EnvInherit::All => snapshot
+            .vars
+            .iter()
+            .map(|(n, v)| (Arc::clone(n), Arc::clone(v)))
+            .collect(),
+        spec::EnvInherit::Vars(vars) => vars
+            .iter()
+            .filter_map(|n| snapshot.vars.get_key_value(n.as_bytes()))
+            .map(|(n, v)| (Arc::clone(n), Arc::clone(v)))
+            .collect(),
+    };
+    for (n, v) in spec.vars.iter() {
+        env.insert(Name::from(n.as_bytes()), format_var(n.as_bytes(), v.as_bytes())?);
+    }
+    Ok(env)
 }
 
 //------------------------------------------------------------------------------
@@ -74,6 +131,61 @@ mod tests {
         );
     }
 
+    fn snapshot() -> Snapshot {
+        Snapshot::from_vars(
+            [("HOME", "/home/user"), ("USER", "user"), ("SHELL", "/bin/bash")]
+                .iter()
+                .map(|(n, v)| (n.as_bytes().to_vec(), v.as_bytes().to_vec())),
+        )
+    }
+
+    fn build_strs(spec: &spec::Env) -> Vec<String> {
+        build(&snapshot(), spec)
+            .unwrap()
+            .values()
+            .map(|v| v.to_str().unwrap().to_string())
+            .collect()
+    }
+
+    #[test]
+    fn build_inherit() {
+        assert_eq!(
+            build_strs(&spec::Env {
+                inherit: All,
+                ..Default::default()
+            }),
+            vec!["HOME=/home/user", "SHELL=/bin/bash", "USER=user"]
+        );
+        assert_eq!(
+            build_strs(&spec::Env {
+                inherit: None,
+                ..Default::default()
+            }),
+            Vec::<String>::new()
+        );
+        assert_eq!(
+            build_strs(&spec::Env {
+                inherit: Vars(vec!["USER".to_string(), "BOGUS".to_string()]),
+                ..Default::default()
+            }),
+            vec!["USER=user"]
+        );
+    }
+
+    #[test]
+    fn build_overlay() {
+        assert_eq!(
+            build_strs(&spec::Env {
+                inherit: Vars(vec!["HOME".to_string(), "USER".to_string()]),
+                vars: BTreeMap::from([
+                    ("USER".to_string(), "other".to_string()),
+                    ("FOO".to_string(), "42".to_string()),
+                ]),
+            }),
+            vec!["FOO=42", "HOME=/home/user", "USER=other"]
+        );
+    }
+
     #[test]
     fn vars() {
         assert_json(
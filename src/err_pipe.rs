@@ -1,4 +1,3 @@
-use bytes::{BufMut, BytesMut};
 use std::io;
 use std::os::fd::RawFd;
 use tokio::io::AsyncReadExt;
@@ -35,16 +34,33 @@ pub struct ErrorWriter {
 }
 
 impl ErrorWriter {
-    pub fn write(&self, error: String) -> Result<()> {
-        let bytes = error.as_bytes();
-        // Encode the message len, which cannot be more than 64.
-        assert!(bytes.len() <= u16::MAX as usize);
-        let mut len = BytesMut::with_capacity(2);
-        len.put_u16_le(bytes.len() as u16);
+    /// Wraps the write end of an error pipe that was passed to another process.
+    pub(crate) fn from_raw_fd(write_fd: RawFd) -> Self {
+        Self { write_fd }
+    }
+
+    /// Writes an error message, followed by the description of `errno` if it
+    /// is nonzero.  Doesn't allocate, so this is safe to call in the child
+    /// process after `fork()`.
+    pub fn write_errno(&self, msg: &[u8], errno: i32) -> Result<()> {
+        // Encode the message len, which cannot be more than 64 KiB, and errno.
+        assert!(msg.len() <= u16::MAX as usize);
+        let mut header = [0 as u8; 6];
+        header[..2].copy_from_slice(&(msg.len() as u16).to_le_bytes());
+        header[2..].copy_from_slice(&errno.to_le_bytes());
 
         // Write sync through the raw fd.
-        fdio::write(self.write_fd, &len)?;
-        fdio::write(self.write_fd, &bytes)
+        fdio::write(self.write_fd, &header)?;
+        fdio::write(self.write_fd, msg)
+    }
+
+    pub fn write(&self, error: String) -> Result<()> {
+        self.write_errno(error.as_bytes(), 0)
+    }
+
+    /// Like [`write_errno`], but ignores errors.
+    pub fn try_write_errno(&self, msg: &[u8], errno: i32) {
+        _ = self.write_errno(msg, errno);
     }
 
     /// Like [`write`], but ignores errors.
@@ -59,6 +75,11 @@ impl ErrorPipe {
         Ok(ErrorPipe { read_fd, write_fd })
     }
 
+    /// The write end, for passing to another process that forks the child.
+    pub(crate) fn write_fd(&self) -> RawFd {
+        self.write_fd
+    }
+
     async fn get_errors(mut read_pipe: PipeRead) -> Vec<String> {
         let mut errors = Vec::new();
         loop {
@@ -79,6 +100,15 @@ impl ErrorPipe {
                 },
             };
 
+            // Read the errno, if any, to append to the message.
+            let errno = match read_pipe.read_i32_le().await {
+                Ok(errno) => errno,
+                Err(e) => {
+                    errors.push(format!("error pipe: {}", e));
+                    break;
+                }
+            };
+
             // We know exactly how long the message should be.
             let mut buf = Vec::with_capacity(len);
             buf.resize(len, 0);
@@ -90,7 +120,11 @@ impl ErrorPipe {
             }
 
             // Accumulate this error.
-            errors.push(String::from_utf8_lossy(&buf).to_string());
+            let mut error = String::from_utf8_lossy(&buf).to_string();
+            if errno != 0 {
+                error.push_str(&std::io::Error::from_raw_os_error(errno).to_string());
+            }
+            errors.push(error);
         }
 
         errors
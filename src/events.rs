@@ -0,0 +1,215 @@
+use serde::Serialize;
+use std::collections::VecDeque;
+use std::sync::{Arc, Mutex};
+use tokio::sync::broadcast;
+
+use crate::res;
+use crate::spec::ProcId;
+
+//------------------------------------------------------------------------------
+
+/// A change in the state of a proc.
+#[derive(Clone, Debug, Serialize)]
+#[serde(tag = "type", rename_all = "snake_case")]
+pub enum EventKind {
+    /// The proc was started.
+    Started { pid: libc::pid_t },
+    /// The proc was started but failed to exec its program.
+    ExecFailed { errors: Vec<String> },
+    /// Output captured from an fd reached EOF.
+    OutputEof { fd: String },
+    /// The proc terminated.
+    Exited { status: res::Status },
+    /// The proc was deleted from the proc table.
+    Deleted,
+}
+
+impl EventKind {
+    /// The event type name.
+    pub fn name(&self) -> &'static str {
+        match self {
+            EventKind::Started { .. } => "started",
+            EventKind::ExecFailed { .. } => "exec_failed",
+            EventKind::OutputEof { .. } => "output_eof",
+            EventKind::Exited { .. } => "exited",
+            EventKind::Deleted => "deleted",
+        }
+    }
+}
+
+#[derive(Clone, Debug, Serialize)]
+pub struct Event {
+    /// Sequence number; increases by one with each event.
+    pub seq: u64,
+    pub proc_id: ProcId,
+    #[serde(flatten)]
+    pub kind: EventKind,
+}
+
+/// Number of events buffered for each subscriber.  A subscriber that falls
+/// further behind misses events.
+const CAPACITY: usize = 4096;
+
+/// Default number of recent events kept in the log.
+pub const DEFAULT_LOG_SIZE: usize = 10000;
+
+/// Events after a cursor aren't in the log, either because they are too old,
+/// or because the cursor is past the last event.
+#[derive(Debug)]
+pub struct CursorUnavailable {
+    pub since: u64,
+    /// Sequence numbers of the first and last events in the log.
+    pub first: u64,
+    pub last: u64,
+}
+
+impl std::fmt::Display for CursorUnavailable {
+    fn fmt(&self, f: &mut std::fmt::Formatter) -> std::fmt::Result {
+        write!(
+            f,
+            "events since {} unavailable; log has events {} to {}",
+            self.since, self.first, self.last
+        )
+    }
+}
+
+struct State {
+    /// Sequence number of the next event.
+    next_seq: u64,
+    /// The most recent events, oldest first.
+    log: VecDeque<Arc<Event>>,
+    log_size: usize,
+    sender: broadcast::Sender<Arc<Event>>,
+}
+
+/// Publishes proc lifecycle events to subscribers, and keeps a log of recent
+/// events, from which subscribers can resume.
+#[derive(Clone)]
+pub struct Events {
+    // Events are numbered, logged, and sent under the lock, so that
+    // subscribers receive them in sequence order, and a subscriber that
+    // resumes from the log neither misses nor repeats any.
+    state: Arc<Mutex<State>>,
+}
+
+impl Events {
+    /// Returns events that keep up to `log_size` recent events in the log.
+    pub fn new(log_size: usize) -> Self {
+        Self {
+            state: Arc::new(Mutex::new(State {
+                next_seq: 1,
+                log: VecDeque::with_capacity(log_size),
+                log_size,
+                sender: broadcast::channel(CAPACITY).0,
+            })),
+        }
+    }
+
+    /// Publishes an event for `proc_id`.
+    pub fn send(&self, proc_id: &str, kind: EventKind) {
+        let mut state = self.state.lock().unwrap();
+        let event = Arc::new(Event {
+            seq: state.next_seq,
+            proc_id: proc_id.to_string(),
+            kind,
+        });
+        state.next_seq += 1;
+        if state.log_size > 0 {
+            if state.log.len() == state.log_size {
+                state.log.pop_front();
+            }
+            state.log.push_back(Arc::clone(&event));
+        }
+        // No subscribers is fine.
+        _ = state.sender.send(event);
+    }
+
+    /// Returns a receiver of events published from now on.
+    pub fn subscribe(&self) -> broadcast::Receiver<Arc<Event>> {
+        self.state.lock().unwrap().sender.subscribe()
+    }
+
+    /// Returns the events in the log after sequence number `since`, and a
+    /// receiver of events published after them.
+    pub fn subscribe_since(
+        &self,
+        since: u64,
+    ) -> Result<(Vec<Arc<Event>>, broadcast::Receiver<Arc<Event>>), CursorUnavailable> {
+        let state = self.state.lock().unwrap();
+        let last = state.next_seq - 1;
+        let first = state.log.front().map_or(state.next_seq, |event| event.seq);
+        if last < since || since + 1 < first {
+            return Err(CursorUnavailable { since, first, last });
+        }
+        // The log is in sequence order, without gaps.
+        let skip = (since + 1 - first) as usize;
+        let events = state.log.iter().skip(skip).cloned().collect();
+        Ok((events, state.sender.subscribe()))
+    }
+
+    /// Returns the number of current subscribers.
+    pub fn num_subscribers(&self) -> usize {
+        self.state.lock().unwrap().sender.receiver_count()
+    }
+}
+
+impl Default for Events {
+    fn default() -> Self {
+        Self::new(DEFAULT_LOG_SIZE)
+    }
+}
+
+//------------------------------------------------------------------------------
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn sequence() {
+        let events = Events::default();
+        events.send("before", EventKind::Deleted);
+        let mut receiver = events.subscribe();
+        events.send("a", EventKind::Started { pid: 42 });
+        events.send("b", EventKind::Deleted);
+
+        let event = receiver.try_recv().unwrap();
+        assert_eq!((event.seq, event.proc_id.as_str()), (2, "a"));
+        assert_eq!(
+            serde_json::to_value(&*event).unwrap(),
+            serde_json::json!({"seq": 2, "proc_id": "a", "type": "started", "pid": 42})
+        );
+        let event = receiver.try_recv().unwrap();
+        assert_eq!((event.seq, event.kind.name()), (3, "deleted"));
+        assert!(receiver.try_recv().is_err());
+    }
+
+    #[test]
+    fn resume() {
+        let events = Events::new(3);
+        // Nothing yet.
+        assert!(events.subscribe_since(0).unwrap().0.is_empty());
+        assert!(events.subscribe_since(1).is_err());
+
+        for i in 0..5 {
+            events.send(&format!("proc{}", i), EventKind::Deleted);
+        }
+        // The log has events 3 through 5.
+        let seqs = |since| {
+            events
+                .subscribe_since(since)
+                .map(|(events, _)| events.iter().map(|e| e.seq).collect::<Vec<_>>())
+        };
+        assert_eq!(seqs(2).unwrap(), vec![3, 4, 5]);
+        assert_eq!(seqs(4).unwrap(), vec![5]);
+        assert!(seqs(5).unwrap().is_empty());
+        let err = seqs(1).unwrap_err();
+        assert_eq!((err.first, err.last), (3, 5));
+        assert!(seqs(6).is_err());
+
+        // The receiver gets events after those in the log.
+        let (_, mut receiver) = events.subscribe_since(4).unwrap();
+        events.send("proc5", EventKind::Deleted);
+        assert_eq!(receiver.try_recv().unwrap().seq, 6);
+    }
+}
@@ -1,14 +1,19 @@
+use bytes::{BufMut, Bytes, BytesMut};
 use libc::c_int;
-use std::cell::RefCell;
 use std::fs;
-use std::io::{Read, Seek};
-use std::os::fd::{FromRawFd, IntoRawFd, RawFd};
-use std::path::PathBuf;
-use std::rc::Rc;
+use std::mem::ManuallyDrop;
+use std::os::fd::{AsRawFd, FromRawFd, IntoRawFd, OwnedFd, RawFd};
+use std::os::unix::fs::FileExt;
+use std::path::{Path, PathBuf};
+use std::sync::{Arc, Mutex};
+use tokio::io::unix::AsyncFd;
 use tokio::io::AsyncReadExt;
+use tokio::sync::watch;
 use tokio::task::JoinHandle;
+use tokio::time::{Duration, Instant};
 use tokio_pipe::PipeRead;
 
+use crate::capture::{self, Buffer, Chunks, Compressed, HeadTail, ReadSize, Spill, Storage, Truncation};
 use crate::err::Result;
 use crate::res::FdRes;
 use crate::spec;
@@ -59,7 +64,10 @@ fn get_oflags(flags: &spec::OpenFlag, fd: RawFd) -> libc::c_int {
 
 #[derive(Debug)]
 pub enum FdHandler {
-    Inherit,
+    Inherit {
+        /// Proc-visible fd.
+        fd: RawFd,
+    },
 
     /// Closes the file descriptor.
     Close {
@@ -90,31 +98,143 @@ pub enum FdHandler {
         file_fd: RawFd,
         /// Format for output.
         format: spec::CaptureFormat,
+        /// Bounds on the output included in results.
+        bounds: Option<HeadTail>,
+        /// True if the file is sealed so it can't shrink, and thus is safe to
+        /// read through a memory map.
+        sealed: bool,
+        /// For a file that isn't sealed and whose output is bounded, the output
+        /// within the bounds read so far.  Its length is the offset up to which
+        /// the file has been read.
+        cache: Option<Buffer>,
     },
 
     /// Attaches the file descriptor to a pipe; reads data from the pipe and
-    /// buffers in memory.
-    CaptureMemory {
+    /// stores it in memory, or in memory and then in a file.
+    CapturePipe {
         /// Proc-visible fd.
         fd: RawFd,
         /// Read end of the pipe.
         read_fd: RawFd,
         /// Write end of the pipe.
         write_fd: RawFd,
+        /// Capacity of the pipe.
+        pipe_size: usize,
         /// Format for output.
         format: spec::CaptureFormat,
         /// Captured output.
-        buf: Vec<u8>,
+        storage: Storage,
+    },
+
+    /// Attaches the file descriptor to a pipe; splices output from the pipe
+    /// into an unlinked temporary file, without copying it through memory.
+    CaptureSplice {
+        /// Proc-visible fd.
+        fd: RawFd,
+        /// Read end of the pipe.
+        read_fd: RawFd,
+        /// Write end of the pipe.
+        write_fd: RawFd,
+        /// Capacity of the pipe.
+        pipe_size: usize,
+        /// Fd open to the file.
+        file_fd: RawFd,
+        /// Format for output.
+        format: spec::CaptureFormat,
+        /// If bounded, the output within the bounds, copied from the pipe;
+        /// otherwise, empty, as output is read from the file on request.
+        buf: Buffer,
     },
 }
 
-pub struct SharedFdHandler(Rc<RefCell<FdHandler>>);
+#[derive(Clone)]
+pub struct SharedFdHandler {
+    handler: Arc<Mutex<FdHandler>>,
+    /// Notifies waiters when output is captured.  The value is true once the
+    /// output has reached EOF.
+    notify: Arc<watch::Sender<bool>>,
+}
+
+/// Interval at which waiters poll output that the proc writes directly to a
+/// file, which isn't otherwise noticed until EOF.
+const FILE_POLL_INTERVAL: Duration = Duration::from_millis(50);
+
+/// An fd operation to perform in the child process, before exec.
+#[derive(Clone, Copy, Debug)]
+pub enum FdOp {
+    /// Closes the fd.
+    Close(RawFd),
+    /// Duplicates the first fd onto the second.  The second fd is not
+    /// close-on-exec.
+    Dup2(RawFd, RawFd),
+    /// Clears close-on-exec on the fd, if it is open, so that the program
+    /// inherits it.
+    ClearCloexec(RawFd),
+    /// Marks the fds in the inclusive range close-on-exec, so that the program
+    /// doesn't inherit them.
+    CloexecRange(RawFd, RawFd),
+}
+
+impl FdOp {
+    /// Returns the op to duplicate `fd` onto `fd2`.
+    fn dup(fd: RawFd, fd2: RawFd) -> FdOp {
+        if fd == fd2 {
+            // dup2() is a no-op in this case, and wouldn't clear close-on-exec.
+            FdOp::ClearCloexec(fd)
+        } else {
+            FdOp::Dup2(fd, fd2)
+        }
+    }
+
+    /// Performs the operation, returning errno on failure.  Doesn't allocate,
+    /// so this is safe to call in the child process after `fork()`.
+    pub fn apply(&self) -> std::result::Result<(), c_int> {
+        let res = match *self {
+            FdOp::Close(fd) => unsafe { libc::close(fd) },
+            FdOp::Dup2(fd, fd2) => unsafe { libc::dup2(fd, fd2) },
+            FdOp::ClearCloexec(fd) => match unsafe { libc::fcntl(fd, libc::F_GETFD) } {
+                // Not open; nothing to inherit.
+                -1 if sys::errno() == libc::EBADF => 0,
+                -1 => -1,
+                flags => unsafe { libc::fcntl(fd, libc::F_SETFD, flags & !libc::FD_CLOEXEC) },
+            },
+            FdOp::CloexecRange(first, last) => match sys::cloexec_range(first, last) {
+                Ok(()) => 0,
+                Err(_) => -1,
+            },
+        };
+        match res {
+            -1 => Err(sys::errno()),
+            _ => Ok(()),
+        }
+    }
+}
+
+/// Returns ops that mark all fds close-on-exec, except those 0-2 and those in
+/// `keep`.  Since all fds this process opens are already close-on-exec, this
+/// only affects fds it inherited.
+pub fn cloexec_others(keep: &[RawFd]) -> Vec<FdOp> {
+    let mut keep = keep.iter().cloned().filter(|fd| *fd > 2).collect::<Vec<_>>();
+    keep.sort();
+    keep.dedup();
+
+    let mut ops = Vec::new();
+    let mut first = 3;
+    for fd in keep {
+        if first < fd {
+            ops.push(FdOp::CloexecRange(first, fd - 1));
+        }
+        first = fd + 1;
+    }
+    ops.push(FdOp::CloexecRange(first, RawFd::MAX));
+    ops
+}
 
 //------------------------------------------------------------------------------
 
 const PATH_DEV_NULL: &str = "/dev/null";
-// FIXME: Correct tmpdir.
-const PATH_TMP_TEMPLATE: &str = "/tmp/ir-capture-XXXXXXXXXXXX";
+/// Size of reads from capture files.
+const READ_SIZE: usize = 65536;
 
 /// Opens a file as an unmanaged file fd handler.
 fn open_unmanaged_file(
@@ -124,43 +244,133 @@ fn open_unmanaged_file(
     mode: c_int,
 ) -> Result<FdHandler> {
     let path = PathBuf::from(path);
-    let oflags = get_oflags(&flags, fd);
+    let oflags = get_oflags(&flags, fd) | libc::O_CLOEXEC;
     let file_fd = sys::open(&path, oflags, mode)?;
     Ok(FdHandler::UnmanagedFile { fd, file_fd })
 }
 
-/// Creates and opens an unlinked temporary file as a fd handler.
-fn open_unlinked_temp_file(fd: RawFd, format: spec::CaptureFormat) -> Result<FdHandler> {
-    // Open a temp file.
-    let (tmp_path, tmp_fd) = sys::mkstemp(PATH_TMP_TEMPLATE)?;
-    // Unlink it.
-    std::fs::remove_file(tmp_path)?;
-    // Since it's unlinked, we don't have to deal with it later.
+/// Creates and opens an unlinked temporary file in `tmpdir` as a fd handler.
+fn open_unlinked_temp_file(
+    fd: RawFd,
+    format: spec::CaptureFormat,
+    bounds: Option<HeadTail>,
+    tmpdir: &Path,
+) -> Result<FdHandler> {
+    Ok(FdHandler::UnlinkedFile {
+        fd,
+        file_fd: capture::temp_file(tmpdir)?.into_raw_fd(),
+        format,
+        bounds,
+        sealed: false,
+        cache: bounds.map(|bounds| Buffer::new(Some(bounds))),
+    })
+}
+
+/// Creates a memfd as a fd handler.  The memfd is sealed against shrinking, so
+/// that it can be mapped safely.  Falls back to an unlinked temporary file in
+/// `tmpdir` if memfds aren't available.
+fn open_memfd(
+    fd: RawFd,
+    format: spec::CaptureFormat,
+    bounds: Option<HeadTail>,
+    tmpdir: &Path,
+) -> Result<FdHandler> {
+    let file_fd = match sys::memfd_create("procstar-capture") {
+        Ok(file_fd) => file_fd,
+        Err(_) => return open_unlinked_temp_file(fd, format, bounds, tmpdir),
+    };
+    if let Err(err) = sys::add_seals(file_fd, libc::F_SEAL_SHRINK) {
+        sys::close(file_fd)?;
+        return Err(err.into());
+    }
     Ok(FdHandler::UnlinkedFile {
         fd,
-        file_fd: tmp_fd,
+        file_fd,
         format,
+        bounds,
+        sealed: true,
+        cache: None,
     })
 }
 
-/// Reads the contents of a file from the beginning, from its open fd.
-fn read_file_from_start(fd: RawFd) -> Result<Vec<u8>> {
-    // Wrap the fd in a file object, for convenience.  This takes ownership of the fd.
-    let mut file = unsafe { fs::File::from_raw_fd(fd) };
-    // Seek to front.
-    file.rewind()?;
-    // Read the contents.
-    let mut buf = Vec::<u8>::new();
-    file.read_to_end(&mut buf)?;
-    // Take back ownership of the fd.
-    assert!(file.into_raw_fd() == fd);
-    Ok(buf)
+/// Reads the output in `start..end` of the file at `fd`, or up to its end if it
+/// is shorter.
+///
+/// The proc writes through the same open file description, so this uses
+/// positional reads, which don't move the proc's file offset.
+fn read_file(fd: RawFd, start: u64, end: u64) -> Result<Chunks> {
+    // Wrap the fd in a file object, for convenience, without taking ownership.
+    let file = ManuallyDrop::new(unsafe { fs::File::from_raw_fd(fd) });
+    let mut data = Chunks::default();
+    let mut offset = start;
+    while offset < end {
+        let mut chunk = vec![0; ((end - offset) as usize).min(READ_SIZE)];
+        match file.read_at(&mut chunk, offset)? {
+            0 => break,
+            n => {
+                chunk.truncate(n);
+                offset += n as u64;
+                data.push(Bytes::from(chunk));
+            }
+        }
+    }
+    Ok(data)
+}
+
+/// Reads output appended to the file at `fd` since the last call into `cache`,
+/// which must be bounded.  Reads only the bytes within the bounds.
+///
+/// If the file has shrunk, the proc truncated it, so reads it again from the
+/// start.  Output the proc overwrote in place before the end of the cache
+/// isn't detected.
+fn read_file_incremental(fd: RawFd, cache: &mut Buffer) -> Result<()> {
+    // Read up to the current end of the file, not anything written meanwhile.
+    let size = sys::file_size(fd)? as u64;
+    if size < cache.len() {
+        cache.clear();
+    }
+    let offset = cache.len();
+    let (start, skip, end) = cache.plan_append((size - offset) as usize);
+    for chunk in read_file(fd, offset, offset + start as u64)?.iter() {
+        cache.append_chunk(chunk.clone());
+    }
+    cache.skip(skip);
+    for chunk in read_file(fd, size - end as u64, size)?.iter() {
+        cache.append_chunk(chunk.clone());
+    }
+    Ok(())
+}
+
+/// Splices exactly `len` bytes from `fd_in` to `fd_out`, which are already
+/// available in `fd_in`.
+fn splice_exact(fd_in: RawFd, fd_out: RawFd, mut len: usize) -> Result<()> {
+    while len > 0 {
+        match sys::splice(fd_in, fd_out, len, libc::SPLICE_F_MOVE)? {
+            0 => return Err(std::io::Error::from(std::io::ErrorKind::UnexpectedEof).into()),
+            n => len -= n,
+        }
+    }
+    Ok(())
+}
+
+/// Reads exactly `len` bytes from `fd`, which are already available.
+fn read_exact(fd: RawFd, len: usize) -> Result<Bytes> {
+    let mut data = vec![0; len];
+    let mut pos = 0;
+    while pos < len {
+        match sys::read(fd, &mut data[pos..])? {
+            0 => return Err(std::io::Error::from(std::io::ErrorKind::UnexpectedEof).into()),
+            n => pos += n,
+        }
+    }
+    Ok(Bytes::from(data))
 }
 
 impl SharedFdHandler {
-    pub fn new(fd: RawFd, spec: spec::Fd) -> Result<Self> {
+    pub fn new(fd: RawFd, spec: spec::Fd, config: &capture::Config) -> Result<Self> {
+        let tmpdir = &config.tmpdir();
         let fd_handler = match spec {
-            spec::Fd::Inherit => FdHandler::Inherit,
+            spec::Fd::Inherit => FdHandler::Inherit { fd },
 
             spec::Fd::Close => FdHandler::Close { fd },
 
@@ -173,55 +383,228 @@ impl SharedFdHandler {
             spec::Fd::Capture {
                 mode: spec::CaptureMode::TempFile,
                 format,
+                head,
+                tail,
+                ..
+            } => open_unlinked_temp_file(fd, format, HeadTail::new(head, tail), tmpdir)?,
+
+            spec::Fd::Capture {
+                mode: spec::CaptureMode::Memfd,
+                format,
+                head,
+                tail,
+                ..
+            } => open_memfd(fd, format, HeadTail::new(head, tail), tmpdir)?,
+
+            spec::Fd::Capture {
+                mode: spec::CaptureMode::Splice,
+                format,
+                head,
+                tail,
+                pipe_size,
                 ..
-            } => open_unlinked_temp_file(fd, format)?,
+            } => {
+                let (read_fd, write_fd, pipe_size) =
+                    capture::pipe(pipe_size.or(config.pipe_size))?;
+                FdHandler::CaptureSplice {
+                    fd,
+                    read_fd,
+                    write_fd,
+                    pipe_size,
+                    file_fd: capture::temp_file(tmpdir)?.into_raw_fd(),
+                    format,
+                    buf: Buffer::new(HeadTail::new(head, tail)),
+                }
+            }
 
             spec::Fd::Capture {
-                mode: spec::CaptureMode::Memory,
+                mode,
                 format,
+                head,
+                tail,
+                spill_size,
+                pipe_size,
+                compress,
             } => {
-                let (read_fd, write_fd) = sys::pipe()?;
-                FdHandler::CaptureMemory {
+                let bounds = HeadTail::new(head, tail);
+                let spill_size = spill_size.unwrap_or(capture::DEFAULT_SPILL_SIZE);
+                let storage = match (mode, compress) {
+                    (spec::CaptureMode::Spill, Some(spec::Compression::Gzip)) => {
+                        Storage::Compressed(Compressed::new(
+                            bounds,
+                            Some((spill_size, tmpdir.to_path_buf())),
+                        ))
+                    }
+                    (spec::CaptureMode::Spill, None) => {
+                        Storage::Spill(Spill::new(spill_size, bounds, tmpdir.to_path_buf()))
+                    }
+                    (_, Some(spec::Compression::Gzip)) => {
+                        Storage::Compressed(Compressed::new(bounds, None))
+                    }
+                    (_, None) => Storage::Memory(Buffer::new(bounds)),
+                };
+                let (read_fd, write_fd, pipe_size) =
+                    capture::pipe(pipe_size.or(config.pipe_size))?;
+                FdHandler::CapturePipe {
                     fd,
                     read_fd,
                     write_fd,
+                    pipe_size,
                     format,
-                    buf: Vec::new(),
+                    storage,
                 }
             }
         };
-        Ok(SharedFdHandler(Rc::new(RefCell::new(fd_handler))))
+        Ok(SharedFdHandler {
+            handler: Arc::new(Mutex::new(fd_handler)),
+            notify: Arc::new(watch::channel(false).0),
+        })
     }
 
-    /// Reads from the pipe read fd, appending data to `buf`, until EOF.
-    async fn run_capture_memory(rc: Rc<RefCell<FdHandler>>) -> Result<()> {
-        let mut read_pipe = if let FdHandler::CaptureMemory { read_fd, .. } = *rc.borrow() {
-            PipeRead::from_raw_fd_checked(read_fd)?
+    /// Reads from the pipe read fd, appending data to storage, until EOF.
+    async fn run_capture_pipe(
+        handler: Arc<Mutex<FdHandler>>,
+        notify: Arc<watch::Sender<bool>>,
+    ) -> Result<()> {
+        let (read_fd, pipe_size) = if let FdHandler::CapturePipe {
+            read_fd, pipe_size, ..
+        } = *handler.lock().unwrap()
+        {
+            (read_fd, pipe_size)
         } else {
             panic!();
         };
+        let mut read_pipe = PipeRead::from_raw_fd_checked(read_fd)?;
 
-        let mut read_buf = [0 as u8; 65536]; // FIXME: What's the right size?
+        let mut read_size = ReadSize::new(pipe_size);
+        let mut read_buf = BytesMut::new();
         loop {
-            // Don't hold a ref to the handler object across await, so `buf` is
+            // Read directly into free space in the buffer, allocating a fresh
+            // one if it is short.  Chunks already split off it are shared with
+            // storage, and are never copied or moved.
+            read_buf.reserve(read_size.get());
+            // Don't hold the handler lock across await, so storage is
             // accessible elsewhere.
-            let len = read_pipe.read(&mut read_buf).await?;
+            let len = read_pipe.read_buf(&mut (&mut read_buf).limit(read_size.get())).await?;
+            read_size.update(len);
             if len == 0 {
+                if let FdHandler::CapturePipe { ref mut storage, .. } = *handler.lock().unwrap() {
+                    storage.finish()?;
+                }
                 break;
             } else {
-                if let &mut FdHandler::CaptureMemory { ref mut buf, .. } = &mut *rc.borrow_mut() {
-                    buf.extend_from_slice(&read_buf[..len]);
+                let chunk = read_buf.split().freeze();
+                if let FdHandler::CapturePipe { ref mut storage, .. } = *handler.lock().unwrap() {
+                    storage.append_chunk(chunk)?;
                 } else {
                     panic!();
                 };
+                notify.send_modify(|_| ());
             }
         }
+        notify.send_replace(true);
+        Ok(())
+    }
+
+    /// Splices from the pipe read fd into the file, until EOF.  If the output
+    /// is bounded, also tees it to a second pipe, from which it reads the bytes
+    /// within the bounds into `buf`, and discards the rest.
+    async fn run_capture_splice(
+        handler: Arc<Mutex<FdHandler>>,
+        notify: Arc<watch::Sender<bool>>,
+    ) -> Result<()> {
+        let (read_fd, pipe_size, file_fd, bounded) = if let FdHandler::CaptureSplice {
+            read_fd,
+            pipe_size,
+            file_fd,
+            ref buf,
+            ..
+        } = *handler.lock().unwrap()
+        {
+            (read_fd, pipe_size, file_fd, buf.is_bounded())
+        } else {
+            panic!();
+        };
+        let read_fd = unsafe { OwnedFd::from_raw_fd(read_fd) };
+        sys::set_nonblocking(read_fd.as_raw_fd())?;
+        let read_fd = AsyncFd::new(read_fd)?;
+
+        let tee_pipe = if bounded {
+            let (tee_read_fd, tee_write_fd, _) = capture::pipe(Some(pipe_size))?;
+            let null_fd = sys::open(
+                Path::new(PATH_DEV_NULL),
+                libc::O_WRONLY | libc::O_CLOEXEC,
+                0,
+            )?;
+            Some(unsafe {
+                (
+                    OwnedFd::from_raw_fd(tee_read_fd),
+                    OwnedFd::from_raw_fd(tee_write_fd),
+                    OwnedFd::from_raw_fd(null_fd),
+                )
+            })
+        } else {
+            None
+        };
+
+        loop {
+            let mut guard = read_fd.readable().await?;
+            // If bounded, copy output to the tee pipe before moving it.  The
+            // tee pipe is empty, so this copies as much as it holds.
+            let result = guard.try_io(|read_fd| match tee_pipe {
+                Some((_, ref tee_write_fd, _)) => sys::tee(
+                    read_fd.as_raw_fd(),
+                    tee_write_fd.as_raw_fd(),
+                    pipe_size,
+                    libc::SPLICE_F_NONBLOCK,
+                ),
+                None => sys::splice(
+                    read_fd.as_raw_fd(),
+                    file_fd,
+                    pipe_size,
+                    libc::SPLICE_F_MOVE | libc::SPLICE_F_NONBLOCK,
+                ),
+            });
+            let len = match result {
+                Ok(result) => result?,
+                Err(_would_block) => continue,
+            };
+            if len == 0 {
+                break;
+            }
+
+            if let Some((ref tee_read_fd, _, ref null_fd)) = tee_pipe {
+                // Move the output we copied to the file.
+                splice_exact(read_fd.get_ref().as_raw_fd(), file_fd, len)?;
+                // Read the copied bytes within the bounds, and discard the
+                // rest.
+                let plan = if let FdHandler::CaptureSplice { ref buf, .. } = *handler.lock().unwrap()
+                {
+                    buf.plan_append(len)
+                } else {
+                    panic!();
+                };
+                let (start, skip, end) = plan;
+                let start_data = read_exact(tee_read_fd.as_raw_fd(), start)?;
+                splice_exact(tee_read_fd.as_raw_fd(), null_fd.as_raw_fd(), skip)?;
+                let end_data = read_exact(tee_read_fd.as_raw_fd(), end)?;
+                if let FdHandler::CaptureSplice { ref mut buf, .. } = *handler.lock().unwrap() {
+                    buf.append_chunk(start_data);
+                    buf.skip(skip);
+                    buf.append_chunk(end_data);
+                } else {
+                    panic!();
+                };
+            }
+            notify.send_modify(|_| ());
+        }
+        notify.send_replace(true);
         Ok(())
     }
 
     pub fn in_parent(&self) -> Result<Option<JoinHandle<Result<()>>>> {
-        Ok(match *self.0.borrow() {
-            FdHandler::Inherit => None,
+        Ok(match *self.handler.lock().unwrap() {
+            FdHandler::Inherit { .. } => None,
 
             FdHandler::Close { .. } => None,
 
@@ -234,84 +617,224 @@ impl SharedFdHandler {
 
             FdHandler::UnlinkedFile { .. } => None,
 
-            FdHandler::CaptureMemory { write_fd, .. } => {
+            FdHandler::CapturePipe { write_fd, .. } => {
+                // In the parent, we only read.
+                sys::close(write_fd)?;
+                // Start a task to drain the pipe into storage.
+                Some(tokio::spawn(Self::run_capture_pipe(
+                    Arc::clone(&self.handler),
+                    Arc::clone(&self.notify),
+                )))
+            }
+
+            FdHandler::CaptureSplice { write_fd, .. } => {
                 // In the parent, we only read.
                 sys::close(write_fd)?;
-                // Start a task to drain the pipe into the buffer.
-                Some(tokio::task::spawn_local(Self::run_capture_memory(
-                    Rc::clone(&self.0),
+                // Start a task to splice the pipe into the file.
+                Some(tokio::spawn(Self::run_capture_splice(
+                    Arc::clone(&self.handler),
+                    Arc::clone(&self.notify),
                 )))
             }
         })
     }
 
-    pub fn in_child(self) -> Result<()> {
-        match Rc::try_unwrap(self.0).unwrap().into_inner() {
-            FdHandler::Inherit => Ok(()),
+    /// Returns the fd operations to perform in the child process.
+    pub fn child_ops(&self) -> Vec<FdOp> {
+        match *self.handler.lock().unwrap() {
+            // The fd may be close-on-exec, if inherited in service mode.
+            FdHandler::Inherit { fd } => vec![FdOp::ClearCloexec(fd)],
 
-            FdHandler::Close { fd } => {
-                sys::close(fd)?;
-                Ok(())
-            }
+            FdHandler::Close { fd } => vec![FdOp::Close(fd)],
 
-            FdHandler::Dup { fd, dup_fd } => {
-                if dup_fd != fd {
-                    sys::dup2(dup_fd, fd)?;
-                }
-                Ok(())
-            }
+            FdHandler::Dup { fd, dup_fd } => vec![FdOp::dup(dup_fd, fd)],
 
+            // Our own fds are close-on-exec, so they needn't be closed after
+            // they are dup'ed.
             FdHandler::UnmanagedFile { fd, file_fd }
-            | FdHandler::UnlinkedFile { fd, file_fd, .. } => {
-                if file_fd != fd {
-                    sys::dup2(file_fd, fd)?;
-                    sys::close(file_fd)?;
-                }
-                Ok(())
-            }
+            | FdHandler::UnlinkedFile { fd, file_fd, .. } => vec![FdOp::dup(file_fd, fd)],
 
-            FdHandler::CaptureMemory {
-                fd,
-                read_fd,
-                write_fd,
-                ..
-            } => {
-                // In the child, don't read from the pipe.
-                sys::close(read_fd)?;
-                // Attach the write pipe to the target fd.
-                sys::dup2(write_fd, fd)?;
-                Ok(())
-            }
+            FdHandler::CapturePipe { fd, write_fd, .. }
+            | FdHandler::CaptureSplice { fd, write_fd, .. } => vec![FdOp::dup(write_fd, fd)],
         }
     }
 
     pub fn get_result(&self) -> Result<FdRes> {
         // FIXME: Should we provide more information here?
-        Ok(match &*self.0.borrow() {
-            FdHandler::Inherit
+        Ok(match &mut *self.handler.lock().unwrap() {
+            FdHandler::Inherit { .. }
             | FdHandler::Close { .. }
             | FdHandler::Dup { .. }
             | FdHandler::UnmanagedFile { .. } => FdRes::None,
 
             FdHandler::UnlinkedFile {
-                file_fd, format, ..
-            } => FdRes::from_bytes(*format, &read_file_from_start(*file_fd)?),
+                file_fd,
+                format,
+                bounds,
+                sealed,
+                cache,
+                ..
+            } => {
+                if *sealed {
+                    let map = sys::Mmap::new(*file_fd, sys::file_size(*file_fd)?)?;
+                    // Encode the kept output directly from the map.
+                    let truncated = bounds.and_then(|bounds| bounds.truncation(map.len() as u64));
+                    let slices = match truncated {
+                        Some(Truncation { start, length }) => {
+                            vec![&map[..start as usize], &map[(start + length) as usize..]]
+                        }
+                        None => vec![&map[..]],
+                    };
+                    FdRes::from_slices(*format, slices, truncated)
+                } else if let Some(cache) = cache {
+                    read_file_incremental(*file_fd, cache)?;
+                    let (data, truncated) = cache.contents();
+                    FdRes::from_bytes(*format, &data, truncated)
+                } else {
+                    // Unbounded, so read the whole file for this result only.
+                    let data = read_file(*file_fd, 0, sys::file_size(*file_fd)? as u64)?;
+                    FdRes::from_bytes(*format, &data, None)
+                }
+            }
+
+            FdHandler::CapturePipe { format, storage, .. } => {
+                let (data, truncated) = storage.contents()?;
+                FdRes::from_bytes(*format, &data, truncated)
+                    .with_compression(storage.compression())
+            }
+
+            FdHandler::CaptureSplice {
+                file_fd,
+                format,
+                buf,
+                ..
+            } => {
+                let (data, truncated) = if buf.is_bounded() {
+                    buf.contents()
+                } else {
+                    // All output is in the file; read it for this result only.
+                    (read_file(*file_fd, 0, sys::file_size(*file_fd)? as u64)?, None)
+                };
+                FdRes::from_bytes(*format, &data, truncated)
+            }
+        })
+    }
+
+    /// Returns the number of bytes of output captured so far, including any
+    /// dropped, and the range that was dropped, if any; or none if the fd
+    /// isn't captured.
+    pub fn output_len(&self) -> Result<Option<(u64, Option<Truncation>)>> {
+        Ok(match &*self.handler.lock().unwrap() {
+            FdHandler::Inherit { .. }
+            | FdHandler::Close { .. }
+            | FdHandler::Dup { .. }
+            | FdHandler::UnmanagedFile { .. } => None,
+
+            FdHandler::UnlinkedFile { file_fd, bounds, .. } => {
+                let len = sys::file_size(*file_fd)? as u64;
+                Some((len, bounds.and_then(|bounds| bounds.truncation(len))))
+            }
+
+            FdHandler::CapturePipe { storage, .. } => Some((storage.len(), storage.truncation())),
+
+            FdHandler::CaptureSplice { file_fd, buf, .. } => {
+                if buf.is_bounded() {
+                    Some((buf.len(), buf.truncation()))
+                } else {
+                    Some((sys::file_size(*file_fd)? as u64, None))
+                }
+            }
+        })
+    }
+
+    /// Reads captured output in `start..end`, which must have been kept.
+    /// Output in a file is read positionally, and only this range of it.
+    pub fn read_output(&self, start: u64, end: u64) -> Result<Chunks> {
+        let mut data = Chunks::default();
+        match &*self.handler.lock().unwrap() {
+            FdHandler::UnlinkedFile { file_fd, .. } | FdHandler::CaptureSplice { file_fd, .. } => {
+                // Splice capture moves all output to the file, even if bounded.
+                let file = ManuallyDrop::new(unsafe { fs::File::from_raw_fd(*file_fd) });
+                data.push(capture::read_file_range(&file, start, end)?);
+            }
+
+            FdHandler::CapturePipe { storage, .. } => data = storage.read(start, end)?,
+
+            _ => {}
+        }
+        Ok(data)
+    }
+
+    /// Waits until more than `after` bytes of output have been captured, the
+    /// output reaches EOF, or `deadline`.
+    pub async fn wait_output(&self, after: u64, deadline: Instant) -> Result<()> {
+        let mut notify = self.notify.subscribe();
+        // Output the proc writes to a file doesn't pass through us, so poll the
+        // file's length.
+        let poll = matches!(*self.handler.lock().unwrap(), FdHandler::UnlinkedFile { .. });
+        loop {
+            // Mark the notification seen before checking, so that we don't
+            // miss output captured meanwhile.
+            let eof = *notify.borrow_and_update();
+            let len = self.output_len()?.map_or(0, |(len, _)| len);
+            if eof || after < len {
+                return Ok(());
+            }
+            let wake = if poll {
+                deadline.min(Instant::now() + FILE_POLL_INTERVAL)
+            } else {
+                deadline
+            };
+            match tokio::time::timeout_at(wake, notify.changed()).await {
+                Err(_) if deadline <= Instant::now() => return Ok(()),
+                _ => {}
+            }
+        }
+    }
+
+    /// Marks output at EOF, once the proc has terminated and any output it
+    /// wrote has been captured.
+    pub fn finish(&self) {
+        self.notify.send_replace(true);
+    }
+
+    /// True if the fd's output is captured.
+    pub fn is_captured(&self) -> bool {
+        matches!(
+            *self.handler.lock().unwrap(),
+            FdHandler::UnlinkedFile { .. } | FdHandler::CapturePipe { .. } | FdHandler::CaptureSplice { .. }
+        )
+    }
+
+    /// True if the output has reached EOF.
+    pub fn is_eof(&self) -> bool {
+        *self.notify.borrow()
+    }
 
-            FdHandler::CaptureMemory { format, buf, .. } => FdRes::from_bytes(*format, buf),
+    /// Returns all captured output as a gzip stream, if it's stored compressed
+    /// and none was dropped.
+    pub fn gzipped_output(&self) -> Result<Option<Chunks>> {
+        Ok(match &*self.handler.lock().unwrap() {
+            FdHandler::CapturePipe { storage, .. } => storage.gzipped()?,
+            _ => None,
         })
     }
 }
 
 //------------------------------------------------------------------------------
 
-pub fn make_fd_handler(fd_str: String, spec: spec::Fd) -> (RawFd, SharedFdHandler) {
+pub fn make_fd_handler(
+    fd_str: String,
+    spec: spec::Fd,
+    config: &capture::Config,
+) -> (RawFd, SharedFdHandler) {
     // FIXME: Parse, or at least check, when deserializing.
     let fd_num = parse_fd(&fd_str).unwrap_or_else(|err| {
         eprintln!("failed to parse fd {}: {}", fd_str, err);
         std::process::exit(exitcode::OSERR);
     });
 
-    let handler = SharedFdHandler::new(fd_num, spec).unwrap_or_else(|err| {
+    let handler = SharedFdHandler::new(fd_num, spec, config).unwrap_or_else(|err| {
         eprintln!("failed to set up fd {}: {}", fd_num, err);
         std::process::exit(exitcode::OSERR);
     });
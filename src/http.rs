@@ -1,18 +1,30 @@
+use http_body_util::combinators::BoxBody;
 use http_body_util::{BodyExt, Full};
-use hyper::body::{Bytes, Incoming};
-use hyper::header::HeaderValue;
+use hyper::body::{Body, Bytes, Frame, Incoming, SizeHint};
+use hyper::header::{HeaderMap, HeaderValue};
 use hyper::{Method, Request, Response, StatusCode};
 use serde_json::json;
-use std::rc::Rc;
+use std::collections::{BTreeMap, BTreeSet, VecDeque};
+use std::io;
+use std::pin::Pin;
+use std::sync::Arc;
+use std::task::{Context, Poll};
+use tokio::sync::{broadcast, mpsc};
+use tokio::time::{Duration, Instant};
 
-use crate::procs::{start_procs, SharedRunningProcs};
-use crate::sig::parse_signum;
+use crate::capture::{self, Chunks};
+use crate::events::Event;
+use crate::fd::{parse_fd, SharedFdHandler};
+use crate::procs::{LabelSelector, ProcFilter, ProcState, SharedRunningProcs};
+use crate::queue::SubmitError;
+use crate::res;
+use crate::sig::{num_watchers, parse_signum};
 use crate::spec::{Input, ProcId};
 
 //------------------------------------------------------------------------------
 
 type Req = Request<Incoming>;
-type Rsp = Response<Full<Bytes>>;
+type Rsp = Response<BoxBody<Bytes, io::Error>>;
 
 struct RspError(StatusCode, Option<String>);
 
@@ -20,6 +32,10 @@ impl RspError {
     fn bad_request(msg: &str) -> RspError {
         RspError(StatusCode::BAD_REQUEST, Some(msg.to_string()))
     }
+
+    fn internal(err: crate::err::Error) -> RspError {
+        RspError(StatusCode::INTERNAL_SERVER_ERROR, Some(err.to_string()))
+    }
 }
 
 type RspResult = Result<serde_json::Value, RspError>;
@@ -35,7 +51,7 @@ where
             hyper::header::CONTENT_TYPE,
             HeaderValue::from_static("application/json"),
         )
-        .body(Full::<Bytes>::from(body))
+        .body(Full::<Bytes>::from(body).map_err(|never| match never {}).boxed())
         .unwrap()
 }
 
@@ -65,19 +81,466 @@ fn make_response(rsp: RspResult) -> Rsp {
     }
 }
 
+//------------------------------------------------------------------------------
+
+/// Size of pieces in which output is read while a response body is sent.
+/// Bodies larger than this are sent chunked.
+const OUTPUT_PIECE_SIZE: u64 = 1 << 20;
+
+/// Response body of captured output, read from an fd handler a piece at a
+/// time as it is sent, so that a large body is never in memory at once.
+struct OutputBody {
+    fd_handler: Option<SharedFdHandler>,
+    /// Ranges of output still to read.
+    ranges: VecDeque<(u64, u64)>,
+    /// Output read but not yet sent.
+    chunks: VecDeque<Bytes>,
+    /// Number of bytes not yet sent.
+    remaining: u64,
+}
+
+impl OutputBody {
+    /// Body of output in `ranges`, read from `fd_handler`.
+    fn new(fd_handler: SharedFdHandler, ranges: Vec<(u64, u64)>) -> Self {
+        let remaining = ranges.iter().map(|(start, end)| end - start).sum();
+        Self {
+            fd_handler: Some(fd_handler),
+            ranges: ranges.into(),
+            chunks: VecDeque::new(),
+            remaining,
+        }
+    }
+
+    /// Body of output that has already been read.
+    fn from_chunks(chunks: Chunks) -> Self {
+        Self {
+            fd_handler: None,
+            ranges: VecDeque::new(),
+            remaining: chunks.len() as u64,
+            chunks: chunks.iter().cloned().collect(),
+        }
+    }
+
+    /// Reads the next piece of output.
+    fn read_piece(&mut self) -> io::Result<()> {
+        let (start, end) = self.ranges.pop_front().unwrap();
+        let piece_end = end.min(start + OUTPUT_PIECE_SIZE);
+        if piece_end < end {
+            self.ranges.push_front((piece_end, end));
+        }
+        let data = self
+            .fd_handler
+            .as_ref()
+            .unwrap()
+            .read_output(start, piece_end)
+            .map_err(|err| io::Error::new(io::ErrorKind::Other, err.to_string()))?;
+        if data.len() as u64 != piece_end - start {
+            // Output was dropped since the response started.
+            return Err(io::Error::new(io::ErrorKind::UnexpectedEof, "output dropped"));
+        }
+        self.chunks.extend(data.iter().cloned());
+        Ok(())
+    }
+}
+
+impl Body for OutputBody {
+    type Data = Bytes;
+    type Error = io::Error;
+
+    fn poll_frame(
+        mut self: Pin<&mut Self>,
+        _cx: &mut Context<'_>,
+    ) -> Poll<Option<Result<Frame<Bytes>, io::Error>>> {
+        while self.chunks.is_empty() && !self.ranges.is_empty() {
+            if let Err(err) = self.read_piece() {
+                self.ranges.clear();
+                return Poll::Ready(Some(Err(err)));
+            }
+        }
+        Poll::Ready(self.chunks.pop_front().map(|chunk| {
+            self.remaining -= chunk.len() as u64;
+            Ok(Frame::data(chunk))
+        }))
+    }
+
+    fn is_end_stream(&self) -> bool {
+        self.remaining == 0
+    }
+
+    fn size_hint(&self) -> SizeHint {
+        // Give the length of small bodies up front; send large ones chunked.
+        if self.remaining <= OUTPUT_PIECE_SIZE {
+            SizeHint::with_exact(self.remaining)
+        } else {
+            SizeHint::default()
+        }
+    }
+}
+
+/// Returns query params from the request URI.
+fn get_query(parts: &http::request::Parts) -> BTreeMap<String, String> {
+    form_urlencoded::parse(parts.uri.query().unwrap_or("").as_bytes())
+        .into_owned()
+        .collect()
+}
+
+/// Returns an integer query param, if given.
+fn get_query_u64(query: &BTreeMap<String, String>, name: &str) -> Result<Option<u64>, RspError> {
+    query
+        .get(name)
+        .map(|val| {
+            val.parse::<u64>()
+                .map_err(|_| RspError::bad_request(&format!("invalid {}: {}", name, val)))
+        })
+        .transpose()
+}
+
+/// Longest time a request may wait.
+const MAX_WAIT: f64 = 3600.0;
+
+/// Returns a duration query param in seconds, if given.  Durations are limited
+/// to `MAX_WAIT`.
+fn get_query_secs(query: &BTreeMap<String, String>, name: &str) -> Result<Option<Duration>, RspError> {
+    query
+        .get(name)
+        .map(|val| {
+            val.parse::<f64>()
+                .ok()
+                .and_then(|secs| Duration::try_from_secs_f64(secs.min(MAX_WAIT)).ok())
+                .ok_or_else(|| RspError::bad_request(&format!("invalid {}: {}", name, val)))
+        })
+        .transpose()
+}
+
+/// Top-level fields of proc results.
+const RES_FIELDS: [&str; 7] = ["errors", "pid", "status", "rusage", "labels", "queued", "fds"];
+
+/// Which parts of proc results to return.
+struct ResQuery {
+    /// Fields to include, or none for all.
+    fields: Option<BTreeSet<String>>,
+    fds: res::FdDetail,
+}
+
+impl ResQuery {
+    /// Returns the parts of proc results requested by query params `fields`
+    /// and `fds`.
+    fn new(query: &BTreeMap<String, String>) -> Result<ResQuery, RspError> {
+        let fields = query
+            .get("fields")
+            .map(|val| {
+                val.split(',')
+                    .filter(|field| !field.is_empty())
+                    .map(|field| {
+                        if RES_FIELDS.contains(&field) {
+                            Ok(field.to_string())
+                        } else {
+                            Err(RspError::bad_request(&format!("invalid field: {}", field)))
+                        }
+                    })
+                    .collect::<Result<BTreeSet<_>, _>>()
+            })
+            .transpose()?;
+        let fds = match query.get("fds").map(String::as_str) {
+            None | Some("full") => res::FdDetail::Full,
+            Some("sizes") => res::FdDetail::Sizes,
+            Some("none") => res::FdDetail::None,
+            Some(fds) => return Err(RspError::bad_request(&format!("invalid fds: {}", fds))),
+        };
+        // Don't bother with fds if they're not wanted.
+        let fds = match fields {
+            Some(ref fields) if !fields.contains("fds") => res::FdDetail::None,
+            _ => fds,
+        };
+        Ok(ResQuery { fields, fds })
+    }
+
+    /// Returns a proc result as JSON, with only the requested fields.
+    fn project(&self, result: res::ProcRes) -> serde_json::Value {
+        let mut jso = serde_json::to_value(result).unwrap();
+        if let (Some(fields), serde_json::Value::Object(obj)) = (&self.fields, &mut jso) {
+            obj.retain(|key, _| fields.contains(key));
+        }
+        jso
+    }
+}
+
+/// A requested range of bytes, before it's resolved against the length of
+/// output.
+#[derive(Debug, PartialEq, Eq)]
+enum ByteRange {
+    /// Bytes from an offset, up to an end offset if given.
+    From(u64, Option<u64>),
+    /// The last bytes.
+    Suffix(u64),
+}
+
+impl ByteRange {
+    /// Parses a `Range` header with a single byte range.  Returns none for
+    /// anything else, in which case the header is ignored.
+    fn parse_header(header: &str) -> Option<ByteRange> {
+        let spec = header.trim().strip_prefix("bytes=")?;
+        let (first, last) = spec.split_once('-')?;
+        let (first, last) = (first.trim(), last.trim());
+        if first.is_empty() {
+            Some(ByteRange::Suffix(last.parse().ok()?))
+        } else {
+            let first = first.parse().ok()?;
+            let end = match last {
+                "" => None,
+                last => {
+                    let last: u64 = last.parse().ok()?;
+                    if last < first {
+                        return None;
+                    }
+                    Some(last + 1)
+                }
+            };
+            Some(ByteRange::From(first, end))
+        }
+    }
+
+    /// Resolves the range against output of `len` bytes, or returns none if
+    /// no bytes of it are in the output.
+    fn resolve(&self, len: u64) -> Option<(u64, u64)> {
+        let (start, end) = match *self {
+            ByteRange::From(start, end) => (start, end.map_or(len, |end| end.min(len))),
+            ByteRange::Suffix(num) => (len - num.min(len), len),
+        };
+        (start < end).then_some((start, end))
+    }
+}
+
+/// True if the `Accept-Encoding` header allows `encoding`.
+fn accepts_encoding(headers: &HeaderMap, encoding: &str) -> bool {
+    headers
+        .get_all(hyper::header::ACCEPT_ENCODING)
+        .iter()
+        .filter_map(|val| val.to_str().ok())
+        .flat_map(|val| val.split(','))
+        .any(|item| {
+            let mut parts = item.split(';').map(str::trim);
+            // A quality of zero means not acceptable.
+            parts.next() == Some(encoding)
+                && parts.all(|param| match param.split_once('=') {
+                    Some(("q", q)) => q.trim().parse::<f32>().map_or(true, |q| q > 0.0),
+                    _ => true,
+                })
+        })
+}
+
+fn make_output_response(
+    status: StatusCode,
+    headers: Vec<(hyper::header::HeaderName, String)>,
+    body: OutputBody,
+) -> Rsp {
+    let mut rsp = Response::builder()
+        .status(status)
+        .header(
+            hyper::header::CONTENT_TYPE,
+            HeaderValue::from_static("application/octet-stream"),
+        )
+        .header(hyper::header::ACCEPT_RANGES, HeaderValue::from_static("bytes"));
+    for (name, val) in headers {
+        rsp = rsp.header(name, val);
+    }
+    rsp.body(body.boxed()).unwrap()
+}
+
+/// Formats an event as a server-sent event.
+fn format_event(event: &Event) -> Bytes {
+    format!(
+        "id: {}\nevent: {}\ndata: {}\n\n",
+        event.seq,
+        event.kind.name(),
+        serde_json::to_string(event).unwrap()
+    )
+    .into()
+}
+
+/// Response body of server-sent events, forwarded by a task from an event
+/// subscription.
+struct EventBody {
+    receiver: mpsc::Receiver<Bytes>,
+}
+
+impl EventBody {
+    /// Body of `backlog` events, followed by events from `events`.
+    fn new(backlog: Vec<Arc<Event>>, mut events: broadcast::Receiver<Arc<Event>>) -> Self {
+        let (sender, receiver) = mpsc::channel(64);
+        tokio::spawn(async move {
+            // Start with a comment, so the client receives the response
+            // headers right away.
+            if sender.send(Bytes::from_static(b": procstar events\n\n")).await.is_err() {
+                return;
+            }
+            for event in backlog {
+                if sender.send(format_event(&event)).await.is_err() {
+                    return;
+                }
+            }
+            loop {
+                let data = tokio::select! {
+                    // The client disconnected.
+                    _ = sender.closed() => break,
+                    event = events.recv() => match event {
+                        Ok(event) => format_event(&event),
+                        Err(broadcast::error::RecvError::Lagged(num)) => {
+                            // The client fell behind.  Tell it how many events
+                            // it missed, and end the stream.
+                            _ = sender
+                                .send(format!("event: lagged\ndata: {{\"missed\":{}}}\n\n", num).into())
+                                .await;
+                            break;
+                        }
+                        Err(broadcast::error::RecvError::Closed) => break,
+                    },
+                };
+                if sender.send(data).await.is_err() {
+                    break;
+                }
+            }
+        });
+        Self { receiver }
+    }
+}
+
+impl Body for EventBody {
+    type Data = Bytes;
+    type Error = io::Error;
+
+    fn poll_frame(
+        mut self: Pin<&mut Self>,
+        cx: &mut Context<'_>,
+    ) -> Poll<Option<Result<Frame<Bytes>, io::Error>>> {
+        self.receiver
+            .poll_recv(cx)
+            .map(|data| data.map(|data| Ok(Frame::data(data))))
+    }
+}
+
+//------------------------------------------------------------------------------
+
+/// Handles `GET /metrics`.
+async fn metrics_get(procs: SharedRunningProcs) -> RspResult {
+    let (plans, hits, misses) = procs.plans.stats();
+    Ok(json!({
+        "metrics": {
+            "procs": procs.len(),
+            "signal_watchers": num_watchers(),
+            "plan_cache": {
+                "plans": plans,
+                "hits": hits,
+                "misses": misses,
+            },
+            "queue": procs.queue.to_jso(),
+            "event_subscribers": procs.events.num_subscribers(),
+        },
+    }))
+}
+
+/// Handles `POST /env/refresh`.
+async fn env_refresh_post(procs: SharedRunningProcs) -> RspResult {
+    procs.plans.refresh_env();
+    Ok(json!({
+        "env": {
+            "vars": procs.plans.env_len(),
+        },
+    }))
+}
+
+/// Returns the proc filter given by query params `state`, `exit_code` or
+/// `exit_code!`, and `labels`.
+fn get_proc_filter(query: &BTreeMap<String, String>) -> Result<ProcFilter, RspError> {
+    let state = match query.get("state").map(String::as_str) {
+        None => None,
+        Some("queued") => Some(ProcState::Queued),
+        Some("running") => Some(ProcState::Running),
+        Some("exited") => Some(ProcState::Exited),
+        Some(state) => return Err(RspError::bad_request(&format!("invalid state: {}", state))),
+    };
+
+    // `exit_code!=0` arrives as param `exit_code!` with value `0`.
+    let get_exit_code = |name: &str| {
+        query
+            .get(name)
+            .map(|val| {
+                val.parse::<i32>()
+                    .map_err(|_| RspError::bad_request(&format!("invalid exit_code: {}", val)))
+            })
+            .transpose()
+    };
+    let exit_code = match (get_exit_code("exit_code")?, get_exit_code("exit_code!")?) {
+        (None, None) => None,
+        (Some(code), None) => Some((true, code)),
+        (None, Some(code)) => Some((false, code)),
+        (Some(_), Some(_)) => return Err(RspError::bad_request("exit_code with exit_code!")),
+    };
+
+    let labels = query
+        .get("labels")
+        .map(|val| {
+            val.split(',')
+                .map(|selector| {
+                    LabelSelector::parse(selector).ok_or_else(|| {
+                        RspError::bad_request(&format!("invalid label selector: {}", selector))
+                    })
+                })
+                .collect::<Result<Vec<_>, _>>()
+        })
+        .transpose()?
+        .unwrap_or_default();
+
+    Ok(ProcFilter {
+        state,
+        exit_code,
+        labels,
+    })
+}
+
 /// Handles `GET /procs`.
-async fn procs_get(procs: SharedRunningProcs) -> RspResult {
+async fn procs_get(procs: SharedRunningProcs, parts: &http::request::Parts) -> RspResult {
+    let query = get_query(parts);
+    let res_query = ResQuery::new(&query)?;
+    let filter = get_proc_filter(&query)?;
+    let after = query.get("after").map(String::as_str);
+    let limit = get_query_u64(&query, "limit")?.map(|limit| limit as usize);
+    if limit == Some(0) {
+        return Err(RspError::bad_request("invalid limit: 0"));
+    }
+
+    let (selected, more) = procs.select(&filter, after, limit);
+    // The cursor for the next page, if any.
+    let next = if more {
+        selected.last().map(|(proc_id, _)| proc_id.clone())
+    } else {
+        None
+    };
+    let results = selected
+        .into_iter()
+        .map(|(proc_id, proc)| {
+            let result = proc.lock().unwrap().to_result(res_query.fds);
+            (proc_id, res_query.project(result))
+        })
+        .collect::<serde_json::Map<_, _>>();
     Ok(json!({
-        "procs": procs.to_result(),
+        "procs": results,
+        "next": next,
     }))
 }
 
 /// Handles `GET /procs/:id`.
-async fn procs_id_get(procs: SharedRunningProcs, proc_id: &str) -> RspResult {
+async fn procs_id_get(
+    procs: SharedRunningProcs,
+    proc_id: &str,
+    parts: &http::request::Parts,
+) -> RspResult {
+    let res_query = ResQuery::new(&get_query(parts))?;
     if let Some(proc) = procs.get(proc_id) {
+        let result = proc.lock().unwrap().to_result(res_query.fds);
         Ok(json!({
             "procs": {
-                proc_id: proc.borrow().to_result(),
+                proc_id: res_query.project(result),
             }
         }))
     } else {
@@ -100,19 +563,257 @@ async fn procs_id_delete(procs: SharedRunningProcs, proc_id: &str) -> RspResult
 }
 
 /// Handles `POST /procs`.
-async fn procs_post(procs: SharedRunningProcs, input: Input) -> RspResult {
+async fn procs_post(procs: SharedRunningProcs, input: Input) -> Result<Rsp, RspError> {
     // FIXME: Check duplicate proc IDs.
-    start_procs(input, procs.clone()).await;
+    procs.queue.submit(input, &procs).map_err(|err| {
+        let status = match err {
+            // Retrying won't help.
+            SubmitError::TooMany { .. } => StatusCode::PAYLOAD_TOO_LARGE,
+            SubmitError::Full { .. } => StatusCode::TOO_MANY_REQUESTS,
+        };
+        RspError(status, Some(err.to_string()))
+    })?;
+    // Respond once the procs are queued, without waiting for them to start,
+    // which may be a long time under `max_running`.
+    Ok(make_json_response(
+        StatusCode::ACCEPTED,
+        json!({
+            "data": {
+                // FIXME
+            },
+        }),
+    ))
+}
+
+/// Handles `GET /procs/:id/fds/:fd`.
+async fn procs_id_fds_fd_get(
+    procs: SharedRunningProcs,
+    proc_id: &str,
+    fd: &str,
+    parts: &http::request::Parts,
+) -> Result<Rsp, RspError> {
+    let proc = procs.get(proc_id).ok_or_else(|| RspError(StatusCode::NOT_FOUND, None))?;
+    let fd_num = parse_fd(fd).map_err(|_| RspError::bad_request("invalid fd"))?;
+    let fd_handler = proc
+        .lock()
+        .unwrap()
+        .fd_handlers
+        .iter()
+        .find(|(n, _)| *n == fd_num)
+        .map(|(_, fd_handler)| fd_handler.clone())
+        .ok_or_else(|| RspError(StatusCode::NOT_FOUND, Some("no such fd".to_string())))?;
+    if fd_handler.output_len().map_err(RspError::internal)?.is_none() {
+        return Err(RspError(StatusCode::NOT_FOUND, Some("fd not captured".to_string())));
+    }
+
+    let query = get_query(parts);
+    let offset = get_query_u64(&query, "offset")?;
+    let length = get_query_u64(&query, "length")?;
+    let after = get_query_u64(&query, "after")?;
+    let wait = get_query_secs(&query, "wait")?;
+
+    if let Some(after) = after {
+        if offset.is_some() {
+            return Err(RspError::bad_request("offset with after"));
+        }
+        // Wait for output past `after`.
+        let deadline = Instant::now() + wait.unwrap_or_default();
+        fd_handler.wait_output(after, deadline).await.map_err(RspError::internal)?;
+    } else if wait.is_some() {
+        return Err(RspError::bad_request("wait without after"));
+    }
+
+    // Check for EOF before getting the length, so that if at EOF, the length
+    // is final.
+    let eof = fd_handler.is_eof();
+    let (len, truncated) = fd_handler
+        .output_len()
+        .map_err(RspError::internal)?
+        .ok_or_else(|| RspError(StatusCode::NOT_FOUND, Some("fd not captured".to_string())))?;
+    let mut headers = vec![(
+        hyper::header::HeaderName::from_static("procstar-eof"),
+        eof.to_string(),
+    )];
+
+    // The range may be given as query params or as a `Range` header.
+    let range = if offset.is_some() || after.is_some() || length.is_some() {
+        let offset = offset.or(after).unwrap_or(0);
+        Some(ByteRange::From(offset, length.map(|length| offset.saturating_add(length))))
+    } else {
+        parts
+            .headers
+            .get(hyper::header::RANGE)
+            .and_then(|val| val.to_str().ok())
+            .and_then(ByteRange::parse_header)
+    };
+
+    match range {
+        Some(range) => {
+            // Only output that was kept can be sent, so the range may be
+            // shortened.
+            match range
+                .resolve(len)
+                .map(|(start, end)| capture::clip_range(start, end, truncated))
+                .filter(|(start, end)| start < end)
+            {
+                Some((start, end)) => {
+                    headers.push((
+                        hyper::header::CONTENT_RANGE,
+                        format!("bytes {}-{}/{}", start, end - 1, len),
+                    ));
+                    Ok(make_output_response(
+                        StatusCode::PARTIAL_CONTENT,
+                        headers,
+                        OutputBody::new(fd_handler, vec![(start, end)]),
+                    ))
+                }
+
+                // No output yet past `after`.
+                None if after.is_some() => Ok(make_output_response(
+                    StatusCode::NO_CONTENT,
+                    headers,
+                    OutputBody::from_chunks(Chunks::default()),
+                )),
+
+                None => Err(RspError(StatusCode::RANGE_NOT_SATISFIABLE, None)),
+            }
+        }
+
+        None => {
+            if accepts_encoding(&parts.headers, "gzip") {
+                // Send compressed output as is.
+                if let Some(data) = fd_handler.gzipped_output().map_err(RspError::internal)? {
+                    headers.push((hyper::header::CONTENT_ENCODING, "gzip".to_string()));
+                    return Ok(make_output_response(
+                        StatusCode::OK,
+                        headers,
+                        OutputBody::from_chunks(data),
+                    ));
+                }
+            }
+            // All output that was kept.
+            let ranges = match truncated {
+                Some(capture::Truncation { start, length }) => {
+                    headers.push((
+                        hyper::header::HeaderName::from_static("procstar-truncated"),
+                        format!("bytes {}-{}/{}", start, start + length - 1, len),
+                    ));
+                    vec![(0, start), (start + length, len)]
+                }
+                None => vec![(0, len)],
+            };
+            Ok(make_output_response(
+                StatusCode::OK,
+                headers,
+                OutputBody::new(fd_handler, ranges),
+            ))
+        }
+    }
+}
+
+/// Waits for procs, and returns their statuses.
+async fn wait_procs(
+    procs: SharedRunningProcs,
+    proc_ids: Vec<ProcId>,
+    parts: &http::request::Parts,
+) -> RspResult {
+    let query = get_query(parts);
+    let timeout = get_query_secs(&query, "timeout")?.unwrap_or(Duration::from_secs_f64(MAX_WAIT));
+    let all = match query.get("mode").map(String::as_str) {
+        None | Some("all") => true,
+        Some("any") => false,
+        Some(mode) => return Err(RspError::bad_request(&format!("invalid mode: {}", mode))),
+    };
+
+    let complete = procs
+        .wait_procs(&proc_ids, all, Instant::now() + timeout)
+        .await
+        .map_err(|err| RspError(StatusCode::NOT_FOUND, Some(err.to_string())))?;
+
+    let statuses = proc_ids
+        .into_iter()
+        .filter_map(|proc_id| {
+            // The proc may have been deleted meanwhile.
+            let proc = procs.get(&proc_id)?;
+            let (status, rusage) = proc.lock().unwrap().to_status();
+            Some((proc_id, json!({"status": status, "rusage": rusage})))
+        })
+        .collect::<serde_json::Map<_, _>>();
     Ok(json!({
-        // FIXME
+        "procs": statuses,
+        "complete": complete,
     }))
 }
 
+/// Handles `POST /procs/:id/wait`.
+async fn procs_id_wait_post(
+    procs: SharedRunningProcs,
+    proc_id: &str,
+    parts: &http::request::Parts,
+) -> RspResult {
+    wait_procs(procs, vec![proc_id.to_string()], parts).await
+}
+
+/// Body of `POST /wait`.
+#[derive(serde::Deserialize)]
+#[serde(deny_unknown_fields)]
+struct WaitBody {
+    procs: Vec<ProcId>,
+}
+
+/// Handles `POST /wait`.
+async fn wait_post(
+    procs: SharedRunningProcs,
+    body: WaitBody,
+    parts: &http::request::Parts,
+) -> RspResult {
+    if body.procs.is_empty() {
+        return Err(RspError::bad_request("no procs"));
+    }
+    wait_procs(procs, body.procs, parts).await
+}
+
+/// Handles `GET /events`.
+async fn events_get(procs: SharedRunningProcs, parts: &http::request::Parts) -> Result<Rsp, RspError> {
+    // Resume after the `since` sequence number, or the last event an SSE client
+    // received before reconnecting.
+    let since = match get_query_u64(&get_query(parts), "since")? {
+        Some(since) => Some(since),
+        None => parts
+            .headers
+            .get("last-event-id")
+            .map(|val| {
+                val.to_str()
+                    .ok()
+                    .and_then(|val| val.parse::<u64>().ok())
+                    .ok_or_else(|| RspError::bad_request("invalid Last-Event-ID"))
+            })
+            .transpose()?,
+    };
+    let (backlog, events) = match since {
+        Some(since) => procs
+            .events
+            .subscribe_since(since)
+            .map_err(|err| RspError(StatusCode::GONE, Some(err.to_string())))?,
+        None => (Vec::new(), procs.events.subscribe()),
+    };
+
+    Ok(Response::builder()
+        .status(StatusCode::OK)
+        .header(
+            hyper::header::CONTENT_TYPE,
+            HeaderValue::from_static("text/event-stream"),
+        )
+        .header(hyper::header::CACHE_CONTROL, HeaderValue::from_static("no-cache"))
+        .body(EventBody::new(backlog, events).boxed())
+        .unwrap())
+}
+
 /// Handles POST /procs/:id/signal/:signum.
 async fn procs_signal_signum_post(procs: SharedRunningProcs, proc_id: &str, signum: &str) -> RspResult {
     let signum = parse_signum(signum).ok_or_else(|| RspError::bad_request("unknwon signum"))?;
     let proc = procs.get(proc_id).ok_or_else(|| RspError(StatusCode::NOT_FOUND, None))?;
-    proc.borrow().send_signal(signum).map_err(|e| RspError::bad_request(&e.to_string()))?;
+    proc.lock().unwrap().send_signal(signum).map_err(|e| RspError::bad_request(&e.to_string()))?;
     Ok(json!({
         // FIXME
     }))
@@ -131,13 +832,19 @@ impl Router {
         router.insert("/procs", 0).unwrap();
         router.insert("/procs/:id", 1).unwrap();
         router.insert("/procs/:id/signals/:signum", 2).unwrap();
+        router.insert("/metrics", 3).unwrap();
+        router.insert("/env/refresh", 4).unwrap();
+        router.insert("/procs/:id/fds/:fd", 5).unwrap();
+        router.insert("/events", 6).unwrap();
+        router.insert("/procs/:id/wait", 7).unwrap();
+        router.insert("/wait", 8).unwrap();
         Router { router }
     }
 
-    async fn get_body_json(
+    async fn get_body_json<T: serde::de::DeserializeOwned>(
         parts: &http::request::Parts,
         body: Incoming,
-    ) -> Result<Input, RspError> {
+    ) -> Result<T, RspError> {
         let bytes = body
             .collect()
             .await
@@ -151,12 +858,12 @@ impl Router {
         } else if bytes.len() == 0 {
             Err(RspError::bad_request("no body"))
         } else {
-            Ok(serde_json::from_slice::<Input>(&bytes)
+            Ok(serde_json::from_slice::<T>(&bytes)
                 .map_err(|err| RspError::bad_request(&format!("parsing body: {}", err)))?)
         }
     }
 
-    async fn dispatch(&self, req: Req, procs: SharedRunningProcs) -> RspResult {
+    async fn dispatch(&self, req: Req, procs: SharedRunningProcs) -> Result<Rsp, RspError> {
         let (parts, body) = req.into_parts();
         let rsp = match self.router.at(parts.uri.path()) {
             Ok(m) => {
@@ -164,16 +871,35 @@ impl Router {
                 match (m.value, parts.method.clone()) {
                     // Match route numbers obtained from the matchit
                     // router, and methods.
-                    (0, Method::GET) => procs_get(procs).await?,
+                    (0, Method::GET) => procs_get(procs, &parts).await?,
                     (0, Method::POST) => {
                         let body = Router::get_body_json(&parts, body).await?;
-                        procs_post(procs, body).await?
+                        return procs_post(procs, body).await;
                     }
-                    (1, Method::GET) => procs_id_get(procs, param("id")).await?,
+                    (1, Method::GET) => procs_id_get(procs, param("id"), &parts).await?,
                     (1, Method::DELETE) => procs_id_delete(procs, param("id")).await?,
 
                     (2, Method::POST) => procs_signal_signum_post(procs, param("id"), param("signum")).await?,
 
+                    (3, Method::GET) => metrics_get(procs).await?,
+
+                    (4, Method::POST) => env_refresh_post(procs).await?,
+
+                    // Responds with raw output, not JSON.
+                    (5, Method::GET) => {
+                        return procs_id_fds_fd_get(procs, param("id"), param("fd"), &parts).await
+                    }
+
+                    // Responds with a stream of events.
+                    (6, Method::GET) => return events_get(procs, &parts).await,
+
+                    (7, Method::POST) => procs_id_wait_post(procs, param("id"), &parts).await?,
+
+                    (8, Method::POST) => {
+                        let body = Router::get_body_json(&parts, body).await?;
+                        wait_post(procs, body, &parts).await?
+                    }
+
                     // Route number (i.e. path match) but no method match.
                     (_, _) => {
                         return Err(RspError(StatusCode::METHOD_NOT_ALLOWED, None));
@@ -187,7 +913,7 @@ impl Router {
             }
         };
 
-        Ok(rsp)
+        Ok(make_response(Ok(rsp)))
     }
 }
 
@@ -203,7 +929,7 @@ pub async fn run_http(procs: SharedRunningProcs) -> Result<(), Box<dyn std::erro
     // We match the URI path to (internal) route numbers, and dispatch below on
     // these.  It's a bit cumbersome to maintain, but quite efficient, and gives
     // us lots of flexibility in structuring the route handlers.
-    let router = Rc::new(Router::new());
+    let router = Arc::new(Router::new());
 
     loop {
         let (stream, _) = listener.accept().await?;
@@ -216,11 +942,11 @@ pub async fn run_http(procs: SharedRunningProcs) -> Result<(), Box<dyn std::erro
             async move {
                 let rsp = router.dispatch(req, procs).await;
                 // FIXME: https://jsonapi.org/format
-                Ok::<Rsp, hyper::Error>(make_response(rsp))
+                Ok::<Rsp, hyper::Error>(rsp.unwrap_or_else(|err| make_response(Err(err))))
             }
         });
 
-        tokio::task::spawn_local(async move {
+        tokio::spawn(async move {
             if let Err(err) = hyper::server::conn::http1::Builder::new()
                 .serve_connection(stream, service)
                 .await
@@ -230,3 +956,46 @@ pub async fn run_http(procs: SharedRunningProcs) -> Result<(), Box<dyn std::erro
         });
     }
 }
+
+//------------------------------------------------------------------------------
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn parse_range_header() {
+        use ByteRange::*;
+        assert_eq!(ByteRange::parse_header("bytes=0-99"), Some(From(0, Some(100))));
+        assert_eq!(ByteRange::parse_header("bytes=100-"), Some(From(100, None)));
+        assert_eq!(ByteRange::parse_header("bytes=-500"), Some(Suffix(500)));
+        assert_eq!(ByteRange::parse_header("bytes=10-5"), None);
+        assert_eq!(ByteRange::parse_header("bytes=0-9,20-29"), None);
+        assert_eq!(ByteRange::parse_header("lines=0-9"), None);
+    }
+
+    #[test]
+    fn resolve_range() {
+        use ByteRange::*;
+        assert_eq!(From(0, Some(100)).resolve(50), Some((0, 50)));
+        assert_eq!(From(10, None).resolve(50), Some((10, 50)));
+        assert_eq!(From(50, None).resolve(50), None);
+        assert_eq!(Suffix(20).resolve(50), Some((30, 50)));
+        assert_eq!(Suffix(100).resolve(50), Some((0, 50)));
+        assert_eq!(Suffix(0).resolve(50), None);
+    }
+
+    #[test]
+    fn accept_encoding() {
+        let headers = |val| {
+            let mut headers = HeaderMap::new();
+            headers.insert(hyper::header::ACCEPT_ENCODING, HeaderValue::from_static(val));
+            headers
+        };
+        assert!(accepts_encoding(&headers("gzip"), "gzip"));
+        assert!(accepts_encoding(&headers("br, gzip;q=0.5"), "gzip"));
+        assert!(!accepts_encoding(&headers("gzip;q=0"), "gzip"));
+        assert!(!accepts_encoding(&headers("identity"), "gzip"));
+        assert!(!accepts_encoding(&HeaderMap::new(), "gzip"));
+    }
+}
@@ -0,0 +1,213 @@
+use std::collections::HashMap;
+use std::ffi::CString;
+use std::io;
+use std::os::fd::RawFd;
+use std::sync::{Arc, Mutex};
+
+use crate::environ;
+use crate::err_pipe::ErrorWriter;
+use crate::fd;
+use crate::fd::FdOp;
+use crate::spec;
+use crate::sys::{errno, CStringVec};
+
+//------------------------------------------------------------------------------
+
+/// The part of a launch plan that depends only on the proc's argv and env
+/// spec, and so may be shared by launches of the same spec.
+pub struct ExecPlan {
+    /// The executable path.
+    pub(crate) exe: CString,
+    /// NULL-terminated argv array.
+    pub(crate) argv: CStringVec,
+    /// NULL-terminated envp array of `NAME=val` strings.
+    pub(crate) envp: CStringVec,
+    /// Prefix for the error message if exec fails.
+    pub(crate) exec_error: Vec<u8>,
+}
+
+impl ExecPlan {
+    pub fn new(argv: &[String], env: &environ::Env) -> io::Result<Self> {
+        let exe = argv
+            .first()
+            .ok_or_else(|| io::Error::new(io::ErrorKind::InvalidInput, "empty argv"))?;
+        Ok(Self {
+            exe: CString::new(exe.as_str())?,
+            argv: CStringVec::new(argv.iter().cloned())?,
+            envp: CStringVec::from_shared(env.values().cloned()),
+            exec_error: format!("exec: {}: ", exe).into_bytes(),
+        })
+    }
+}
+
+/// Everything needed to start a proc, compiled in the parent before forking.
+/// In the child, carrying out the plan involves only syscalls, and no
+/// allocation.
+pub struct LaunchPlan {
+    pub exec: Arc<ExecPlan>,
+    /// Fd operations to perform in the child before exec, in order.
+    pub fd_ops: Vec<FdOp>,
+    /// Prefix for the error message if each fd op fails.
+    pub(crate) fd_op_errors: Vec<Vec<u8>>,
+}
+
+impl LaunchPlan {
+    pub fn new(exec: Arc<ExecPlan>, fd_ops: Vec<(RawFd, FdOp)>) -> Self {
+        let fd_op_errors = fd_ops
+            .iter()
+            .map(|(fd, _)| format!("failed to set up fd {}: ", fd).into_bytes())
+            .collect();
+        let fd_ops = fd_ops.into_iter().map(|(_, fd_op)| fd_op).collect();
+        Self {
+            exec,
+            fd_ops,
+            fd_op_errors,
+        }
+    }
+
+    /// Adds ops to mark close-on-exec all fds other than 0-2 and `keep`, so
+    /// that the program doesn't inherit them.
+    pub fn close_others(&mut self, keep: &[RawFd]) {
+        for fd_op in fd::cloexec_others(keep) {
+            self.fd_ops.push(fd_op);
+            self.fd_op_errors.push(b"failed to close fds: ".to_vec());
+        }
+    }
+
+    /// In the child process after `fork()`, performs the fd ops and execs the
+    /// program.  Reports failures to the parent through `error_writer`.
+    pub fn exec_child(&self, error_writer: ErrorWriter) -> ! {
+        // True if we should finally exec.
+        let mut ok_to_exec = true;
+
+        for (fd_op, error) in self.fd_ops.iter().zip(self.fd_op_errors.iter()) {
+            if let Err(errno) = fd_op.apply() {
+                error_writer.try_write_errno(error, errno);
+                ok_to_exec = false;
+            }
+        }
+
+        if ok_to_exec {
+            // execve() only returns with an error; on success, the program is
+            // replaced.
+            unsafe {
+                libc::execve(
+                    self.exec.exe.as_ptr(),
+                    self.exec.argv.as_ptr(),
+                    self.exec.envp.as_ptr(),
+                )
+            };
+            error_writer.try_write_errno(&self.exec.exec_error, errno());
+        }
+
+        // Don't run exit handlers, which belong to the parent.
+        unsafe { libc::_exit(exitcode::OSERR) }
+    }
+}
+
+//------------------------------------------------------------------------------
+
+/// Max number of exec plans to cache.
+const PLAN_CACHE_SIZE: usize = 1024;
+
+#[derive(PartialEq, Eq, Hash)]
+struct ExecKey {
+    argv: Vec<String>,
+    env: spec::Env,
+}
+
+/// Cache of exec plans, keyed by proc argv and env spec.  Plans are built
+/// from a snapshot of this process's environment.
+#[derive(Clone, Default)]
+pub struct PlanCache(Arc<Mutex<PlanCacheInner>>);
+
+#[derive(Default)]
+struct PlanCacheInner {
+    env: environ::Snapshot,
+    plans: HashMap<ExecKey, Arc<ExecPlan>>,
+    hits: u64,
+    misses: u64,
+}
+
+impl PlanCache {
+    pub fn new() -> Self {
+        Self::with_env(environ::Snapshot::new())
+    }
+
+    pub fn with_env(env: environ::Snapshot) -> Self {
+        PlanCache(Arc::new(Mutex::new(PlanCacheInner {
+            env,
+            ..Default::default()
+        })))
+    }
+
+    /// Takes a new snapshot of this process's environment, for subsequent
+    /// procs.  Since plans include the environment, drops all cached plans.
+    pub fn refresh_env(&self) {
+        let mut inner = self.0.lock().unwrap();
+        inner.env = environ::Snapshot::new();
+        inner.plans.clear();
+    }
+
+    /// Returns the exec plan for `argv` and `env`, compiling it if it isn't
+    /// cached.
+    pub fn get(&self, argv: Vec<String>, env: spec::Env) -> io::Result<Arc<ExecPlan>> {
+        let key = ExecKey { argv, env };
+        let mut inner = self.0.lock().unwrap();
+        if let Some(plan) = inner.plans.get(&key) {
+            let plan = Arc::clone(plan);
+            inner.hits += 1;
+            return Ok(plan);
+        }
+
+        inner.misses += 1;
+        let env = environ::build(&inner.env, &key.env)?;
+        let plan = Arc::new(ExecPlan::new(&key.argv, &env)?);
+        if inner.plans.len() >= PLAN_CACHE_SIZE {
+            // Crude, but repeated specs will be cached again soon enough.
+            inner.plans.clear();
+        }
+        inner.plans.insert(key, Arc::clone(&plan));
+        Ok(plan)
+    }
+
+    /// Returns the number of cached plans, cache hits, and cache misses.
+    pub fn stats(&self) -> (usize, u64, u64) {
+        let inner = self.0.lock().unwrap();
+        (inner.plans.len(), inner.hits, inner.misses)
+    }
+
+    /// Returns the number of vars in the environment snapshot.
+    pub fn env_len(&self) -> usize {
+        self.0.lock().unwrap().env.len()
+    }
+}
+
+//------------------------------------------------------------------------------
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn argv(args: &[&str]) -> Vec<String> {
+        args.iter().map(|a| a.to_string()).collect()
+    }
+
+    #[test]
+    fn cache_hit() {
+        let cache = PlanCache::new();
+        let plan0 = cache.get(argv(&["/bin/echo", "hello"]), Default::default()).unwrap();
+        let plan1 = cache.get(argv(&["/bin/echo", "hello"]), Default::default()).unwrap();
+        let plan2 = cache.get(argv(&["/bin/echo", "world"]), Default::default()).unwrap();
+        assert!(Arc::ptr_eq(&plan0, &plan1));
+        assert!(!Arc::ptr_eq(&plan0, &plan2));
+        assert_eq!(cache.stats(), (2, 1, 2));
+    }
+
+    #[test]
+    fn bad_argv() {
+        let cache = PlanCache::new();
+        assert!(cache.get(vec![], Default::default()).is_err());
+        assert!(cache.get(argv(&["/bin/echo", "a\0b"]), Default::default()).is_err());
+    }
+}
@@ -1,11 +1,18 @@
+pub mod capture;
 pub mod environ;
 pub mod err;
 pub mod err_pipe;
+pub mod events;
 pub mod fd;
 pub mod fdio;
 pub mod http;
+pub mod launch;
 pub mod procs;
+pub mod queue;
+pub mod reaper;
 pub mod res;
 pub mod sig;
+pub mod spawn;
 pub mod spec;
 pub mod sys;
+pub mod zygote;
@@ -1,20 +1,90 @@
 extern crate exitcode;
 
+use std::os::fd::OwnedFd;
+
 mod argv;
 
 // use procstar::fd::parse_fd;
+use procstar::capture;
 use procstar::http::run_http;
-use procstar::procs::{collect_results, start_procs, SharedRunningProcs};
+use procstar::procs::{collect_results, start_procs, Config, SharedRunningProcs};
+use procstar::queue::Limits;
+use procstar::reaper::Tracking;
+use procstar::spawn::SpawnMode;
 use procstar::res;
 use procstar::spec;
+use procstar::zygote::fork_zygote;
 
 //------------------------------------------------------------------------------
 
-#[tokio::main(flavor = "current_thread")]
-async fn main() {
+fn main() {
     let args = argv::parse();
 
-    let running_procs = SharedRunningProcs::new();
+    // Fork the zygote first, while this process is small and has no threads.
+    let zygote = if args.spawn == "zygote" {
+        Some(fork_zygote().unwrap_or_else(|err| {
+            eprintln!("failed to start zygote: {}", err);
+            std::process::exit(exitcode::OSERR);
+        }))
+    } else {
+        None
+    };
+
+    let mut builder = if args.threads > 1 {
+        let mut builder = tokio::runtime::Builder::new_multi_thread();
+        builder.worker_threads(args.threads);
+        builder
+    } else {
+        tokio::runtime::Builder::new_current_thread()
+    };
+    let runtime = builder.enable_all().build().unwrap_or_else(|err| {
+        eprintln!("failed to start runtime: {}", err);
+        std::process::exit(exitcode::OSERR);
+    });
+    runtime.block_on(run(args, zygote));
+}
+
+async fn run(args: argv::Args, zygote: Option<OwnedFd>) {
+    let tracking = if args.pidfd {
+        Tracking::Pidfd
+    } else {
+        Tracking::Sigchld
+    };
+    tracking.check().unwrap_or_else(|err| {
+        eprintln!("process tracking {:?} not available: {}", tracking, err);
+        std::process::exit(exitcode::OSERR);
+    });
+
+    let spawn = match args.spawn.as_str() {
+        "fork" => SpawnMode::Fork,
+        "zygote" => SpawnMode::Zygote,
+        _ => SpawnMode::PosixSpawn,
+    };
+
+    let close_fds = args.close_fds.unwrap_or(args.serve);
+
+    let running_procs = SharedRunningProcs::new(Config {
+        tracking,
+        spawn,
+        close_fds,
+        limits: Limits {
+            max_running: args.max_running,
+            max_rate: args.max_rate,
+            max_depth: args.max_queue,
+        },
+        capture: capture::Config {
+            tmpdir: args.tmpdir.clone(),
+            pipe_size: args.pipe_size,
+        },
+        event_log_size: args.event_log_size,
+    });
+    let running_procs = match zygote {
+        Some(sock) => running_procs.with_zygote(sock).unwrap_or_else(|err| {
+            eprintln!("failed to connect to zygote: {}", err);
+            std::process::exit(exitcode::OSERR);
+        }),
+        None => running_procs,
+    };
     let input = if let Some(p) = args.input {
         spec::load_file(&p).unwrap_or_else(|err| {
             eprintln!("failed to load {}: {}", p, err);
@@ -24,46 +94,36 @@ async fn main() {
         spec::Input::new()
     };
 
-    let local = tokio::task::LocalSet::new();
     if args.serve {
-        // Service mode.
-        local
-            .run_until(async move {
-                // Start specs from the command line.  Discard the tasks.  We
-                // intentionally don't start the HTTP service until the input
-                // processes have started, to avoid races where these procs
-                // don't appear in HTTP results.
-                start_procs(input, running_procs.clone()).await;
-                // Run the HTTP service.
-                run_http(running_procs).await.unwrap()
-            })
-            .await;
+        // Service mode.  Start specs from the command line.  Discard the tasks.
+        // We intentionally don't start the HTTP service until the input
+        // processes have started, to avoid races where these procs don't appear
+        // in HTTP results.
+        start_procs(input, running_procs.clone()).await;
+        // Run the HTTP service.
+        run_http(running_procs).await.unwrap()
     } else {
-        local
-            .run_until(async move {
-                // Start specs from the command line.
-                let tasks = start_procs(input, running_procs.clone()).await;
-                // Wait for tasks to complete.
-                for task in tasks {
-                    _ = task.await.unwrap(); // FIXME: unwrap
-                }
-                // Collect results.
-                let result = collect_results(running_procs).await;
-                // Print them.
-                if let Some(path) = args.output {
-                    res::dump_file(&result, &path).unwrap_or_else(|err| {
-                        eprintln!("failed to write output {}: {}", path, err);
-                        std::process::exit(exitcode::OSFILE);
-                    });
-                } else {
-                    res::print(&result).unwrap_or_else(|err| {
-                        eprintln!("failed to print output: {}", err);
-                        std::process::exit(exitcode::OSFILE);
-                    });
-                    println!("");
-                }
-            })
-            .await;
+        // Start specs from the command line.
+        let tasks = start_procs(input, running_procs.clone()).await;
+        // Wait for tasks to complete.
+        for task in tasks {
+            _ = task.await.unwrap(); // FIXME: unwrap
+        }
+        // Collect results.
+        let result = collect_results(running_procs).await;
+        // Print them.
+        if let Some(path) = args.output {
+            res::dump_file(&result, &path).unwrap_or_else(|err| {
+                eprintln!("failed to write output {}: {}", path, err);
+                std::process::exit(exitcode::OSFILE);
+            });
+        } else {
+            res::print(&result).unwrap_or_else(|err| {
+                eprintln!("failed to print output: {}", err);
+                std::process::exit(exitcode::OSFILE);
+            });
+            println!("");
+        }
         let ok = true; // FIXME: Determine if something went wrong.
         std::process::exit(if ok { exitcode::OK } else { 1 });
     }
@@ -1,17 +1,25 @@
 use libc::pid_t;
-use std::cell::RefCell;
-use std::collections::BTreeMap;
-use std::os::fd::RawFd;
-use std::rc::Rc;
-
-use crate::environ;
+use std::collections::{BTreeMap, BTreeSet};
+use std::ops::Bound;
+use std::os::fd::{AsRawFd, OwnedFd, RawFd};
+use std::sync::{Arc, Mutex, RwLock};
+use tokio::sync::{broadcast, oneshot};
+use tokio::time::Instant;
+
+use crate::capture;
 use crate::err_pipe::ErrorPipe;
+use crate::events::{EventKind, Events};
 use crate::fd;
 use crate::fd::SharedFdHandler;
+use crate::launch::{LaunchPlan, PlanCache};
+use crate::queue::{Limits, SpawnQueue};
+use crate::reaper::{Reaper, Tracking};
 use crate::res;
-use crate::sig::{SignalReceiver, SignalWatcher, Signum};
+use crate::sig::Signum;
+use crate::spawn::{posix_spawn, SpawnMode};
 use crate::spec::{Input, ProcId};
-use crate::sys::{execve, fork, wait, kill, WaitInfo};
+use crate::sys::{cloexec_range, fork, kill, pidfd_send_signal, WaitInfo};
+use crate::zygote::Zygote;
 
 //------------------------------------------------------------------------------
 
@@ -46,58 +54,137 @@ type FdHandlers = Vec<(RawFd, SharedFdHandler)>;
 
 pub struct RunningProc {
     pub pid: pid_t,
+    /// Pidfd referring to the process, if it is tracked by pidfd.
+    pub pidfd: Option<OwnedFd>,
     pub errors: Vec<String>,
     pub wait_info: Option<WaitInfo>,
     pub fd_handlers: FdHandlers,
+    pub labels: BTreeMap<String, String>,
+    /// True for a placeholder of a proc waiting in the spawn queue.
+    pub queued: bool,
+}
+
+/// Where a proc is in its lifecycle.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum ProcState {
+    /// Waiting in the spawn queue.
+    Queued,
+    /// Started but not yet terminated.
+    Running,
+    /// Terminated, or failed to start.
+    Exited,
 }
 
 impl RunningProc {
-    pub fn new(pid: pid_t, fd_handlers: FdHandlers) -> Self {
+    pub fn new(
+        pid: pid_t,
+        pidfd: Option<OwnedFd>,
+        fd_handlers: FdHandlers,
+        labels: BTreeMap<String, String>,
+    ) -> Self {
         Self {
             pid,
+            pidfd,
             errors: Vec::new(),
             wait_info: None,
             fd_handlers,
+            labels,
+            queued: false,
+        }
+    }
+
+    /// Returns a placeholder for a proc waiting in the spawn queue.  It is
+    /// replaced in the proc table once the proc is started.
+    pub fn queued(labels: BTreeMap<String, String>) -> Self {
+        Self {
+            queued: true,
+            ..Self::new(0, None, Vec::new(), labels)
+        }
+    }
+
+    pub fn state(&self) -> ProcState {
+        if self.queued {
+            ProcState::Queued
+        } else if self.wait_info.is_some() {
+            ProcState::Exited
+        } else {
+            ProcState::Running
         }
     }
 
     pub fn send_signal(&self, signum: Signum) -> Result<(), Error> {
-        Ok(kill(self.pid, signum)?)
+        if self.pid == 0 {
+            // The proc never started.  Don't signal our own process group.
+            Err(Error::Io(std::io::Error::from_raw_os_error(libc::ESRCH)))
+        } else if let Some(ref pidfd) = self.pidfd {
+            // The pidfd refers to this process even if it has been reaped and
+            // its pid reused.
+            Ok(pidfd_send_signal(pidfd.as_raw_fd(), signum)?)
+        } else {
+            Ok(kill(self.pid, signum)?)
+        }
     }
 
-    pub fn to_result(&self) -> res::ProcRes {
-        let (status, rusage) = if let Some((_, status, rusage)) = self.wait_info {
+    /// Returns the exit status and resource usage, if the proc has completed.
+    pub fn to_status(&self) -> (Option<res::Status>, Option<res::ResourceUsage>) {
+        if let Some((_, status, rusage)) = self.wait_info {
             (
                 Some(res::Status::new(status)),
                 Some(res::ResourceUsage::new(&rusage)),
             )
         } else {
             (None, None)
-        };
+        }
+    }
 
-        let fds = self
-            .fd_handlers
-            .iter()
-            .map(|(fd_num, fd_handler)| {
-                let result = match fd_handler.get_result() {
-                    Ok(fd_result) => fd_result,
-                    Err(_err) => {
-                        // result
-                        //     .errors
-                        //     .push(format!("failed to clean up fd {}: {}", fd.get_fd(), err));
-                        // FIXME: Put the error in here.
-                        res::FdRes::Error {}
-                    }
-                };
-                (fd::get_fd_name(*fd_num), result)
-            })
-            .collect::<BTreeMap<_, _>>();
+    /// Returns the proc's result, with `fds` detail about its fds.
+    pub fn to_result(&self, fds: res::FdDetail) -> res::ProcRes {
+        let (status, rusage) = self.to_status();
+
+        let fds = match fds {
+            res::FdDetail::None => None,
+            res::FdDetail::Sizes => Some(
+                self.fd_handlers
+                    .iter()
+                    .map(|(fd_num, fd_handler)| {
+                        let result = match fd_handler.output_len() {
+                            Ok(Some((length, truncated))) => {
+                                res::FdRes::CaptureLength { length, truncated }
+                            }
+                            Ok(None) => res::FdRes::None,
+                            Err(_err) => res::FdRes::Error {},
+                        };
+                        (fd::get_fd_name(*fd_num), result)
+                    })
+                    .collect::<BTreeMap<_, _>>(),
+            ),
+            res::FdDetail::Full => Some(
+                self.fd_handlers
+                    .iter()
+                    .map(|(fd_num, fd_handler)| {
+                        let result = match fd_handler.get_result() {
+                            Ok(fd_result) => fd_result,
+                            Err(_err) => {
+                                // result
+                                //     .errors
+                                //     .push(format!("failed to clean up fd {}: {}", fd.get_fd(), err));
+                                // FIXME: Put the error in here.
+                                res::FdRes::Error {}
+                            }
+                        };
+                        (fd::get_fd_name(*fd_num), result)
+                    })
+                    .collect::<BTreeMap<_, _>>(),
+            ),
+        };
 
         res::ProcRes {
             pid: self.pid,
             errors: self.errors.clone(),
             status,
             rusage,
+            labels: self.labels.clone(),
+            queued: self.queued,
             fds,
         }
     }
@@ -113,51 +200,179 @@ impl std::fmt::Debug for RunningProc {
 
 //------------------------------------------------------------------------------
 
-type SharedRunningProc = Rc<RefCell<RunningProc>>;
+/// Server-wide settings for starting and tracking procs.
+#[derive(Clone, Debug, Default)]
+pub struct Config {
+    /// How to detect termination of procs.
+    pub tracking: Tracking,
+    /// How to create procs.
+    pub spawn: SpawnMode,
+    /// If true, procs don't inherit fds other than 0-2 and those in their
+    /// specs.
+    pub close_fds: bool,
+    /// Limits on starting procs through the spawn queue.
+    pub limits: Limits,
+    /// Settings for capturing output.
+    pub capture: capture::Config,
+    /// Number of recent events to keep, from which event subscribers can
+    /// resume.
+    pub event_log_size: usize,
+}
+
+type SharedRunningProc = Arc<Mutex<RunningProc>>;
 pub type RunningProcs = BTreeMap<ProcId, SharedRunningProc>;
 
+/// A condition on proc labels.
+#[derive(Debug, PartialEq, Eq)]
+pub enum LabelSelector {
+    /// The label is present.
+    Exists(String),
+    /// The label is absent.
+    NotExists(String),
+    /// The label has this value.
+    Eq(String, String),
+    /// The label is absent or has another value.
+    Ne(String, String),
+}
+
+impl LabelSelector {
+    /// Parses `key`, `!key`, `key=value`, or `key!=value`.
+    pub fn parse(selector: &str) -> Option<LabelSelector> {
+        let selector = if let Some((key, value)) = selector.split_once("!=") {
+            LabelSelector::Ne(key.to_string(), value.to_string())
+        } else if let Some((key, value)) = selector.split_once('=') {
+            LabelSelector::Eq(key.to_string(), value.to_string())
+        } else if let Some(key) = selector.strip_prefix('!') {
+            LabelSelector::NotExists(key.to_string())
+        } else {
+            LabelSelector::Exists(selector.to_string())
+        };
+        match selector {
+            LabelSelector::Exists(ref key)
+            | LabelSelector::NotExists(ref key)
+            | LabelSelector::Eq(ref key, _)
+            | LabelSelector::Ne(ref key, _)
+                if key.is_empty() =>
+            {
+                None
+            }
+            _ => Some(selector),
+        }
+    }
+
+    pub fn matches(&self, labels: &BTreeMap<String, String>) -> bool {
+        match self {
+            LabelSelector::Exists(key) => labels.contains_key(key),
+            LabelSelector::NotExists(key) => !labels.contains_key(key),
+            LabelSelector::Eq(key, value) => labels.get(key) == Some(value),
+            LabelSelector::Ne(key, value) => labels.get(key) != Some(value),
+        }
+    }
+}
+
+/// Selects procs from the proc table.  All conditions must hold.
+#[derive(Debug, Default)]
+pub struct ProcFilter {
+    pub state: Option<ProcState>,
+    /// The proc terminated with, or with other than, this exit code.  A proc
+    /// terminated by a signal has no exit code.
+    pub exit_code: Option<(bool, i32)>,
+    pub labels: Vec<LabelSelector>,
+}
+
+impl ProcFilter {
+    pub fn matches(&self, proc: &RunningProc) -> bool {
+        let exit_code = proc.wait_info.map(|(_, status, _)| res::Status::new(status).exit_code);
+        if let Some(state) = self.state {
+            if proc.state() != state {
+                return false;
+            }
+        }
+        if let Some((eq, code)) = self.exit_code {
+            match exit_code {
+                Some(exit_code) if (exit_code == Some(code)) == eq => {}
+                _ => return false,
+            }
+        }
+        self.labels.iter().all(|selector| selector.matches(&proc.labels))
+    }
+}
+
 #[derive(Clone)]
 pub struct SharedRunningProcs {
-    procs: Rc<RefCell<RunningProcs>>,
+    /// The proc table.  Each proc has its own lock, so the table lock is held
+    /// only to look up, add, or remove procs.
+    procs: Arc<RwLock<RunningProcs>>,
+    config: Arc<Config>,
+    reaper: Reaper,
+    pub plans: PlanCache,
+    pub queue: SpawnQueue,
+    /// Proc lifecycle events.
+    pub events: Events,
+    zygote: Option<Zygote>,
 }
 
 impl SharedRunningProcs {
-    pub fn new() -> SharedRunningProcs {
+    pub fn new(config: Config) -> SharedRunningProcs {
+        if config.close_fds {
+            // Mark fds we inherited close-on-exec, so that procs don't inherit
+            // them either.  Fds we open ourselves are already close-on-exec.
+            // This covers procs started with posix_spawn, which can't do this
+            // in the child.
+            if let Err(err) = cloexec_range(3, RawFd::MAX) {
+                eprintln!("failed to set close-on-exec: {}", err);
+            }
+        }
         SharedRunningProcs {
-            procs: Rc::new(RefCell::new(BTreeMap::new())),
+            procs: Arc::new(RwLock::new(BTreeMap::new())),
+            reaper: Reaper::new(config.tracking),
+            queue: SpawnQueue::new(config.limits.clone()),
+            events: Events::new(config.event_log_size),
+            config: Arc::new(config),
+            plans: PlanCache::new(),
+            zygote: None,
         }
     }
 
+    /// Launches procs through the zygote connected to `sock`, in
+    /// `SpawnMode::Zygote`.
+    pub fn with_zygote(mut self, sock: OwnedFd) -> std::io::Result<Self> {
+        self.zygote = Some(Zygote::new(sock, self.reaper.clone())?);
+        Ok(self)
+    }
+
     // FIXME: Some of these methods are unused.
 
     pub fn insert(&self, proc_id: ProcId, proc: SharedRunningProc) {
-        self.procs.borrow_mut().insert(proc_id, proc);
+        self.procs.write().unwrap().insert(proc_id, proc);
     }
 
     pub fn len(&self) -> usize {
-        self.procs.borrow().len()
+        self.procs.read().unwrap().len()
     }
 
     pub fn get(&self, proc_id: &str) -> Option<SharedRunningProc> {
-        self.procs.borrow().get(proc_id).cloned()
+        self.procs.read().unwrap().get(proc_id).cloned()
     }
 
     pub fn first(&self) -> Option<(ProcId, SharedRunningProc)> {
         self.procs
-            .borrow()
+            .read()
+            .unwrap()
             .first_key_value()
-            .map(|(proc_id, proc)| (proc_id.clone(), Rc::clone(proc)))
+            .map(|(proc_id, proc)| (proc_id.clone(), Arc::clone(proc)))
     }
 
     pub fn remove(&self, proc_id: ProcId) -> Option<SharedRunningProc> {
-        self.procs.borrow_mut().remove(&proc_id)
+        self.procs.write().unwrap().remove(&proc_id)
     }
 
     /// Removes and returns a proc, if it is complete (has wait info).
     pub fn remove_if_complete(&self, proc_id: &ProcId) -> Result<SharedRunningProc, Error> {
-        let mut procs = self.procs.borrow_mut();
+        let mut procs = self.procs.write().unwrap();
         if let Some(proc) = procs.get(proc_id) {
-            if proc.borrow().wait_info.is_some() {
+            if proc.lock().unwrap().wait_info.is_some() {
+                self.events.send(proc_id, EventKind::Deleted);
                 Ok(procs.remove(proc_id).unwrap())
             } else {
                 Err(Error::ProcRunning(proc_id.clone()))
@@ -167,56 +382,166 @@ impl SharedRunningProcs {
         }
     }
 
+    /// Waits until all of `proc_ids` have completed, or if `all` is false, any
+    /// of them, or until `deadline`.  Returns true if they completed.
+    pub async fn wait_procs(
+        &self,
+        proc_ids: &[ProcId],
+        all: bool,
+        deadline: Instant,
+    ) -> Result<bool, Error> {
+        // Subscribe before checking, so that we don't miss a proc that
+        // completes meanwhile.
+        let mut events = self.events.subscribe();
+        if let Some(proc_id) = proc_ids.iter().find(|proc_id| self.get(proc_id).is_none()) {
+            return Err(Error::NoProcId(proc_id.to_string()));
+        }
+        // Ignore duplicate proc IDs.
+        let proc_ids = proc_ids.iter().collect::<BTreeSet<_>>();
+        let num_procs = proc_ids.len();
+        loop {
+            // Look up procs each time, as a queued proc's placeholder is
+            // replaced when it starts.  A proc that has been deleted had
+            // completed.
+            let num_done = proc_ids
+                .iter()
+                .filter(|proc_id| {
+                    self.get(proc_id)
+                        .map_or(true, |proc| proc.lock().unwrap().wait_info.is_some())
+                })
+                .count();
+            let done = if all { num_done == num_procs } else { num_done > 0 };
+            if done {
+                return Ok(true);
+            }
+            // Wait for one of the procs to exit.
+            loop {
+                match tokio::time::timeout_at(deadline, events.recv()).await {
+                    Err(_) => return Ok(false),
+                    Ok(Ok(event)) => {
+                        if matches!(event.kind, EventKind::Exited { .. })
+                            && proc_ids.contains(&event.proc_id)
+                        {
+                            break;
+                        }
+                    }
+                    // We may have missed an exit; check again.
+                    Ok(Err(broadcast::error::RecvError::Lagged(_))) => break,
+                    Ok(Err(broadcast::error::RecvError::Closed)) => return Ok(false),
+                }
+            }
+        }
+    }
+
     pub fn pop(&self) -> Option<(ProcId, SharedRunningProc)> {
-        self.procs.borrow_mut().pop_first()
+        self.procs.write().unwrap().pop_first()
     }
 
-    pub fn to_result(&self) -> res::Res {
-        self.procs
-            .borrow()
-            .iter()
-            .map(|(proc_id, proc)| (proc_id.clone(), proc.borrow().to_result()))
-            .collect::<BTreeMap<_, _>>()
+    /// Returns procs that match `filter`, in proc ID order, starting after
+    /// proc ID `after`.  Returns at most `limit` procs, and whether there are
+    /// more.
+    pub fn select(
+        &self,
+        filter: &ProcFilter,
+        after: Option<&str>,
+        limit: Option<usize>,
+    ) -> (Vec<(ProcId, SharedRunningProc)>, bool) {
+        let limit = limit.unwrap_or(usize::MAX);
+        // Copy out the matching procs, so that we don't hold the table lock
+        // while building results, which may be large.  Checking the filter
+        // holds each proc's lock only briefly.
+        let procs = self.procs.read().unwrap();
+        let range = match after {
+            Some(after) => procs.range::<str, _>((Bound::Excluded(after), Bound::Unbounded)),
+            None => procs.range::<str, _>(..),
+        };
+        let mut selected = range
+            .filter(|(_, proc)| filter.matches(&proc.lock().unwrap()))
+            .take(limit.saturating_add(1))
+            .map(|(proc_id, proc)| (proc_id.clone(), Arc::clone(proc)))
+            .collect::<Vec<_>>();
+        let more = selected.len() > limit;
+        selected.truncate(limit);
+        (selected, more)
     }
 }
 
-async fn wait_for_proc(proc: SharedRunningProc, mut sigchld_receiver: SignalReceiver) {
-    let pid = proc.borrow().pid;
-
-    loop {
-        // Wait until the process receives SIGCHLD.
-        sigchld_receiver.signal().await;
-
-        // Check if this pid has terminated, with a nonblocking wait.
-        if let Some(wait_info) = wait(pid, false) {
-            let mut proc = proc.borrow_mut();
-            assert!(proc.wait_info.is_none());
-            // Process terminated.
-            proc.wait_info = Some(wait_info);
-            break;
-        }
-    }
+async fn wait_for_proc(
+    proc_id: ProcId,
+    proc: SharedRunningProc,
+    wait_receiver: oneshot::Receiver<WaitInfo>,
+    events: Events,
+) {
+    // The reaper sends the wait info once the process has terminated.  It never
+    // drops the sender without sending.
+    let wait_info = wait_receiver.await.unwrap();
+    let mut proc = proc.lock().unwrap();
+    assert!(proc.wait_info.is_none());
+    proc.wait_info = Some(wait_info);
+    let (_, status, _) = wait_info;
+    events.send(&proc_id, EventKind::Exited { status: res::Status::new(status) });
 }
 
 pub async fn run_proc(
+    proc_id: ProcId,
     proc: SharedRunningProc,
-    sigchld_receiver: SignalReceiver,
-    error_pipe: ErrorPipe,
+    wait_receiver: oneshot::Receiver<WaitInfo>,
+    error_pipe: Option<ErrorPipe>,
+    fd_handler_tasks: Vec<(RawFd, tokio::task::JoinHandle<crate::err::Result<()>>)>,
+    events: Events,
 ) {
     // FIXME: Error pipe should append directly to errors, so that they are
     // available earlier.
     let error_task = {
-        let proc = Rc::clone(&proc);
-        tokio::task::spawn_local(async move {
-            let mut errors = error_pipe.in_parent().await;
-            proc.borrow_mut().errors.append(&mut errors);
+        let proc = Arc::clone(&proc);
+        let proc_id = proc_id.clone();
+        let events = events.clone();
+        tokio::spawn(async move {
+            if let Some(error_pipe) = error_pipe {
+                let mut errors = error_pipe.in_parent().await;
+                if !errors.is_empty() {
+                    events.send(&proc_id, EventKind::ExecFailed { errors: errors.clone() });
+                }
+                proc.lock().unwrap().errors.append(&mut errors);
+            }
         })
     };
 
-    let wait_task = tokio::task::spawn_local(wait_for_proc(proc, sigchld_receiver));
-
+    let wait_task = tokio::spawn(wait_for_proc(
+        proc_id.clone(),
+        Arc::clone(&proc),
+        wait_receiver,
+        events.clone(),
+    ));
+
+    // Finish reading output, while waiting.
+    let piped_fds = fd_handler_tasks.iter().map(|(fd, _)| *fd).collect::<Vec<_>>();
+    futures::future::join_all(fd_handler_tasks.into_iter().map(|(fd, task)| {
+        let (proc_id, events) = (&proc_id, &events);
+        async move {
+            _ = task.await;
+            events.send(proc_id, EventKind::OutputEof { fd: fd::get_fd_name(fd) });
+        }
+    }))
+    .await;
     _ = error_task.await;
     _ = wait_task.await;
+
+    // All output is captured, including output written to files.
+    for (fd, fd_handler) in proc.lock().unwrap().fd_handlers.iter() {
+        fd_handler.finish();
+        if fd_handler.is_captured() && !piped_fds.contains(fd) {
+            events.send(&proc_id, EventKind::OutputEof { fd: fd::get_fd_name(*fd) });
+        }
+    }
+}
+
+/// Returns wait info for a proc that couldn't be started, with no pid.  Its
+/// exit status is that of a child that fails to exec.
+fn not_started() -> oneshot::Receiver<WaitInfo> {
+    let (sender, receiver) = oneshot::channel();
+    _ = sender.send((0, exitcode::OSERR << 8, unsafe { std::mem::zeroed() }));
+    receiver
 }
 
 //------------------------------------------------------------------------------
@@ -225,90 +550,191 @@ pub async fn start_procs(
     input: Input,
     running_procs: SharedRunningProcs,
 ) -> Vec<tokio::task::JoinHandle<()>> {
-    let (sigchld_watcher, sigchld_receiver) =
-        SignalWatcher::new(tokio::signal::unix::SignalKind::child());
-    let _sigchld_task = tokio::spawn(sigchld_watcher.watch());
     let mut tasks = Vec::new();
 
     for (proc_id, spec) in input.procs.into_iter() {
-        let env = environ::build(std::env::vars(), &spec.env);
-
-        let error_pipe = ErrorPipe::new().unwrap_or_else(|err| {
-            eprintln!("failed to create pipe: {}", err);
-            std::process::exit(exitcode::OSFILE);
-        });
+        // Compile, or look up, the exec plan.
+        let exec_plan = match running_procs.plans.get(spec.argv, spec.env) {
+            Ok(exec_plan) => exec_plan,
+            Err(err) => {
+                // The proc can't be started.  Record it with the error.
+                let mut proc = RunningProc::new(0, None, Vec::new(), spec.labels);
+                proc.errors = vec![format!("invalid spec: {}", err)];
+                tasks.push(add_proc(
+                    &running_procs,
+                    proc_id,
+                    proc,
+                    not_started(),
+                    None,
+                    Vec::new(),
+                ));
+                continue;
+            }
+        };
 
         let fd_handlers = spec
             .fds
             .into_iter()
-            .map(|(fd_str, fd_spec)| fd::make_fd_handler(fd_str, fd_spec))
+            .map(|(fd_str, fd_spec)| fd::make_fd_handler(fd_str, fd_spec, &running_procs.config.capture))
             .collect::<Vec<_>>();
 
-        // Fork the child process.
-        match fork() {
-            Ok(0) => {
-                // In the child process.
-
-                // Set up to write errors, if any, back to the parent.
-                let error_writer = error_pipe.in_child().unwrap();
-                // True if we should finally exec.
-                let mut ok_to_exec = true;
-
-                for (fd, fd_handler) in fd_handlers.into_iter() {
-                    fd_handler.in_child().unwrap_or_else(|err| {
-                        error_writer.try_write(format!("failed to set up fd {}: {}", fd, err));
-                        ok_to_exec = false;
-                    });
-                }
+        // Compile the full launch plan, before forking.
+        let fd_ops = fd_handlers
+            .iter()
+            .flat_map(|(fd, fd_handler)| {
+                fd_handler
+                    .child_ops()
+                    .into_iter()
+                    .map(move |fd_op| (*fd, fd_op))
+            })
+            .collect::<Vec<_>>();
+        let mut plan = LaunchPlan::new(exec_plan, fd_ops);
+        if running_procs.config.close_fds {
+            let fds = fd_handlers.iter().map(|(fd, _)| *fd).collect::<Vec<_>>();
+            plan.close_others(&fds);
+        }
 
-                if ok_to_exec {
-                    let exe = &spec.argv[0];
-                    // execve() only returns with an error; on success, the program is
-                    // replaced.
-                    let err = execve(exe.clone(), spec.argv.clone(), env).unwrap_err();
-                    error_writer.try_write(format!("exec: {}: {}", exe, err));
+        // Until the child is registered with the reaper, the reaper keeps its
+        // wait info if it terminates right away.
+        let spawning = running_procs.reaper.spawning();
+
+        // Try to spawn the child process without forking.
+        let mut error_pipe = None;
+        // The pidfd, if the zygote launched the proc.
+        let mut remote = None;
+        let spawned = match (running_procs.config.spawn, &running_procs.zygote) {
+            (SpawnMode::PosixSpawn, _) => match posix_spawn(&plan) {
+                Ok(child_pid) => Some(Ok(child_pid)),
+                // posix_spawn can't carry out this plan; fork instead.
+                Err(err) if err.raw_os_error() == Some(libc::ENOSYS) => None,
+                // The proc failed to start; report the error as exec would.
+                Err(err) => Some(Err(vec![format!(
+                    "{}{}",
+                    String::from_utf8_lossy(&plan.exec.exec_error),
+                    err
+                )])),
+            },
+            (SpawnMode::Zygote, Some(zygote)) => {
+                let pipe = ErrorPipe::new().unwrap_or_else(|err| {
+                    eprintln!("failed to create pipe: {}", err);
+                    std::process::exit(exitcode::OSFILE);
+                });
+                match zygote.launch(&plan, &pipe).await {
+                    Ok((child_pid, pidfd)) => {
+                        error_pipe = Some(pipe);
+                        remote = Some(pidfd);
+                        Some(Ok(child_pid))
+                    }
+                    Err(err) => {
+                        eprintln!("zygote failed to start {}: {}", proc_id, err);
+                        None
+                    }
                 }
-                std::process::exit(exitcode::OSERR);
             }
+            // On failure, fall back to fork, which reports the error.
+            _ => None,
+        };
 
-            Ok(child_pid) => {
-                // Parent process.
-                // FIXME: What do we do with these tasks?  We should await them later.
-                let _fd_handler_tasks = fd_handlers
-                    .iter()
-                    .filter_map(|(ref fd, ref fd_handler)| {
-                        match fd_handler.in_parent() {
-                            Ok(task) => Some(task),
-                            Err(err) => {
-                                // FIXME: Push this error.
-                                let err = format!("failed to set up fd {}: {}", fd, err);
-                                eprintln!("{}", err);
-                                None
-                            }
-                        }
-                    })
-                    .collect::<Vec<_>>();
-
-                let proc = Rc::new(RefCell::new(RunningProc::new(child_pid, fd_handlers)));
+        let child_pid = match spawned {
+            Some(child_pid) => child_pid,
+
+            None => {
+                let pipe = ErrorPipe::new().unwrap_or_else(|err| {
+                    eprintln!("failed to create pipe: {}", err);
+                    std::process::exit(exitcode::OSFILE);
+                });
+
+                // Fork the child process.
+                match fork() {
+                    // In the child process.
+                    Ok(0) => plan.exec_child(pipe.in_child().unwrap()),
+                    Ok(child_pid) => {
+                        error_pipe = Some(pipe);
+                        Ok(child_pid)
+                    }
+                    Err(err) => panic!("failed to fork: {}", err),
+                }
+            }
+        };
 
-                // Start a task to handle this child.
-                tasks.push(tokio::task::spawn_local(run_proc(
-                    Rc::clone(&proc),
-                    sigchld_receiver.clone(),
-                    error_pipe,
-                )));
+        // Parent process.
+        let fd_handler_tasks = fd_handlers
+            .iter()
+            .filter_map(|(ref fd, ref fd_handler)| {
+                match fd_handler.in_parent() {
+                    Ok(task) => task.map(|task| (*fd, task)),
+                    Err(err) => {
+                        // FIXME: Push this error.
+                        let err = format!("failed to set up fd {}: {}", fd, err);
+                        eprintln!("{}", err);
+                        None
+                    }
+                }
+            })
+            .collect::<Vec<_>>();
 
-                // Construct the record of this running proc.
-                running_procs.insert(proc_id, proc);
+        // Register with the reaper before yielding, so that we receive the wait
+        // info even if the child terminates right away.
+        let (child_pid, pidfd, wait_receiver, errors) = match child_pid {
+            Ok(child_pid) => {
+                let (pidfd, wait_receiver) = match remote {
+                    // The zygote reaps the child, and reports its wait info.
+                    Some(pidfd) => (pidfd, running_procs.reaper.expect(child_pid)),
+                    None => running_procs.reaper.track(child_pid),
+                };
+                (child_pid, pidfd, wait_receiver, Vec::new())
             }
-
-            Err(err) => panic!("failed to fork: {}", err),
-        }
+            Err(errors) => (0, None, not_started(), errors),
+        };
+        drop(spawning);
+
+        let mut proc = RunningProc::new(child_pid, pidfd, fd_handlers, spec.labels);
+        proc.errors = errors;
+        tasks.push(add_proc(
+            &running_procs,
+            proc_id,
+            proc,
+            wait_receiver,
+            error_pipe,
+            fd_handler_tasks,
+        ));
     }
 
     tasks
 }
 
+/// Adds a proc to the table, and starts a task to handle it.  If the proc
+/// has errors, it couldn't be started.
+fn add_proc(
+    running_procs: &SharedRunningProcs,
+    proc_id: ProcId,
+    proc: RunningProc,
+    wait_receiver: oneshot::Receiver<WaitInfo>,
+    error_pipe: Option<ErrorPipe>,
+    fd_handler_tasks: Vec<(RawFd, tokio::task::JoinHandle<crate::err::Result<()>>)>,
+) -> tokio::task::JoinHandle<()> {
+    let event = if proc.errors.is_empty() {
+        EventKind::Started { pid: proc.pid }
+    } else {
+        EventKind::ExecFailed { errors: proc.errors.clone() }
+    };
+    let proc = Arc::new(Mutex::new(proc));
+
+    // Construct the record of this running proc.
+    running_procs.insert(proc_id.clone(), Arc::clone(&proc));
+    running_procs.events.send(&proc_id, event);
+
+    // Start a task to handle this child.
+    tokio::spawn(run_proc(
+        proc_id,
+        proc,
+        wait_receiver,
+        error_pipe,
+        fd_handler_tasks,
+        running_procs.events.clone(),
+    ))
+}
+
 pub async fn collect_results(running_procs: SharedRunningProcs) -> res::Res {
     let mut result = res::Res::new();
 
@@ -336,12 +762,43 @@ pub async fn collect_results(running_procs: SharedRunningProcs) -> res::Res {
 
     // Collect proc results by removing and waiting each running proc.
     while let Some((proc_id, proc)) = running_procs.pop() {
-        let proc = Rc::try_unwrap(proc).unwrap().into_inner();
+        let proc = Arc::try_unwrap(proc).unwrap().into_inner().unwrap();
         // Build the proc res.
-        result.insert(proc_id.clone(), proc.to_result());
+        result.insert(proc_id.clone(), proc.to_result(res::FdDetail::Full));
     }
     // Nothing should be left running.
     assert!(running_procs.len() == 0);
 
     result
 }
+
+//------------------------------------------------------------------------------
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn label_selector() {
+        use LabelSelector::*;
+        assert_eq!(LabelSelector::parse("env"), Some(Exists("env".into())));
+        assert_eq!(LabelSelector::parse("!env"), Some(NotExists("env".into())));
+        assert_eq!(LabelSelector::parse("env=prod"), Some(Eq("env".into(), "prod".into())));
+        assert_eq!(LabelSelector::parse("env!=prod"), Some(Ne("env".into(), "prod".into())));
+        assert_eq!(LabelSelector::parse("env="), Some(Eq("env".into(), "".into())));
+        assert_eq!(LabelSelector::parse(""), None);
+        assert_eq!(LabelSelector::parse("!"), None);
+        assert_eq!(LabelSelector::parse("=prod"), None);
+
+        let labels = BTreeMap::from([("env".to_string(), "prod".to_string())]);
+        let matches = |selector| LabelSelector::parse(selector).unwrap().matches(&labels);
+        assert!(matches("env"));
+        assert!(!matches("!env"));
+        assert!(matches("!team"));
+        assert!(matches("env=prod"));
+        assert!(!matches("env=dev"));
+        assert!(matches("env!=dev"));
+        assert!(matches("team!=web"));
+        assert!(!matches("env!=prod"));
+    }
+}
@@ -0,0 +1,216 @@
+use std::collections::{BTreeMap, VecDeque};
+use std::sync::{Arc, Mutex};
+use std::time::Duration;
+use tokio::sync::Notify;
+use tokio::time::Instant;
+
+use crate::procs::{start_procs, RunningProc, SharedRunningProcs};
+use crate::spec::{Input, Proc, ProcId};
+
+//------------------------------------------------------------------------------
+
+/// Limits on starting procs through the spawn queue.
+#[derive(Clone, Debug)]
+pub struct Limits {
+    /// Max number of queued procs running at once, if limited.  Must be
+    /// positive.
+    pub max_running: Option<usize>,
+    /// Max number of procs started per second, if limited.  Must be positive.
+    pub max_rate: Option<f64>,
+    /// Max number of procs waiting in the queue.
+    pub max_depth: usize,
+}
+
+impl Default for Limits {
+    fn default() -> Self {
+        Self {
+            max_running: None,
+            max_rate: None,
+            max_depth: 10000,
+        }
+    }
+}
+
+/// Procs can't be queued.
+#[derive(Debug)]
+pub enum SubmitError {
+    /// There are more procs than the queue can ever hold.
+    TooMany { num: usize, max_depth: usize },
+    /// The queue is too full to accept the procs now.
+    Full { depth: usize, max_depth: usize },
+}
+
+impl std::fmt::Display for SubmitError {
+    fn fmt(&self, f: &mut std::fmt::Formatter) -> std::fmt::Result {
+        match self {
+            SubmitError::TooMany { num, max_depth } => {
+                write!(f, "too many procs: {} exceeds spawn queue size {}", num, max_depth)
+            }
+            SubmitError::Full { depth, max_depth } => {
+                write!(f, "spawn queue full: {} of {} queued", depth, max_depth)
+            }
+        }
+    }
+}
+
+struct Entry {
+    proc_id: ProcId,
+    spec: Proc,
+    /// When the entry was queued.
+    time: Instant,
+}
+
+#[derive(Default)]
+struct State {
+    entries: VecDeque<Entry>,
+    /// Number of procs started from the queue that are still running.
+    running: usize,
+    /// True if the launcher task has been started.
+    launching: bool,
+    /// Number of procs started from the queue.
+    num_started: u64,
+    /// Total and max time that started procs spent in the queue.
+    wait_total: Duration,
+    wait_max: Duration,
+}
+
+/// Queue of procs waiting to be started.
+///
+/// A single launcher task starts queued procs one at a time, subject to
+/// `Limits`, and yields to the reactor between them, so that a large batch of
+/// procs doesn't stall other tasks.
+#[derive(Clone)]
+pub struct SpawnQueue {
+    limits: Arc<Limits>,
+    state: Arc<Mutex<State>>,
+    /// Notified when an entry is queued or a running proc completes.
+    notify: Arc<Notify>,
+}
+
+impl SpawnQueue {
+    pub fn new(limits: Limits) -> Self {
+        Self {
+            limits: Arc::new(limits),
+            state: Default::default(),
+            notify: Default::default(),
+        }
+    }
+
+    /// Returns true if the next queued proc may be started now.
+    fn ready(&self) -> bool {
+        let state = self.state.lock().unwrap();
+        !state.entries.is_empty()
+            && self
+                .limits
+                .max_running
+                .map_or(true, |max_running| state.running < max_running)
+    }
+
+    async fn run(self, procs: SharedRunningProcs) {
+        let interval = self.limits.max_rate.map(|r| Duration::from_secs_f64(1. / r));
+        let mut last_start: Option<Instant> = None;
+
+        loop {
+            while !self.ready() {
+                self.notify.notified().await;
+            }
+            if let (Some(interval), Some(last_start)) = (interval, last_start) {
+                tokio::time::sleep_until(last_start + interval).await;
+            }
+
+            // Only this task removes entries, so the queue is still nonempty.
+            let entry = self.state.lock().unwrap().entries.pop_front().unwrap();
+            let now = Instant::now();
+            last_start = Some(now);
+            {
+                let mut state = self.state.lock().unwrap();
+                let wait = now - entry.time;
+                state.num_started += 1;
+                state.wait_total += wait;
+                state.wait_max = state.wait_max.max(wait);
+            }
+
+            let input = Input {
+                procs: BTreeMap::from([(entry.proc_id, entry.spec)]),
+            };
+            let tasks = start_procs(input, procs.clone()).await;
+
+            // Track running procs, to enforce `max_running`.
+            self.state.lock().unwrap().running += tasks.len();
+            for task in tasks {
+                let queue = self.clone();
+                tokio::spawn(async move {
+                    _ = task.await;
+                    queue.state.lock().unwrap().running -= 1;
+                    queue.notify.notify_one();
+                });
+            }
+
+            // Let other tasks run between starts.
+            tokio::task::yield_now().await;
+        }
+    }
+
+    /// Queues the procs in `input`, to be started into `procs`, or returns an
+    /// error if there isn't room for all the procs.  Until each proc is
+    /// started, a placeholder for it is in `procs`.
+    pub fn submit(&self, input: Input, procs: &SharedRunningProcs) -> Result<(), SubmitError> {
+        let num = input.procs.len();
+        if num > self.limits.max_depth {
+            return Err(SubmitError::TooMany {
+                num,
+                max_depth: self.limits.max_depth,
+            });
+        }
+        let mut state = self.state.lock().unwrap();
+        let depth = state.entries.len();
+        if depth + num > self.limits.max_depth {
+            return Err(SubmitError::Full {
+                depth,
+                max_depth: self.limits.max_depth,
+            });
+        }
+
+        if !state.launching {
+            tokio::spawn(self.clone().run(procs.clone()));
+            state.launching = true;
+        }
+
+        let time = Instant::now();
+        for (proc_id, spec) in input.procs.into_iter() {
+            // The launcher can't start the proc, and replace the placeholder,
+            // until it is queued.
+            let placeholder = RunningProc::queued(spec.labels.clone());
+            procs.insert(proc_id.clone(), Arc::new(Mutex::new(placeholder)));
+            state.entries.push_back(Entry {
+                proc_id,
+                spec,
+                time,
+            });
+        }
+        self.notify.notify_one();
+        Ok(())
+    }
+
+    pub fn to_jso(&self) -> serde_json::Value {
+        let state = self.state.lock().unwrap();
+        let now = Instant::now();
+        serde_json::json!({
+            "depth": state.entries.len(),
+            "max_depth": self.limits.max_depth,
+            "running": state.running,
+            "max_running": self.limits.max_running,
+            "max_rate": self.limits.max_rate,
+            "started": state.num_started,
+            "wait": {
+                "mean": if state.num_started > 0 {
+                    state.wait_total.as_secs_f64() / state.num_started as f64
+                } else {
+                    0.
+                },
+                "max": state.wait_max.as_secs_f64(),
+                "oldest": state.entries.front().map_or(0., |e| (now - e.time).as_secs_f64()),
+            },
+        })
+    }
+}
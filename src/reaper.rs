@@ -0,0 +1,277 @@
+use libc::pid_t;
+use std::collections::HashMap;
+use std::io;
+use std::os::fd::{AsRawFd, FromRawFd, OwnedFd, RawFd};
+use std::sync::atomic::{AtomicBool, Ordering};
+use std::sync::{Arc, Mutex};
+use tokio::io::unix::AsyncFd;
+use tokio::io::Interest;
+use tokio::signal::unix::SignalKind;
+use tokio::sync::oneshot;
+
+use crate::sig::{SignalReceiver, SignalWatcher};
+use crate::sys::{getpid, pidfd_open, wait, wait4, WaitInfo};
+
+//------------------------------------------------------------------------------
+
+/// How termination of child processes is detected.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum Tracking {
+    /// A single task reaps all children on SIGCHLD.
+    Sigchld,
+    /// Each child is tracked through its own pidfd, registered with the
+    /// reactor.  No SIGCHLD handling is involved.
+    Pidfd,
+}
+
+impl Default for Tracking {
+    fn default() -> Self {
+        Self::Sigchld
+    }
+}
+
+impl Tracking {
+    /// Checks that this tracking mode is supported by the OS.
+    pub fn check(&self) -> io::Result<()> {
+        match self {
+            Tracking::Sigchld => Ok(()),
+            Tracking::Pidfd => {
+                let pidfd = pidfd_open(getpid())?;
+                drop(unsafe { OwnedFd::from_raw_fd(pidfd) });
+                Ok(())
+            }
+        }
+    }
+}
+
+/// Waits for the termination of child process `pid` through its `pidfd`,
+/// and reaps it.
+async fn wait_pidfd(pid: pid_t, pidfd: RawFd) -> io::Result<WaitInfo> {
+    let async_fd = AsyncFd::with_interest(pidfd, Interest::READABLE)?;
+    loop {
+        // The pidfd polls readable once the process has terminated.
+        let mut guard = async_fd.readable().await?;
+        if let Some(wait_info) = wait(pid, false) {
+            return Ok(wait_info);
+        }
+        guard.clear_ready();
+    }
+}
+
+/// Waits for the termination of child process `pid` by polling.  This is a
+/// fallback, used only if we can't get a pidfd for the process.
+async fn wait_poll(pid: pid_t) -> WaitInfo {
+    let mut interval = tokio::time::interval(std::time::Duration::from_millis(100));
+    loop {
+        interval.tick().await;
+        if let Some(wait_info) = wait(pid, false) {
+            return wait_info;
+        }
+    }
+}
+
+//------------------------------------------------------------------------------
+
+#[derive(Default)]
+struct Waiters {
+    /// Senders for wait info of procs that are being waited for, by pid.
+    pending: HashMap<pid_t, oneshot::Sender<WaitInfo>>,
+    /// Wait info of procs that were reaped while procs were being spawned,
+    /// before anyone waited for them.
+    reaped: HashMap<pid_t, WaitInfo>,
+    /// Number of spawns in progress.
+    spawning: usize,
+}
+
+impl Waiters {
+    fn dispatch(&mut self, wait_info: WaitInfo) {
+        let (pid, _, _) = wait_info;
+        if let Some(sender) = self.pending.remove(&pid) {
+            // If the receiver is gone, nobody cares about this proc anymore.
+            _ = sender.send(wait_info);
+        } else if self.spawning > 0 {
+            // The proc may be one being spawned, which terminated before it
+            // was registered.
+            self.reaped.insert(pid, wait_info);
+        }
+        // Otherwise, nobody will wait for this proc, for example the zygote,
+        // or a child that failed in posix_spawn.  Drop its wait info, so that
+        // it isn't handed to a later proc that reuses its pid.
+    }
+}
+
+/// A spawn in progress.  While any spawn is in progress, the reaper keeps wait
+/// info of procs that terminate before they are registered with `track()` or
+/// `expect()`.  Once none is, it drops wait info nobody registered for.
+pub struct Spawning(Arc<Mutex<Waiters>>);
+
+impl Drop for Spawning {
+    fn drop(&mut self) {
+        let mut waiters = self.0.lock().unwrap();
+        waiters.spawning -= 1;
+        if waiters.spawning == 0 {
+            waiters.reaped.clear();
+        }
+    }
+}
+
+/// Reaps terminated child processes, and dispatches their wait info by pid.
+///
+/// A single reaper task waits for SIGCHLD, then reaps all terminated children
+/// with nonblocking `wait4()`, and sends each wait info to whoever is waiting
+/// for that pid.  The cost of handling a termination thus doesn't depend on
+/// the number of running children.
+///
+/// In SIGCHLD mode, the reaper reaps _all_ children of this process, so there
+/// must be only one.  In pidfd mode, each child is waited for individually.
+#[derive(Clone, Default)]
+pub struct Reaper {
+    tracking: Tracking,
+    waiters: Arc<Mutex<Waiters>>,
+    started: Arc<AtomicBool>,
+}
+
+impl Reaper {
+    pub fn new(tracking: Tracking) -> Self {
+        Self {
+            tracking,
+            ..Default::default()
+        }
+    }
+
+    /// Reaps all terminated children, without blocking.
+    fn reap(&self) {
+        loop {
+            match wait4(-1, false) {
+                Ok(Some(wait_info)) => self.waiters.lock().unwrap().dispatch(wait_info),
+                // Children exist, but none has terminated.
+                Ok(None) => break,
+                Err(ref err) if err.raw_os_error() == Some(libc::ECHILD) => break,
+                Err(ref err) if err.kind() == std::io::ErrorKind::Interrupted => continue,
+                Err(err) => panic!("wait4 failed: {}", err),
+            }
+        }
+    }
+
+    async fn run(self, mut sigchld_receiver: SignalReceiver) {
+        loop {
+            // Children may have terminated before we started watching.
+            self.reap();
+            sigchld_receiver.signal().await;
+        }
+    }
+
+    /// Starts the reaper task, if it isn't already running.
+    fn start(&self) {
+        if !self.started.swap(true, Ordering::AcqRel) {
+            let (sigchld_watcher, sigchld_receiver) = SignalWatcher::new(SignalKind::child());
+            tokio::spawn(sigchld_watcher.watch());
+            tokio::spawn(self.clone().run(sigchld_receiver));
+        }
+    }
+
+    /// Starts a spawn.  Hold the result until the spawned proc is registered
+    /// with `track()` or `expect()`, or the spawn has failed.
+    pub fn spawning(&self) -> Spawning {
+        self.waiters.lock().unwrap().spawning += 1;
+        Spawning(Arc::clone(&self.waiters))
+    }
+
+    /// Returns a receiver for the wait info of child process `pid`, once it
+    /// terminates.
+    fn wait_for(&self, pid: pid_t) -> oneshot::Receiver<WaitInfo> {
+        self.start();
+        self.expect(pid)
+    }
+
+    /// Returns a receiver for the wait info of process `pid`, once it is
+    /// passed to `dispatch()`.  For processes that are reaped elsewhere.  Must
+    /// be called while `spawning()` is held for the process.
+    pub fn expect(&self, pid: pid_t) -> oneshot::Receiver<WaitInfo> {
+        let (sender, receiver) = oneshot::channel();
+        let mut waiters = self.waiters.lock().unwrap();
+        if let Some(wait_info) = waiters.reaped.remove(&pid) {
+            // Already reaped.
+            _ = sender.send(wait_info);
+        } else {
+            waiters.pending.insert(pid, sender);
+        }
+        receiver
+    }
+
+    /// Dispatches wait info of a process that was reaped elsewhere.
+    pub fn dispatch(&self, wait_info: WaitInfo) {
+        self.waiters.lock().unwrap().dispatch(wait_info);
+    }
+
+    /// Starts tracking child process `pid`.  Must be called while
+    /// `spawning()` is held for the child.
+    ///
+    /// Returns the pidfd for the process, in pidfd mode, and a receiver for its
+    /// wait info, once it terminates.
+    pub fn track(&self, pid: pid_t) -> (Option<OwnedFd>, oneshot::Receiver<WaitInfo>) {
+        match self.tracking {
+            Tracking::Sigchld => (None, self.wait_for(pid)),
+
+            Tracking::Pidfd => {
+                let (sender, receiver) = oneshot::channel();
+                match pidfd_open(pid) {
+                    Ok(pidfd) => {
+                        let pidfd = unsafe { OwnedFd::from_raw_fd(pidfd) };
+                        let raw_fd = pidfd.as_raw_fd();
+                        tokio::spawn(async move {
+                            let wait_info = match wait_pidfd(pid, raw_fd).await {
+                                Ok(wait_info) => wait_info,
+                                Err(err) => {
+                                    eprintln!("failed to wait on pidfd for {}: {}", pid, err);
+                                    wait_poll(pid).await
+                                }
+                            };
+                            _ = sender.send(wait_info);
+                        });
+                        (Some(pidfd), receiver)
+                    }
+                    Err(err) => {
+                        eprintln!("failed to open pidfd for {}: {}", pid, err);
+                        tokio::spawn(async move {
+                            _ = sender.send(wait_poll(pid).await);
+                        });
+                        (None, receiver)
+                    }
+                }
+            }
+        }
+    }
+}
+
+//------------------------------------------------------------------------------
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn reaped_early() {
+        let reaper = Reaper::new(Tracking::Sigchld);
+        let wait_info = |pid| (pid, 0, unsafe { std::mem::zeroed() });
+
+        // Reaped while spawning, before it was registered.
+        let spawning = reaper.spawning();
+        reaper.dispatch(wait_info(100));
+        reaper.dispatch(wait_info(101));
+        let mut receiver = reaper.expect(100);
+        assert_eq!(receiver.try_recv().unwrap().0, 100);
+        drop(spawning);
+
+        // Wait info nobody registered for is dropped once spawning is done.
+        assert!(reaper.waiters.lock().unwrap().reaped.is_empty());
+        let mut receiver = reaper.expect(101);
+        assert!(receiver.try_recv().is_err());
+        reaper.dispatch(wait_info(101));
+        assert_eq!(receiver.try_recv().unwrap().0, 101);
+
+        // Not spawning: dropped.
+        reaper.dispatch(wait_info(102));
+        assert!(reaper.waiters.lock().unwrap().reaped.is_empty());
+    }
+}
@@ -1,10 +1,12 @@
 /// Named "Res" to avoid confusion with the `Result` types.
-use base64::Engine;
+use base64::write::EncoderStringWriter;
 use libc::{c_int, pid_t, rusage};
 use serde::Serialize;
 use std::collections::BTreeMap;
+use std::io::Write;
 use std::path::{Path, PathBuf};
 
+use crate::capture::{Chunks, CompressionStats, Truncation};
 use crate::spec::{CaptureFormat, ProcId};
 
 //------------------------------------------------------------------------------
@@ -72,34 +74,165 @@ pub enum FdRes {
 
     File { path: PathBuf },
 
-    CaptureUtf8 { text: String },
+    CaptureUtf8 {
+        text: String,
+        /// The range of output dropped from `text`, if any.
+        #[serde(skip_serializing_if = "Option::is_none")]
+        truncated: Option<Truncation>,
+        /// Sizes of output as stored, if compressed.
+        #[serde(skip_serializing_if = "Option::is_none")]
+        compression: Option<CompressionStats>,
+    },
 
-    CaptureBase64 { data: String, encoding: String },
+    CaptureBase64 {
+        data: String,
+        encoding: String,
+        /// The range of output dropped from `data`, if any.
+        #[serde(skip_serializing_if = "Option::is_none")]
+        truncated: Option<Truncation>,
+        /// Sizes of output as stored, if compressed.
+        #[serde(skip_serializing_if = "Option::is_none")]
+        compression: Option<CompressionStats>,
+    },
+
+    /// The length of captured output, without the output itself.
+    CaptureLength {
+        /// Bytes of output captured so far, including any dropped.
+        length: u64,
+        /// The range of output dropped, if any.
+        #[serde(skip_serializing_if = "Option::is_none")]
+        truncated: Option<Truncation>,
+    },
+}
+
+/// How much to include about fds in proc results.
+#[derive(Clone, Copy, Debug, Default, PartialEq, Eq)]
+pub enum FdDetail {
+    /// Omit fds.
+    None,
+    /// Include the lengths of captured output only.
+    Sizes,
+    /// Include captured output.
+    #[default]
+    Full,
+}
+
+/// Appends `data` to `text`, replacing invalid UTF-8 as
+/// `String::from_utf8_lossy()` does.  `partial` holds an incomplete sequence at
+/// the end of the previous data, which may continue in this data.
+fn push_utf8_lossy(text: &mut String, partial: &mut Vec<u8>, mut data: &[u8]) {
+    // Complete a sequence split from the previous data.
+    while !partial.is_empty() && !data.is_empty() {
+        partial.push(data[0]);
+        data = &data[1..];
+        match std::str::from_utf8(partial) {
+            Ok(s) => {
+                text.push_str(s);
+                partial.clear();
+            }
+            Err(err) => {
+                if let Some(len) = err.error_len() {
+                    text.push(char::REPLACEMENT_CHARACTER);
+                    let rest = partial.split_off(len);
+                    partial.clear();
+                    push_utf8_lossy(text, partial, &rest);
+                }
+            }
+        }
+    }
+
+    loop {
+        match std::str::from_utf8(data) {
+            Ok(s) => {
+                text.push_str(s);
+                break;
+            }
+            Err(err) => {
+                let (valid, rest) = data.split_at(err.valid_up_to());
+                text.push_str(unsafe { std::str::from_utf8_unchecked(valid) });
+                match err.error_len() {
+                    Some(len) => {
+                        text.push(char::REPLACEMENT_CHARACTER);
+                        data = &rest[len..];
+                    }
+                    None => {
+                        partial.extend_from_slice(rest);
+                        break;
+                    }
+                }
+            }
+        }
+    }
 }
 
 impl FdRes {
-    pub fn from_bytes(format: CaptureFormat, buffer: &Vec<u8>) -> FdRes {
+    pub fn from_bytes(format: CaptureFormat, data: &Chunks, truncated: Option<Truncation>) -> FdRes {
+        Self::from_slices(format, data.iter().map(|chunk| &chunk[..]), truncated)
+    }
+
+    /// Builds a capture result from output in consecutive pieces, encoding
+    /// each in turn, without joining them.
+    pub fn from_slices<'a>(
+        format: CaptureFormat,
+        slices: impl IntoIterator<Item = &'a [u8]>,
+        truncated: Option<Truncation>,
+    ) -> FdRes {
         match format {
             CaptureFormat::Text => {
-                // FIXME: Handle errors.
-                let text = String::from_utf8_lossy(&buffer).to_string();
-                FdRes::CaptureUtf8 { text }
+                let mut text = String::new();
+                let mut partial = Vec::new();
+                for slice in slices {
+                    push_utf8_lossy(&mut text, &mut partial, slice);
+                }
+                if !partial.is_empty() {
+                    // The output ended in an incomplete sequence.
+                    text.push(char::REPLACEMENT_CHARACTER);
+                }
+                FdRes::CaptureUtf8 {
+                    text,
+                    truncated,
+                    compression: None,
+                }
             }
             CaptureFormat::Base64 => {
-                // FIXME: Handle errors.
-                let data = base64::engine::general_purpose::STANDARD.encode(&buffer);
+                // The writer carries bytes over between slices, so that the
+                // encoding is the same as of the joined output.
+                let mut writer = EncoderStringWriter::new(&base64::engine::general_purpose::STANDARD);
+                for slice in slices {
+                    // Writing to a string can't fail.
+                    writer.write_all(slice).unwrap();
+                }
+                let data = writer.into_inner();
                 FdRes::CaptureBase64 {
                     data,
                     encoding: "base64".to_string(),
+                    truncated,
+                    compression: None,
                 }
             }
         }
     }
+
+    /// Adds sizes of compressed output to a capture result.
+    pub fn with_compression(mut self, stats: Option<CompressionStats>) -> FdRes {
+        match self {
+            FdRes::CaptureUtf8 {
+                ref mut compression,
+                ..
+            }
+            | FdRes::CaptureBase64 {
+                ref mut compression,
+                ..
+            } => *compression = stats,
+            _ => {}
+        }
+        self
+    }
 }
 
 //------------------------------------------------------------------------------
 
-#[derive(Debug, Serialize)]
+#[derive(Clone, Debug, Serialize)]
 pub struct Status {
     /// The raw process exit status returned by `wait()`.  This combines exit
     /// code and signum.
@@ -143,9 +276,18 @@ pub struct ProcRes {
     /// Process resource usage, if it has completed.
     pub rusage: Option<ResourceUsage>,
 
-    /// Fd results.
+    /// Labels from the proc spec.
+    #[serde(skip_serializing_if = "BTreeMap::is_empty")]
+    pub labels: BTreeMap<String, String>,
+
+    /// True if the proc is waiting in the spawn queue.
+    #[serde(skip_serializing_if = "std::ops::Not::not")]
+    pub queued: bool,
+
+    /// Fd results, unless omitted.
     /// FIXME: Associative map from fd instead?
-    pub fds: BTreeMap<String, FdRes>,
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub fds: Option<BTreeMap<String, FdRes>>,
 }
 
 impl ProcRes {
@@ -155,7 +297,9 @@ impl ProcRes {
             pid,
             status: Some(Status::new(status)),
             rusage: Some(ResourceUsage::new(&rusage)),
-            fds: BTreeMap::new(),
+            labels: BTreeMap::new(),
+            queued: false,
+            fds: Some(BTreeMap::new()),
         }
     }
 }
@@ -174,3 +318,43 @@ pub fn dump_file<P: AsRef<Path>>(result: &Res, path: P) -> std::io::Result<()> {
     serde_json::to_writer(file, result)?;
     Ok(())
 }
+
+//------------------------------------------------------------------------------
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use base64::Engine;
+    use bytes::Bytes;
+
+    fn split(data: &[u8], at: &[usize]) -> Chunks {
+        let mut chunks = Chunks::default();
+        let mut start = 0;
+        for &end in at.iter().chain([data.len()].iter()) {
+            chunks.push(Bytes::copy_from_slice(&data[start..end]));
+            start = end;
+        }
+        chunks
+    }
+
+    #[test]
+    fn from_bytes_split() {
+        // Valid multibyte sequences, then invalid and incomplete ones.
+        let data = ["aé€😀".as_bytes(), b"\xf0\x9f\x98x\xe2\x82\x80\xff\xc3"].concat();
+        for i in 0..=data.len() {
+            for j in i..=data.len() {
+                let chunks = split(&data, &[i, j]);
+                match FdRes::from_bytes(CaptureFormat::Text, &chunks, None) {
+                    FdRes::CaptureUtf8 { text, .. } => assert_eq!(text, String::from_utf8_lossy(&data)),
+                    _ => panic!(),
+                }
+                match FdRes::from_bytes(CaptureFormat::Base64, &chunks, None) {
+                    FdRes::CaptureBase64 { data: encoded, .. } => {
+                        assert_eq!(encoded, base64::engine::general_purpose::STANDARD.encode(&data))
+                    }
+                    _ => panic!(),
+                }
+            }
+        }
+    }
+}
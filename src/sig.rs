@@ -3,6 +3,7 @@ extern crate libc;
 use lazy_static::lazy_static;
 use libc::c_int;
 use std::collections::HashMap;
+use std::sync::atomic::{AtomicUsize, Ordering};
 use tokio::signal::unix::{signal, Signal, SignalKind};
 use tokio::sync::watch::error::SendError;
 use tokio::sync::watch::{channel, Receiver, Sender};
@@ -73,6 +74,14 @@ impl SignalReceiver {
     }
 }
 
+/// Number of signal watchers that currently exist.
+static NUM_WATCHERS: AtomicUsize = AtomicUsize::new(0);
+
+/// Returns the number of signal watchers that currently exist.
+pub fn num_watchers() -> usize {
+    NUM_WATCHERS.load(Ordering::Relaxed)
+}
+
 pub struct SignalWatcher {
     stream: Signal,
     sender: Sender<()>,
@@ -82,6 +91,7 @@ impl SignalWatcher {
     pub fn new(kind: SignalKind) -> (SignalWatcher, SignalReceiver) {
         let stream = signal(kind).unwrap();
         let (sender, receiver) = channel(());
+        NUM_WATCHERS.fetch_add(1, Ordering::Relaxed);
         (SignalWatcher { stream, sender }, SignalReceiver(receiver))
     }
 
@@ -100,3 +110,9 @@ impl SignalWatcher {
         }
     }
 }
+
+impl Drop for SignalWatcher {
+    fn drop(&mut self) {
+        NUM_WATCHERS.fetch_sub(1, Ordering::Relaxed);
+    }
+}
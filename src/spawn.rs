@@ -0,0 +1,97 @@
+use libc::{c_char, c_int, pid_t};
+use std::io;
+use std::mem::MaybeUninit;
+
+use crate::fd::FdOp;
+use crate::launch::LaunchPlan;
+
+//------------------------------------------------------------------------------
+
+/// How child processes are created.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum SpawnMode {
+    /// `fork()`, then set up fds and `execve()` in the child.  The cost of
+    /// `fork()` grows with the size of this process, as it copies page tables.
+    Fork,
+    /// `posix_spawn()`, which glibc implements with `CLONE_VM | CLONE_VFORK`,
+    /// so that the cost doesn't depend on the size of this process.
+    ///
+    /// If the spawn fails, the proc is complete right away, with the error in
+    /// its errors, and the exit status of a child that fails to exec.  If
+    /// posix_spawn isn't supported, the proc is started with `Fork` instead.
+    PosixSpawn,
+    /// Ask the zygote, a small helper process forked at startup, to fork and
+    /// exec, so that neither the cost nor the blocking of `fork()` falls on
+    /// this process.
+    ///
+    /// If the zygote can't start the proc, it is started again with `Fork`.
+    Zygote,
+}
+
+impl Default for SpawnMode {
+    fn default() -> Self {
+        Self::PosixSpawn
+    }
+}
+
+//------------------------------------------------------------------------------
+
+/// Converts a posix_spawn-style return value, which is an error number.
+fn check(ret: c_int) -> io::Result<()> {
+    match ret {
+        0 => Ok(()),
+        err => Err(io::Error::from_raw_os_error(err)),
+    }
+}
+
+struct FileActions(libc::posix_spawn_file_actions_t);
+
+impl FileActions {
+    fn new(fd_ops: &[FdOp]) -> io::Result<Self> {
+        let mut actions = MaybeUninit::<libc::posix_spawn_file_actions_t>::uninit();
+        check(unsafe { libc::posix_spawn_file_actions_init(actions.as_mut_ptr()) })?;
+        let mut actions = FileActions(unsafe { actions.assume_init() });
+        for fd_op in fd_ops {
+            check(match *fd_op {
+                FdOp::Close(fd) => unsafe {
+                    libc::posix_spawn_file_actions_addclose(&mut actions.0, fd)
+                },
+                FdOp::Dup2(fd, fd2) => unsafe {
+                    libc::posix_spawn_file_actions_adddup2(&mut actions.0, fd, fd2)
+                },
+                // glibc clears close-on-exec when dup'ing an fd to itself.
+                FdOp::ClearCloexec(fd) => unsafe {
+                    libc::posix_spawn_file_actions_adddup2(&mut actions.0, fd, fd)
+                },
+                // There's no file action for this.  Instead, with fd hygiene,
+                // all inherited fds are marked close-on-exec at startup.
+                FdOp::CloexecRange(..) => 0,
+            })?;
+        }
+        Ok(actions)
+    }
+}
+
+impl Drop for FileActions {
+    fn drop(&mut self) {
+        unsafe { libc::posix_spawn_file_actions_destroy(&mut self.0) };
+    }
+}
+
+/// Spawns a child process that carries out `plan`.  Returns the child pid.
+pub fn posix_spawn(plan: &LaunchPlan) -> io::Result<pid_t> {
+    let actions = FileActions::new(&plan.fd_ops)?;
+
+    let mut pid: pid_t = -1;
+    check(unsafe {
+        libc::posix_spawn(
+            &mut pid,
+            plan.exec.exe.as_ptr(),
+            &actions.0,
+            std::ptr::null(),
+            plan.exec.argv.as_ptr() as *const *mut c_char,
+            plan.exec.envp.as_ptr() as *const *mut c_char,
+        )
+    })?;
+    Ok(pid)
+}
@@ -47,7 +47,7 @@ type Result<T> = std::result::Result<T, Error>;
 // Env spec
 //------------------------------------------------------------------------------
 
-#[derive(Serialize, Debug, PartialEq)]
+#[derive(Serialize, Debug, PartialEq, Eq, Hash)]
 #[serde(deny_unknown_fields)]
 pub enum EnvInherit {
     None,
@@ -98,7 +98,7 @@ impl<'de> Deserialize<'de> for EnvInherit {
     }
 }
 
-#[derive(Serialize, Deserialize, Default, Debug, PartialEq)]
+#[derive(Serialize, Deserialize, Default, Debug, PartialEq, Eq, Hash)]
 #[serde(deny_unknown_fields, default)]
 pub struct Env {
     pub inherit: EnvInherit,
@@ -145,6 +145,12 @@ impl Default for OpenFlag {
 pub enum CaptureMode {
     TempFile,
     Memory,
+    /// In memory, until output exceeds `spill_size`; then in a temp file.
+    Spill,
+    /// In a memfd, or a temp file if memfds are unavailable.
+    Memfd,
+    /// In a temp file, spliced from a pipe.
+    Splice,
 }
 
 impl Default for CaptureMode {
@@ -153,6 +159,13 @@ impl Default for CaptureMode {
     }
 }
 
+#[derive(Debug, Serialize, Deserialize, Clone, Copy)]
+#[serde(deny_unknown_fields)]
+#[serde(rename_all = "lowercase")]
+pub enum Compression {
+    Gzip,
+}
+
 #[derive(Debug, Serialize, Deserialize, Clone, Copy)]
 #[serde(deny_unknown_fields)]
 #[serde(rename_all = "lowercase")]
@@ -207,6 +220,25 @@ pub enum Fd {
 
         #[serde(default)]
         format: CaptureFormat,
+
+        /// If given, keep only this many bytes from the start of the output,
+        /// plus the `tail`.
+        head: Option<usize>,
+
+        /// If given, keep only this many bytes from the end of the output,
+        /// plus the `head`.
+        tail: Option<usize>,
+
+        /// In spill mode, the size of output past which it is moved from
+        /// memory to a temp file.
+        spill_size: Option<usize>,
+
+        /// In memory, spill, and splice modes, the capacity of the capture
+        /// pipe; if none, the server default.
+        pipe_size: Option<usize>,
+
+        /// In memory and spill modes, if given, compress output as it arrives.
+        compress: Option<Compression>,
     },
 }
 
@@ -228,6 +260,8 @@ pub struct Proc {
     pub argv: Vec<String>,
     pub env: Env,
     pub fds: Vec<(String, Fd)>,
+    /// Arbitrary key-value pairs, for selecting procs.
+    pub labels: BTreeMap<String, String>,
 }
 
 //------------------------------------------------------------------------------
@@ -1,16 +1,15 @@
 extern crate libc;
 
 use libc::{c_int, pid_t, rusage, ssize_t};
-use std::ffi::CString;
+use std::ffi::{CStr, CString};
 use std::io;
 use std::mem::MaybeUninit;
-use std::os::fd::RawFd;
+use std::os::fd::{FromRawFd, OwnedFd, RawFd};
 use std::path::{Path, PathBuf};
 use std::string::String;
+use std::sync::Arc;
 use std::vec::Vec;
 
-use crate::environ::Env;
-
 #[allow(non_camel_case_types)]
 pub type fd_t = c_int;
 
@@ -18,34 +17,38 @@ pub type fd_t = c_int;
 
 /// C-style char* array, containing a NULL-terminated array of pointers to
 /// nul-terminated strings.
-struct CStringVec {
-    // Nul-terminated strings.
+pub(crate) struct CStringVec {
+    // Nul-terminated strings, possibly shared.
     // FIXME: We need to keep this around as it stores the actual strings
     // pointed to by `ptrs`, but Rust doesn't know this.  Should figure out how
     // to tell it.
     #[allow(dead_code)]
-    strs: Vec<CString>,
+    strs: Vec<Arc<CStr>>,
 
     // NULL-terminated vector of char* pointers.
     ptrs: Vec<*const i8>,
 }
 
 impl CStringVec {
-    pub fn as_ptr(&self) -> *const *const i8 {
-        self.ptrs.as_ptr() as *const *const i8
-    }
-}
-
-impl<T> From<T> for CStringVec
-where
-    T: IntoIterator<Item = String>,
-{
-    fn from(strings: T) -> Self {
+    /// Builds from strings, or fails if any contains a nul character.
+    pub fn new<T>(strings: T) -> io::Result<Self>
+    where
+        T: IntoIterator<Item = String>,
+    {
         // Build nul-terminated strings.
         let strs = strings
             .into_iter()
-            .map(|s| CString::new(s).unwrap())
-            .collect::<Vec<_>>();
+            .map(|s| CString::new(s).map(Arc::from))
+            .collect::<Result<Vec<_>, _>>()?;
+        Ok(Self::from_shared(strs))
+    }
+
+    /// Builds from shared nul-terminated strings, without copying them.
+    pub fn from_shared<T>(strings: T) -> Self
+    where
+        T: IntoIterator<Item = Arc<CStr>>,
+    {
+        let strs = strings.into_iter().collect::<Vec<_>>();
 
         // Grab their pointers into an array.
         let mut ptrs = strs
@@ -57,10 +60,37 @@ where
 
         Self { strs, ptrs }
     }
+
+    pub fn as_ptr(&self) -> *const *const i8 {
+        self.ptrs.as_ptr() as *const *const i8
+    }
+
+    pub fn iter(&self) -> impl Iterator<Item = &CStr> {
+        self.strs.iter().map(|s| s.as_ref())
+    }
+}
+
+// The pointers refer into `strs`, which is immutable and owned, so the vec may
+// be shared among threads.
+unsafe impl Send for CStringVec {}
+unsafe impl Sync for CStringVec {}
+
+impl<T> From<T> for CStringVec
+where
+    T: IntoIterator<Item = String>,
+{
+    fn from(strings: T) -> Self {
+        Self::new(strings).unwrap()
+    }
 }
 
 //------------------------------------------------------------------------------
 
+/// Returns the current errno.  Doesn't allocate.
+pub fn errno() -> c_int {
+    io::Error::last_os_error().raw_os_error().unwrap_or(0)
+}
+
 pub fn close(fd: fd_t) -> io::Result<()> {
     let res = unsafe { libc::close(fd) };
     match res {
@@ -86,26 +116,6 @@ pub fn execv(exe: String, args: Vec<String>) -> io::Result<()> {
     Err(io::Error::last_os_error())
 }
 
-pub fn execve(exe: String, args: Vec<String>, env: Env) -> io::Result<()> {
-    // Construct NAME=val strings for env vars.
-    let env: Vec<String> = env
-        .into_iter()
-        .map(|(n, v)| format!("{}={}", n, v))
-        .collect();
-
-    let exe = CString::new(exe).unwrap();
-    let res = unsafe {
-        libc::execve(
-            exe.as_ptr() as *const i8,
-            CStringVec::from(args).as_ptr(),
-            CStringVec::from(env).as_ptr(),
-        )
-    };
-    // execve only returns on failure, with result -1.
-    assert!(res == -1);
-    Err(io::Error::last_os_error())
-}
-
 pub fn fork() -> io::Result<pid_t> {
     let child_pid = unsafe { libc::fork() };
     assert!(child_pid >= -1);
@@ -120,11 +130,12 @@ pub fn getpid() -> pid_t {
     unsafe { libc::getpid() }
 }
 
+/// Creates and opens a temporary file.  The fd is close-on-exec.
 pub fn mkstemp(template: &str) -> io::Result<(PathBuf, fd_t)> {
     let path = CString::new(template)?;
     let (fd, path) = unsafe {
         let ptr = path.into_raw();
-        (libc::mkstemp(ptr), CString::from_raw(ptr))
+        (libc::mkostemp(ptr, libc::O_CLOEXEC), CString::from_raw(ptr))
     };
     match fd {
         -1 => Err(io::Error::last_os_error()),
@@ -145,12 +156,12 @@ pub fn open(path: &Path, oflag: c_int, mode: c_int) -> io::Result<fd_t> {
     }
 }
 
-/// Creates an anonymous pipe.
+/// Creates an anonymous pipe.  Both ends are close-on-exec.
 ///
 /// Returns the read and write file descriptors of the ends of the pipe.
 pub fn pipe() -> io::Result<(RawFd, RawFd)> {
     let mut fildes: Vec<fd_t> = vec![-1, 2];
-    match unsafe { libc::pipe(fildes.as_mut_ptr()) } {
+    match unsafe { libc::pipe2(fildes.as_mut_ptr(), libc::O_CLOEXEC) } {
         -1 => Err(io::Error::last_os_error()),
         0 => Ok((fildes[0], fildes[1])),
         ret => panic!("pipe returned {}", ret),
@@ -237,6 +248,42 @@ pub fn fcntl_setfd(fd: RawFd, flags: i32) -> io::Result<()> {
     }
 }
 
+/// Flag for close_range(2), from linux/close_range.h.
+const CLOSE_RANGE_CLOEXEC: libc::c_uint = 1 << 2;
+
+/// Marks fds `first` through `last`, inclusive, close-on-exec.  Skips fds that
+/// aren't open.  Doesn't allocate, so this is safe to call in the child process
+/// after `fork()`.
+pub fn cloexec_range(first: RawFd, last: RawFd) -> io::Result<()> {
+    let res = unsafe {
+        libc::syscall(
+            libc::SYS_close_range,
+            first as libc::c_uint,
+            last as libc::c_uint,
+            CLOSE_RANGE_CLOEXEC,
+        )
+    };
+    match res {
+        0 => Ok(()),
+        -1 if matches!(errno(), libc::ENOSYS | libc::EINVAL) => {
+            // close_range() or its CLOEXEC flag isn't supported by this kernel.
+            // Fall back to marking fds one at a time, up to the fd limit.
+            let mut rlim = MaybeUninit::<libc::rlimit>::uninit();
+            let max_fd = match unsafe { libc::getrlimit(libc::RLIMIT_NOFILE, rlim.as_mut_ptr()) } {
+                0 => unsafe { rlim.assume_init() }.rlim_cur.min(RawFd::MAX as u64) as RawFd - 1,
+                _ => return Err(io::Error::last_os_error()),
+            };
+            for fd in first..=last.min(max_fd) {
+                // Ignore EBADF for fds that aren't open.
+                unsafe { libc::fcntl(fd, libc::F_SETFD, libc::FD_CLOEXEC) };
+            }
+            Ok(())
+        }
+        -1 => Err(io::Error::last_os_error()),
+        ret => panic!("close_range returned {}", ret),
+    }
+}
+
 pub fn set_cloexec(fd: RawFd) -> io::Result<()> {
     let flags = fcntl_getfd(fd)?;
     return if flags & libc::FD_CLOEXEC == 0 {
@@ -257,3 +304,281 @@ pub fn kill(pid: pid_t, signum: c_int) -> io::Result<()> {
     }
 }
 
+//------------------------------------------------------------------------------
+
+/// Opens a pidfd referring to process `pid`.  The pidfd polls readable once
+/// the process terminates.
+pub fn pidfd_open(pid: pid_t) -> io::Result<fd_t> {
+    match unsafe { libc::syscall(libc::SYS_pidfd_open, pid, 0) } {
+        -1 => Err(io::Error::last_os_error()),
+        fd if fd >= 0 => Ok(fd as fd_t),
+        ret => panic!("pidfd_open returned {}", ret),
+    }
+}
+
+/// Sends a signal to the process referred to by `pidfd`.  Unlike `kill`, this
+/// can't signal an unrelated process that has reused the pid.
+pub fn pidfd_send_signal(pidfd: fd_t, signum: c_int) -> io::Result<()> {
+    match unsafe {
+        libc::syscall(
+            libc::SYS_pidfd_send_signal,
+            pidfd,
+            signum,
+            std::ptr::null::<libc::siginfo_t>(),
+            0,
+        )
+    } {
+        -1 => Err(io::Error::last_os_error()),
+        0 => Ok(()),
+        ret => panic!("pidfd_send_signal returned {}", ret),
+    }
+}
+
+
+//------------------------------------------------------------------------------
+
+/// Creates a connected pair of close-on-exec Unix sockets of `type_`.
+pub fn socketpair(type_: c_int) -> io::Result<(OwnedFd, OwnedFd)> {
+    let mut fds: [c_int; 2] = [-1, -1];
+    match unsafe {
+        libc::socketpair(libc::AF_UNIX, type_ | libc::SOCK_CLOEXEC, 0, fds.as_mut_ptr())
+    } {
+        -1 => Err(io::Error::last_os_error()),
+        0 => Ok(unsafe { (OwnedFd::from_raw_fd(fds[0]), OwnedFd::from_raw_fd(fds[1])) }),
+        ret => panic!("socketpair returned {}", ret),
+    }
+}
+
+/// Sends `data` on socket `sock` as a single message, passing `fds` along with
+/// it with `SCM_RIGHTS`.
+pub fn send_fds(sock: RawFd, data: &[u8], fds: &[RawFd]) -> io::Result<usize> {
+    let mut iov = libc::iovec {
+        iov_base: data.as_ptr() as *mut libc::c_void,
+        iov_len: data.len(),
+    };
+    let mut msg: libc::msghdr = unsafe { std::mem::zeroed() };
+    msg.msg_iov = &mut iov;
+    msg.msg_iovlen = 1;
+
+    // Control buffer, aligned for cmsghdr.
+    let mut cbuf = Vec::<u64>::new();
+    if !fds.is_empty() {
+        let fds_len = std::mem::size_of_val(fds);
+        let space = unsafe { libc::CMSG_SPACE(fds_len as u32) } as usize;
+        cbuf.resize((space + 7) / 8, 0);
+        msg.msg_control = cbuf.as_mut_ptr() as *mut libc::c_void;
+        msg.msg_controllen = space as _;
+        unsafe {
+            let cmsg = libc::CMSG_FIRSTHDR(&msg);
+            (*cmsg).cmsg_level = libc::SOL_SOCKET;
+            (*cmsg).cmsg_type = libc::SCM_RIGHTS;
+            (*cmsg).cmsg_len = libc::CMSG_LEN(fds_len as u32) as _;
+            std::ptr::copy_nonoverlapping(
+                fds.as_ptr() as *const u8,
+                libc::CMSG_DATA(cmsg),
+                fds_len,
+            );
+        }
+    }
+
+    match unsafe { libc::sendmsg(sock, &msg, libc::MSG_NOSIGNAL) } {
+        -1 => Err(io::Error::last_os_error()),
+        n if n >= 0 => Ok(n as usize),
+        ret => panic!("sendmsg returned {}", ret),
+    }
+}
+
+/// Receives a single message from socket `sock` into `buf`, along with up to
+/// `max_fds` fds passed with `SCM_RIGHTS`.  The received fds are close-on-exec.
+/// Fails if the message or fds don't fit.
+pub fn recv_fds(sock: RawFd, buf: &mut [u8], max_fds: usize) -> io::Result<(usize, Vec<OwnedFd>)> {
+    let mut iov = libc::iovec {
+        iov_base: buf.as_mut_ptr() as *mut libc::c_void,
+        iov_len: buf.len(),
+    };
+    let mut msg: libc::msghdr = unsafe { std::mem::zeroed() };
+    msg.msg_iov = &mut iov;
+    msg.msg_iovlen = 1;
+
+    let space = unsafe { libc::CMSG_SPACE((max_fds * std::mem::size_of::<c_int>()) as u32) };
+    let mut cbuf = vec![0u64; (space as usize + 7) / 8];
+    msg.msg_control = cbuf.as_mut_ptr() as *mut libc::c_void;
+    msg.msg_controllen = space as _;
+
+    let len = match unsafe { libc::recvmsg(sock, &mut msg, libc::MSG_CMSG_CLOEXEC) } {
+        -1 => return Err(io::Error::last_os_error()),
+        n if n >= 0 => n as usize,
+        ret => panic!("recvmsg returned {}", ret),
+    };
+
+    // Take ownership of received fds first, so they're closed on error.
+    let mut fds = Vec::new();
+    let mut cmsg = unsafe { libc::CMSG_FIRSTHDR(&msg) };
+    while !cmsg.is_null() {
+        let (level, type_, cmsg_len) =
+            unsafe { ((*cmsg).cmsg_level, (*cmsg).cmsg_type, (*cmsg).cmsg_len as usize) };
+        if level == libc::SOL_SOCKET && type_ == libc::SCM_RIGHTS {
+            let data = unsafe { libc::CMSG_DATA(cmsg) } as *const c_int;
+            let num = (cmsg_len - unsafe { libc::CMSG_LEN(0) } as usize)
+                / std::mem::size_of::<c_int>();
+            for i in 0..num {
+                let fd = unsafe { std::ptr::read_unaligned(data.add(i)) };
+                fds.push(unsafe { OwnedFd::from_raw_fd(fd) });
+            }
+        }
+        cmsg = unsafe { libc::CMSG_NXTHDR(&msg, cmsg) };
+    }
+
+    if msg.msg_flags & (libc::MSG_TRUNC | libc::MSG_CTRUNC) != 0 {
+        Err(io::Error::new(io::ErrorKind::InvalidData, "message truncated"))
+    } else {
+        Ok((len, fds))
+    }
+}
+
+//------------------------------------------------------------------------------
+
+/// Creates an anonymous memory-backed file.  The fd is close-on-exec, and
+/// allows sealing.
+pub fn memfd_create(name: &str) -> io::Result<fd_t> {
+    let name = CString::new(name)?;
+    match unsafe { libc::memfd_create(name.as_ptr(), libc::MFD_CLOEXEC | libc::MFD_ALLOW_SEALING) } {
+        -1 => Err(io::Error::last_os_error()),
+        fd if fd >= 0 => Ok(fd),
+        ret => panic!("memfd_create returned {}", ret),
+    }
+}
+
+/// Adds `seals` to a memfd.
+pub fn add_seals(fd: fd_t, seals: c_int) -> io::Result<()> {
+    match unsafe { libc::fcntl(fd, libc::F_ADD_SEALS, seals) } {
+        -1 => Err(io::Error::last_os_error()),
+        _ => Ok(()),
+    }
+}
+
+/// Returns the size of the file open at `fd`.
+pub fn file_size(fd: fd_t) -> io::Result<usize> {
+    let mut stat = MaybeUninit::<libc::stat>::uninit();
+    match unsafe { libc::fstat(fd, stat.as_mut_ptr()) } {
+        -1 => Err(io::Error::last_os_error()),
+        _ => Ok(unsafe { stat.assume_init() }.st_size as usize),
+    }
+}
+
+/// A read-only shared memory map of the start of a file.
+///
+/// Accessing the map past the end of the file raises SIGBUS, so only map files
+/// that can't shrink.
+pub struct Mmap {
+    ptr: *mut libc::c_void,
+    len: usize,
+}
+
+impl Mmap {
+    /// Maps the first `len` bytes of the file open at `fd`.
+    pub fn new(fd: fd_t, len: usize) -> io::Result<Self> {
+        let ptr = if len == 0 {
+            // mmap() rejects empty maps.
+            std::ptr::null_mut()
+        } else {
+            match unsafe {
+                libc::mmap(std::ptr::null_mut(), len, libc::PROT_READ, libc::MAP_SHARED, fd, 0)
+            } {
+                libc::MAP_FAILED => return Err(io::Error::last_os_error()),
+                ptr => ptr,
+            }
+        };
+        Ok(Self { ptr, len })
+    }
+}
+
+impl std::ops::Deref for Mmap {
+    type Target = [u8];
+
+    fn deref(&self) -> &[u8] {
+        if self.len == 0 {
+            &[]
+        } else {
+            unsafe { std::slice::from_raw_parts(self.ptr as *const u8, self.len) }
+        }
+    }
+}
+
+impl Drop for Mmap {
+    fn drop(&mut self) {
+        if self.len > 0 {
+            unsafe { libc::munmap(self.ptr, self.len) };
+        }
+    }
+}
+
+//------------------------------------------------------------------------------
+
+const PATH_PIPE_MAX_SIZE: &str = "/proc/sys/fs/pipe-max-size";
+
+/// Returns the largest size to which an unprivileged process may grow a pipe.
+pub fn pipe_max_size() -> io::Result<usize> {
+    std::fs::read_to_string(PATH_PIPE_MAX_SIZE)?
+        .trim()
+        .parse::<usize>()
+        .map_err(|err| io::Error::new(io::ErrorKind::InvalidData, err))
+}
+
+/// Sets the capacity of a pipe to at least `size`.  Returns the capacity, which
+/// the kernel rounds up to a power-of-two number of pages.
+pub fn set_pipe_size(fd: fd_t, size: usize) -> io::Result<usize> {
+    match unsafe { libc::fcntl(fd, libc::F_SETPIPE_SZ, size as c_int) } {
+        -1 => Err(io::Error::last_os_error()),
+        size if size > 0 => Ok(size as usize),
+        ret => panic!("fcntl F_SETPIPE_SZ returned {}", ret),
+    }
+}
+
+/// Moves up to `len` bytes from `fd_in` to `fd_out`, at least one of which
+/// must be a pipe, without copying through user space.  Returns the number of
+/// bytes moved, or zero at EOF.
+pub fn splice(fd_in: fd_t, fd_out: fd_t, len: usize, flags: libc::c_uint) -> io::Result<usize> {
+    let ptr = std::ptr::null_mut();
+    match unsafe { libc::splice(fd_in, ptr, fd_out, ptr, len, flags) } {
+        -1 => Err(io::Error::last_os_error()),
+        n if n >= 0 => Ok(n as usize),
+        ret => panic!("splice returned {}", ret),
+    }
+}
+
+/// Duplicates up to `len` bytes from pipe `fd_in` to pipe `fd_out`, without
+/// consuming them.  Returns the number of bytes duplicated, or zero at EOF.
+pub fn tee(fd_in: fd_t, fd_out: fd_t, len: usize, flags: libc::c_uint) -> io::Result<usize> {
+    match unsafe { libc::tee(fd_in, fd_out, len, flags) } {
+        -1 => Err(io::Error::last_os_error()),
+        n if n >= 0 => Ok(n as usize),
+        ret => panic!("tee returned {}", ret),
+    }
+}
+
+/// Puts the file description of `fd` in nonblocking mode.
+pub fn set_nonblocking(fd: fd_t) -> io::Result<()> {
+    let flags = unsafe { libc::fcntl(fd, libc::F_GETFL) };
+    if flags == -1 || unsafe { libc::fcntl(fd, libc::F_SETFL, flags | libc::O_NONBLOCK) } == -1 {
+        Err(io::Error::last_os_error())
+    } else {
+        Ok(())
+    }
+}
+
+/// Deallocates `len` bytes of the file open at `fd` at `offset`, without
+/// changing its size.  The range reads as zeros.
+pub fn punch_hole(fd: fd_t, offset: u64, len: usize) -> io::Result<()> {
+    match unsafe {
+        libc::fallocate(
+            fd,
+            libc::FALLOC_FL_PUNCH_HOLE | libc::FALLOC_FL_KEEP_SIZE,
+            offset as libc::off_t,
+            len as libc::off_t,
+        )
+    } {
+        -1 => Err(io::Error::last_os_error()),
+        _ => Ok(()),
+    }
+}
@@ -0,0 +1,532 @@
+use libc::{c_int, pid_t, rusage};
+use std::collections::VecDeque;
+use std::ffi::CString;
+use std::io;
+use std::mem::MaybeUninit;
+use std::os::fd::{AsRawFd, FromRawFd, OwnedFd, RawFd};
+use std::sync::atomic::{AtomicBool, Ordering};
+use std::sync::{Arc, Mutex};
+use tokio::io::unix::AsyncFd;
+use tokio::sync::oneshot;
+
+use crate::err_pipe::{ErrorPipe, ErrorWriter};
+use crate::fd::FdOp;
+use crate::launch::{ExecPlan, LaunchPlan};
+use crate::reaper::Reaper;
+use crate::sys::{self, CStringVec};
+
+//------------------------------------------------------------------------------
+
+// The zygote is a helper process, forked at startup before the runtime
+// exists, while this process is still small.  It receives launch requests on a
+// Unix seqpacket socket, forks and execs procs, and reports back their pids
+// and pidfds, and later their wait info.
+//
+// A launch request carries the launch plan, fully resolved, along with the fds
+// the child needs: the error pipe first, then the sources of the fd ops, which
+// refer to them by index.  The zygote responds to requests in order.
+
+/// Max length of a launch request.
+const MAX_REQUEST_LEN: usize = 1 << 20;
+/// Max number of fds passed with a launch request; the kernel's limit.
+const MAX_FDS: usize = 253;
+
+const OP_CLOSE: u8 = 0;
+const OP_DUP2: u8 = 1;
+const OP_CLOEXEC_RANGE: u8 = 2;
+
+/// The proc started; carries its pid and pidfd, if available.
+const RSP_STARTED: u32 = 0;
+/// The proc didn't start; carries errno.
+const RSP_FAILED: u32 = 1;
+/// A proc terminated; carries its wait info.
+const RSP_EXITED: u32 = 2;
+
+const RESPONSE_LEN: usize = 12 + std::mem::size_of::<rusage>();
+
+fn invalid(msg: &str) -> io::Error {
+    io::Error::new(io::ErrorKind::InvalidData, msg)
+}
+
+struct Encoder(Vec<u8>);
+
+impl Encoder {
+    fn u32(&mut self, val: u32) {
+        self.0.extend_from_slice(&val.to_le_bytes());
+    }
+
+    fn i32(&mut self, val: i32) {
+        self.0.extend_from_slice(&val.to_le_bytes());
+    }
+
+    fn bytes(&mut self, bytes: &[u8]) {
+        self.u32(bytes.len() as u32);
+        self.0.extend_from_slice(bytes);
+    }
+
+    fn strs(&mut self, strs: &CStringVec) {
+        self.u32(strs.iter().count() as u32);
+        for s in strs.iter() {
+            self.bytes(s.to_bytes());
+        }
+    }
+}
+
+struct Decoder<'a>(&'a [u8]);
+
+impl<'a> Decoder<'a> {
+    fn take(&mut self, len: usize) -> io::Result<&'a [u8]> {
+        if self.0.len() < len {
+            return Err(invalid("truncated launch request"));
+        }
+        let (head, rest) = self.0.split_at(len);
+        self.0 = rest;
+        Ok(head)
+    }
+
+    fn u8(&mut self) -> io::Result<u8> {
+        Ok(self.take(1)?[0])
+    }
+
+    fn u32(&mut self) -> io::Result<u32> {
+        Ok(u32::from_le_bytes(self.take(4)?.try_into().unwrap()))
+    }
+
+    fn i32(&mut self) -> io::Result<i32> {
+        Ok(i32::from_le_bytes(self.take(4)?.try_into().unwrap()))
+    }
+
+    fn bytes(&mut self) -> io::Result<&'a [u8]> {
+        let len = self.u32()? as usize;
+        self.take(len)
+    }
+
+    fn cstring(&mut self) -> io::Result<CString> {
+        Ok(CString::new(self.bytes()?)?)
+    }
+
+    fn strs(&mut self) -> io::Result<CStringVec> {
+        let num = self.u32()?;
+        let strs = (0..num)
+            .map(|_| self.cstring().map(Arc::from))
+            .collect::<io::Result<Vec<_>>>()?;
+        Ok(CStringVec::from_shared(strs))
+    }
+}
+
+/// Encodes a launch request for `plan`.  Returns the request and the fds to
+/// pass with it.
+fn encode_request(plan: &LaunchPlan, error_fd: RawFd) -> (Vec<u8>, Vec<RawFd>) {
+    let mut fds = vec![error_fd];
+    let mut enc = Encoder(Vec::new());
+
+    let exec = &plan.exec;
+    enc.bytes(exec.exe.as_bytes());
+    enc.strs(&exec.argv);
+    enc.strs(&exec.envp);
+    enc.bytes(&exec.exec_error);
+
+    let mut ops = Vec::new();
+    for (fd_op, error) in plan.fd_ops.iter().zip(plan.fd_op_errors.iter()) {
+        let (op, a, b) = match *fd_op {
+            FdOp::Close(fd) => (OP_CLOSE, fd, 0),
+            FdOp::Dup2(fd, fd2) => {
+                fds.push(fd);
+                (OP_DUP2, fds.len() as i32 - 1, fd2)
+            }
+            FdOp::ClearCloexec(fd) => {
+                // The fd is ours, not the zygote's, so pass it along.  If we
+                // don't have it open, there's nothing to inherit.
+                if sys::fcntl_getfd(fd).is_err() {
+                    continue;
+                }
+                fds.push(fd);
+                (OP_DUP2, fds.len() as i32 - 1, fd)
+            }
+            FdOp::CloexecRange(first, last) => (OP_CLOEXEC_RANGE, first, last),
+        };
+        ops.push((op, a, b, error));
+    }
+    enc.u32(ops.len() as u32);
+    for (op, a, b, error) in ops {
+        enc.0.push(op);
+        enc.i32(a);
+        enc.i32(b);
+        enc.bytes(error);
+    }
+
+    (enc.0, fds)
+}
+
+/// Duplicates `fd` to the lowest fd number not less than `min_fd`.
+fn dup_above(fd: OwnedFd, min_fd: RawFd) -> io::Result<OwnedFd> {
+    match unsafe { libc::fcntl(fd.as_raw_fd(), libc::F_DUPFD_CLOEXEC, min_fd) } {
+        -1 => Err(io::Error::last_os_error()),
+        new_fd => Ok(unsafe { OwnedFd::from_raw_fd(new_fd) }),
+    }
+}
+
+/// Decodes a launch request, with the fds passed with it.  Returns the launch
+/// plan, and the fds, which must remain open until after forking.
+fn decode_request(req: &[u8], fds: Vec<OwnedFd>) -> io::Result<(LaunchPlan, Vec<OwnedFd>)> {
+    let mut dec = Decoder(req);
+    let exe = dec.cstring()?;
+    let argv = dec.strs()?;
+    let envp = dec.strs()?;
+    let exec_error = dec.bytes()?.to_vec();
+    let ops = (0..dec.u32()?)
+        .map(|_| Ok((dec.u8()?, dec.i32()?, dec.i32()?, dec.bytes()?.to_vec())))
+        .collect::<io::Result<Vec<_>>>()?;
+    if !dec.0.is_empty() {
+        return Err(invalid("trailing data in launch request"));
+    }
+
+    // Move the passed fds above any fd the ops touch, so that setting up one
+    // fd in the child doesn't clobber the source of another, or the error pipe.
+    let min_fd = ops
+        .iter()
+        .map(|(op, a, b, _)| match *op {
+            OP_CLOSE => *a,
+            OP_DUP2 => *b,
+            _ => 0,
+        })
+        .max()
+        .unwrap_or(0)
+        .max(2)
+        + 1;
+    let fds = fds
+        .into_iter()
+        .map(|fd| dup_above(fd, min_fd))
+        .collect::<io::Result<Vec<_>>>()?;
+    if fds.is_empty() {
+        return Err(invalid("no error pipe in launch request"));
+    }
+
+    let mut fd_ops = Vec::with_capacity(ops.len());
+    let mut fd_op_errors = Vec::with_capacity(ops.len());
+    for (op, a, b, error) in ops {
+        fd_ops.push(match op {
+            OP_CLOSE => FdOp::Close(a),
+            OP_DUP2 => {
+                let fd = fds
+                    .get(a as usize)
+                    .ok_or_else(|| invalid("bad fd index in launch request"))?;
+                FdOp::Dup2(fd.as_raw_fd(), b)
+            }
+            OP_CLOEXEC_RANGE => FdOp::CloexecRange(a, b),
+            _ => return Err(invalid("bad fd op in launch request")),
+        });
+        fd_op_errors.push(error);
+    }
+
+    let plan = LaunchPlan {
+        exec: Arc::new(ExecPlan {
+            exe,
+            argv,
+            envp,
+            exec_error,
+        }),
+        fd_ops,
+        fd_op_errors,
+    };
+    Ok((plan, fds))
+}
+
+fn encode_response(kind: u32, pid: pid_t, status: c_int, usage: Option<&rusage>) -> Vec<u8> {
+    let mut rsp = Vec::with_capacity(RESPONSE_LEN);
+    rsp.extend_from_slice(&kind.to_le_bytes());
+    rsp.extend_from_slice(&pid.to_le_bytes());
+    rsp.extend_from_slice(&status.to_le_bytes());
+    match usage {
+        Some(usage) => rsp.extend_from_slice(unsafe {
+            std::slice::from_raw_parts(
+                usage as *const rusage as *const u8,
+                std::mem::size_of::<rusage>(),
+            )
+        }),
+        None => rsp.resize(RESPONSE_LEN, 0),
+    }
+    rsp
+}
+
+fn decode_response(rsp: &[u8; RESPONSE_LEN]) -> (u32, pid_t, c_int, rusage) {
+    let kind = u32::from_le_bytes(rsp[0..4].try_into().unwrap());
+    let pid = pid_t::from_le_bytes(rsp[4..8].try_into().unwrap());
+    let status = c_int::from_le_bytes(rsp[8..12].try_into().unwrap());
+    let usage = unsafe { std::ptr::read_unaligned(rsp[12..].as_ptr() as *const rusage) };
+    (kind, pid, status, usage)
+}
+
+//------------------------------------------------------------------------------
+// The zygote process.
+
+/// Sends a response to the server.  If the server is gone, so is our purpose.
+fn respond(sock: RawFd, rsp: &[u8], fds: &[RawFd]) {
+    if let Err(err) = sys::send_fds(sock, rsp, fds) {
+        if err.kind() != io::ErrorKind::BrokenPipe {
+            eprintln!("zygote: send failed: {}", err);
+        }
+        unsafe { libc::_exit(0) };
+    }
+}
+
+fn sigset(signums: &[c_int]) -> libc::sigset_t {
+    let mut set = MaybeUninit::<libc::sigset_t>::uninit();
+    unsafe {
+        libc::sigemptyset(set.as_mut_ptr());
+        for signum in signums {
+            libc::sigaddset(set.as_mut_ptr(), *signum);
+        }
+        set.assume_init()
+    }
+}
+
+/// Handles a launch request.
+fn launch(sock: RawFd, req: &[u8], fds: Vec<OwnedFd>) {
+    let (plan, fds) = match decode_request(req, fds) {
+        Ok(plan) => plan,
+        Err(err) => {
+            let errno = err.raw_os_error().unwrap_or(libc::EINVAL);
+            return respond(sock, &encode_response(RSP_FAILED, 0, errno, None), &[]);
+        }
+    };
+
+    match sys::fork() {
+        Ok(0) => {
+            // Restore the signal mask, which the program would inherit.
+            let empty = sigset(&[]);
+            unsafe { libc::sigprocmask(libc::SIG_SETMASK, &empty, std::ptr::null_mut()) };
+            plan.exec_child(ErrorWriter::from_raw_fd(fds[0].as_raw_fd()))
+        }
+        Ok(pid) => {
+            // Close our copies of the fds, so that the server sees EOF on the
+            // error pipe once the child execs.
+            drop(fds);
+            let pidfd = sys::pidfd_open(pid)
+                .ok()
+                .map(|fd| unsafe { OwnedFd::from_raw_fd(fd) });
+            let pidfds = pidfd.iter().map(|fd| fd.as_raw_fd()).collect::<Vec<_>>();
+            respond(sock, &encode_response(RSP_STARTED, pid, 0, None), &pidfds);
+        }
+        Err(err) => {
+            let errno = err.raw_os_error().unwrap_or(libc::EAGAIN);
+            respond(sock, &encode_response(RSP_FAILED, 0, errno, None), &[]);
+        }
+    }
+}
+
+/// Reaps all terminated children, without blocking, and reports them.
+fn reap(sock: RawFd) {
+    loop {
+        match sys::wait4(-1, false) {
+            Ok(Some((pid, status, usage))) => {
+                respond(sock, &encode_response(RSP_EXITED, pid, status, Some(&usage)), &[])
+            }
+            Ok(None) => break,
+            Err(ref err) if err.raw_os_error() == Some(libc::ECHILD) => break,
+            Err(ref err) if err.kind() == io::ErrorKind::Interrupted => continue,
+            Err(err) => panic!("wait4 failed: {}", err),
+        }
+    }
+}
+
+/// Runs the zygote, until the server closes the socket.
+fn serve(sock: OwnedFd) -> ! {
+    let sock = sock.as_raw_fd();
+
+    // Receive SIGCHLD through a signalfd, instead of a handler.
+    let sigchld = sigset(&[libc::SIGCHLD]);
+    let sigfd = unsafe {
+        libc::sigprocmask(libc::SIG_BLOCK, &sigchld, std::ptr::null_mut());
+        libc::signalfd(-1, &sigchld, libc::SFD_CLOEXEC | libc::SFD_NONBLOCK)
+    };
+    if sigfd == -1 {
+        eprintln!("zygote: signalfd failed: {}", io::Error::last_os_error());
+        unsafe { libc::_exit(exitcode::OSERR) };
+    }
+
+    let mut buf = vec![0u8; MAX_REQUEST_LEN];
+    let mut siginfo = [0u8; std::mem::size_of::<libc::signalfd_siginfo>()];
+    loop {
+        let mut pollfds = [
+            libc::pollfd {
+                fd: sock,
+                events: libc::POLLIN,
+                revents: 0,
+            },
+            libc::pollfd {
+                fd: sigfd,
+                events: libc::POLLIN,
+                revents: 0,
+            },
+        ];
+        if unsafe { libc::poll(pollfds.as_mut_ptr(), 2, -1) } == -1 {
+            match sys::errno() {
+                libc::EINTR => continue,
+                errno => panic!("poll failed: {}", io::Error::from_raw_os_error(errno)),
+            }
+        }
+
+        if pollfds[1].revents != 0 {
+            // Drain the signalfd; SIGCHLDs coalesce anyway.
+            while sys::read(sigfd, &mut siginfo).is_ok() {}
+            reap(sock);
+        }
+
+        if pollfds[0].revents != 0 {
+            match sys::recv_fds(sock, &mut buf, MAX_FDS) {
+                // The server closed the socket.
+                Ok((0, _)) => unsafe { libc::_exit(0) },
+                Ok((len, fds)) => launch(sock, &buf[..len], fds),
+                Err(ref err) if err.kind() == io::ErrorKind::Interrupted => {}
+                Err(ref err) if err.kind() == io::ErrorKind::InvalidData => {
+                    // Truncated request.  Every request gets a response.
+                    respond(sock, &encode_response(RSP_FAILED, 0, libc::EMSGSIZE, None), &[]);
+                }
+                Err(err) => {
+                    eprintln!("zygote: recv failed: {}", err);
+                    unsafe { libc::_exit(exitcode::OSERR) };
+                }
+            }
+        }
+    }
+}
+
+/// Forks the zygote process, and returns the server end of its socket.  Must
+/// be called early, before starting the runtime or any other threads.
+pub fn fork_zygote() -> io::Result<OwnedFd> {
+    let (sock, zygote_sock) = sys::socketpair(libc::SOCK_SEQPACKET)?;
+    match sys::fork()? {
+        0 => {
+            drop(sock);
+            serve(zygote_sock)
+        }
+        _ => Ok(sock),
+    }
+}
+
+//------------------------------------------------------------------------------
+// The server side.
+
+type LaunchResult = io::Result<(pid_t, Option<OwnedFd>)>;
+
+struct Inner {
+    sock: AsyncFd<OwnedFd>,
+    /// Receives wait info of procs the zygote reports terminated.
+    reaper: Reaper,
+    /// Senders for responses to launch requests, in order of the requests.
+    /// Also serializes sending requests.
+    pending: Mutex<VecDeque<oneshot::Sender<LaunchResult>>>,
+    started: AtomicBool,
+    /// True if the zygote has exited, or the socket failed.
+    closed: AtomicBool,
+}
+
+/// Connection to the zygote process, which launches procs on our behalf.
+///
+/// Procs launched by the zygote are its children, not ours, so the zygote
+/// reaps them, and reports their wait info, which we dispatch to the reaper.
+#[derive(Clone)]
+pub struct Zygote(Arc<Inner>);
+
+impl Zygote {
+    /// Connects to the zygote through `sock`, from `fork_zygote()`.
+    pub fn new(sock: OwnedFd, reaper: Reaper) -> io::Result<Self> {
+        sys::set_nonblocking(sock.as_raw_fd())?;
+        Ok(Zygote(Arc::new(Inner {
+            sock: AsyncFd::new(sock)?,
+            reaper,
+            pending: Default::default(),
+            started: AtomicBool::new(false),
+            closed: AtomicBool::new(false),
+        })))
+    }
+
+    fn closed_error() -> io::Error {
+        io::Error::new(io::ErrorKind::NotConnected, "zygote exited")
+    }
+
+    async fn recv(&self, buf: &mut [u8]) -> io::Result<(usize, Vec<OwnedFd>)> {
+        loop {
+            let mut guard = self.0.sock.readable().await?;
+            match guard.try_io(|sock| sys::recv_fds(sock.as_raw_fd(), buf, 1)) {
+                Ok(result) => return result,
+                Err(_would_block) => continue,
+            }
+        }
+    }
+
+    async fn run(self) {
+        let mut buf = [0u8; RESPONSE_LEN];
+        let err = loop {
+            match self.recv(&mut buf).await {
+                Ok((0, _)) => break Self::closed_error(),
+                Ok((len, mut fds)) if len == RESPONSE_LEN => {
+                    let (kind, pid, status, usage) = decode_response(&buf);
+                    let result = match kind {
+                        RSP_EXITED => {
+                            self.0.reaper.dispatch((pid, status, usage));
+                            continue;
+                        }
+                        RSP_STARTED => Ok((pid, fds.pop())),
+                        RSP_FAILED => Err(io::Error::from_raw_os_error(status)),
+                        _ => break invalid("bad zygote response"),
+                    };
+                    if let Some(sender) = self.0.pending.lock().unwrap().pop_front() {
+                        _ = sender.send(result);
+                    }
+                }
+                Ok(_) => break invalid("bad zygote response"),
+                Err(err) => break err,
+            }
+        };
+
+        eprintln!("zygote: {}", err);
+        let mut pending = self.0.pending.lock().unwrap();
+        self.0.closed.store(true, Ordering::Release);
+        for sender in pending.drain(..) {
+            _ = sender.send(Err(io::Error::new(err.kind(), err.to_string())));
+        }
+    }
+
+    /// Starts the task that receives responses, if it isn't already running.
+    fn start(&self) {
+        if !self.0.started.swap(true, Ordering::AcqRel) {
+            tokio::spawn(self.clone().run());
+        }
+    }
+
+    /// Launches a proc in the zygote according to `plan`.  The child reports
+    /// errors through `error_pipe`.  Returns its pid, and its pidfd if the
+    /// zygote could open one.  Its wait info will be dispatched to the reaper.
+    pub async fn launch(&self, plan: &LaunchPlan, error_pipe: &ErrorPipe) -> LaunchResult {
+        if self.0.closed.load(Ordering::Acquire) {
+            return Err(Self::closed_error());
+        }
+        let (req, fds) = encode_request(plan, error_pipe.write_fd());
+        if req.len() > MAX_REQUEST_LEN || fds.len() > MAX_FDS {
+            return Err(io::Error::from_raw_os_error(libc::EMSGSIZE));
+        }
+        self.start();
+
+        let (sender, receiver) = oneshot::channel();
+        loop {
+            let mut guard = self.0.sock.writable().await?;
+            // Send and register for the response together, so that responses
+            // match requests in order.
+            let mut pending = self.0.pending.lock().unwrap();
+            match guard.try_io(|sock| sys::send_fds(sock.as_raw_fd(), &req, &fds)) {
+                Ok(result) => {
+                    result?;
+                    if self.0.closed.load(Ordering::Acquire) {
+                        return Err(Self::closed_error());
+                    }
+                    pending.push_back(sender);
+                    break;
+                }
+                Err(_would_block) => continue,
+            }
+        }
+        receiver.await.unwrap_or_else(|_| Err(Self::closed_error()))
+    }
+}
@@ -1,10 +1,15 @@
 import collections.abc
+import contextlib
 import json
 import logging
 import os
 from   pathlib import Path
+import socket
 import subprocess
 import tempfile
+import time
+import urllib.error
+import urllib.request
 
 log = logging.getLogger(__name__)
 
@@ -52,7 +57,7 @@ def _thunk_jso(o):
     return o
 
 
-def run(spec):
+def run(spec, *, args=(), pass_fds=()):
     spec = _thunk_jso(spec)
     with TemporaryDirectory() as tmp_dir:
         tmp_dir = Path(tmp_dir)
@@ -64,17 +69,19 @@ def run(spec):
             [
                 str(PROCSTAR_EXE),
                 "--output", output_path,
+                *args,
                 spec_path,
             ],
             stdout=subprocess.PIPE,
             env=os.environ | {"RUST_BACKTRACE": "1"},
+            pass_fds=pass_fds,
         )
         assert output_path.is_file()
         with open(output_path) as file:
             return json.load(file)
 
 
-def run1(spec, *, proc_id="test"):
+def run1(spec, *, proc_id="test", args=()):
     """
     Runs a single process and returns its results, if it ran successfully.
 
@@ -83,7 +90,7 @@ def run1(spec, *, proc_id="test"):
     :raise Errors:
       The process had errors.
     """
-    proc = run({"procs": {proc_id: spec}})[proc_id]
+    proc = run({"procs": {proc_id: spec}}, args=args)[proc_id]
     if len(proc["errors"]) == 0:
         return proc
     else:
@@ -96,3 +103,84 @@ def run_spec(name):
     return run(spec)
 
 
+#-------------------------------------------------------------------------------
+
+SERVER_ADDR = ("127.0.0.1", 3000)
+
+class Server:
+    """
+    Minimal synchronous HTTP client for a running Procstar server.
+    """
+
+    def __init__(self, addr=SERVER_ADDR):
+        self.addr = addr
+
+
+    def request(self, method, path, jso=None, headers={}):
+        """
+        Makes a request, and returns the status, headers, and body bytes.
+        """
+        host, port = self.addr
+        data = None if jso is None else json.dumps(_thunk_jso(jso)).encode()
+        headers = dict(headers)
+        if data is not None:
+            headers["content-type"] = "application/json"
+        req = urllib.request.Request(
+            f"http://{host}:{port}{path}",
+            method=method, data=data, headers=headers,
+        )
+        try:
+            with urllib.request.urlopen(req) as rsp:
+                return rsp.status, rsp.headers, rsp.read()
+        except urllib.error.HTTPError as err:
+            return err.code, err.headers, err.read()
+
+
+    def open(self, path, headers={}):
+        """
+        Makes a GET request and returns the response, to read its body as a
+        stream.
+        """
+        host, port = self.addr
+        req = urllib.request.Request(f"http://{host}:{port}{path}", headers=headers)
+        return urllib.request.urlopen(req, timeout=10)
+
+
+    def json(self, method, path, jso=None):
+        """
+        Makes a request and returns the status and JSON response.
+        """
+        status, _, body = self.request(method, path, jso)
+        return status, json.loads(body)
+
+
+
+def _wait_for_port(addr, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(addr, timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+@contextlib.contextmanager
+def serve(*, args=()):
+    """
+    Runs a Procstar server in a subprocess, for the duration of the context.
+    """
+    proc = subprocess.Popen(
+        [str(PROCSTAR_EXE), "--serve", *args],
+        env=os.environ | {"RUST_BACKTRACE": "1"},
+    )
+    try:
+        _wait_for_port(SERVER_ADDR)
+        yield Server()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
@@ -1,10 +1,10 @@
 import base64
-from   base import run1, SCRIPTS_DIR
+from   base import run1, SCRIPTS_DIR, TemporaryDirectory
 import pytest
 
 #-------------------------------------------------------------------------------
 
-@pytest.mark.parametrize("mode", ["tempfile", "memory"])
+@pytest.mark.parametrize("mode", ["tempfile", "memory", "spill", "memfd", "splice"])
 @pytest.mark.parametrize("format", ["text", "base64"])
 def test_echo(mode, format):
     """
@@ -35,7 +35,7 @@ def test_echo(mode, format):
         assert stdout["text"] == base64.b64encode(text.encode())
 
 
-@pytest.mark.parametrize("mode", ["tempfile", "memory"])
+@pytest.mark.parametrize("mode", ["tempfile", "memory", "spill", "memfd", "splice"])
 def test_interleaved(mode):
     """
     Tests interleaved stdout and stderr.
@@ -75,7 +75,7 @@ def test_interleaved(mode):
     assert err == b"".join( bytes([i]) * i for i in range(256) if i % 3 == 0 )
 
 
-@pytest.mark.parametrize("mode", ["tempfile", "memory"])
+@pytest.mark.parametrize("mode", ["tempfile", "memory", "spill", "memfd", "splice"])
 def test_utf8_sanitize(mode):
     """
     Tests capturing invalid UTF-8 as text.
@@ -98,3 +98,172 @@ def test_utf8_sanitize(mode):
     assert out[-3 :] == "def"
 
 
+
+
+@pytest.mark.parametrize("mode", ["tempfile", "memory", "spill", "memfd", "splice"])
+def test_head_tail(mode):
+    """
+    Tests capturing only the head and tail of output.
+    """
+    res = run1({
+        "argv": ["/usr/bin/seq", "1", "1000"],
+        "fds": [
+            ["stdout", {"capture": {"mode": mode, "head": 10, "tail": 20}}],
+        ]
+    })
+
+    assert res["status"]["exit_code"] == 0
+    stdout = res["fds"]["stdout"]
+    output = "".join(f"{i}\n" for i in range(1, 1001))
+    assert stdout["text"] == output[: 10] + output[-20 :]
+    assert stdout["truncated"] == {"start": 10, "length": len(output) - 30}
+
+
+def test_tail_short():
+    """
+    Tests that output within the bounds is not truncated.
+    """
+    res = run1({
+        "argv": ["/bin/echo", "Hello, world."],
+        "fds": [
+            ["stdout", {"capture": {"mode": "memory", "tail": 1024}}],
+        ]
+    })
+    stdout = res["fds"]["stdout"]
+    assert stdout["text"] == "Hello, world.\n"
+    assert "truncated" not in stdout
+
+
+@pytest.mark.parametrize("spill_size", [0, 1000, 1 << 20])
+def test_spill(spill_size):
+    """
+    Tests that output is the same whether or not it spills to a file.
+    """
+    res = run1({
+        "argv": ["/usr/bin/seq", "1", "10000"],
+        "fds": [
+            ["stdout", {"capture": {"mode": "spill", "spill_size": spill_size}}],
+        ]
+    })
+
+    assert res["status"]["exit_code"] == 0
+    stdout = res["fds"]["stdout"]
+    assert stdout["text"] == "".join(f"{i}\n" for i in range(1, 10001))
+    assert "truncated" not in stdout
+
+
+def test_tmpdir():
+    """
+    Tests that temp files for capture are created in the tmpdir.
+    """
+    with TemporaryDirectory() as tmpdir:
+        res = run1(
+            {
+                "argv": ["/usr/bin/readlink", "/proc/self/fd/1"],
+                "fds": [["stdout", {"capture": {"mode": "tempfile"}}]],
+            },
+            args=("--tmpdir", tmpdir),
+        )
+    assert res["fds"]["stdout"]["text"].startswith(tmpdir + "/ir-capture-")
+
+
+def test_memfd():
+    """
+    Tests that memfd capture uses a memfd, which the proc can't truncate.
+    """
+    res = run1({
+        "argv": [
+            "/bin/sh", "-c",
+            "readlink /proc/self/fd/1; true > /dev/stdout; echo done",
+        ],
+        "fds": [["stdout", {"capture": {"mode": "memfd"}}]],
+    })
+    lines = res["fds"]["stdout"]["text"].splitlines()
+    assert lines[0].startswith("/memfd:procstar-capture")
+    assert lines[1] == "done"
+
+
+def _get_pipe_size(capture, args=()):
+    res = run1(
+        {
+            "argv": [
+                "/usr/bin/python3", "-c",
+                "import fcntl; print(fcntl.fcntl(1, fcntl.F_GETPIPE_SZ))",
+            ],
+            "fds": [["stdout", {"capture": capture}]],
+        },
+        args=args,
+    )
+    return int(res["fds"]["stdout"]["text"])
+
+
+def test_pipe_size():
+    """
+    Tests setting the capacity of capture pipes.
+    """
+    with open("/proc/sys/fs/pipe-max-size") as file:
+        max_size = int(file.read())
+
+    assert _get_pipe_size({"mode": "memory"}) == 65536
+    assert _get_pipe_size({"mode": "memory", "pipe_size": 262144}) == 262144
+    assert _get_pipe_size({"mode": "spill"}, args=("--pipe-size", "131072")) == 131072
+    assert _get_pipe_size(
+        {"mode": "memory", "pipe_size": 131072},
+        args=("--pipe-size", "262144"),
+    ) == 131072
+    # Limited to the max size.
+    assert _get_pipe_size({"mode": "memory", "pipe_size": max_size * 4}) == max_size
+
+
+@pytest.mark.parametrize("bounds", [{}, {"head": 1000}, {"tail": 100000}, {"head": 10, "tail": 20}])
+def test_splice(bounds):
+    """
+    Tests splice capture of large output, with and without bounds.
+    """
+    res = run1({
+        "argv": ["/usr/bin/seq", "1", "200000"],
+        "fds": [["stdout", {"capture": {"mode": "splice", **bounds}}]],
+    })
+
+    output = "".join(f"{i}\n" for i in range(1, 200001))
+    head = bounds.get("head", 0)
+    tail = bounds.get("tail", 0)
+    stdout = res["fds"]["stdout"]
+    if bounds:
+        assert stdout["text"] == output[: head] + output[len(output) - tail :]
+        assert stdout["truncated"] == {"start": head, "length": len(output) - head - tail}
+    else:
+        assert stdout["text"] == output
+        assert "truncated" not in stdout
+
+
+@pytest.mark.parametrize("mode", ["memory", "spill"])
+@pytest.mark.parametrize("bounds", [{}, {"head": 1000, "tail": 300000}])
+def test_compress(mode, bounds):
+    """
+    Tests capture with compression.
+    """
+    res = run1({
+        "argv": ["/usr/bin/seq", "1", "200000"],
+        "fds": [[
+            "stdout",
+            {"capture": {
+                "mode": mode, "compress": "gzip", "spill_size": 10000, **bounds,
+            }},
+        ]],
+    })
+
+    output = "".join(f"{i}\n" for i in range(1, 200001))
+    stdout = res["fds"]["stdout"]
+    if bounds:
+        head, tail = bounds["head"], bounds["tail"]
+        assert stdout["text"] == output[: head] + output[len(output) - tail :]
+        assert stdout["truncated"]["length"] == len(output) - head - tail
+    else:
+        assert stdout["text"] == output
+
+    compression = stdout["compression"]
+    assert compression["method"] == "gzip"
+    stored = compression["memory"] + compression["disk"]
+    assert stored < compression["length"] / 3
+    assert (compression["disk"] > 0) == (mode == "spill")
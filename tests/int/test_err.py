@@ -1,18 +1,59 @@
 import pytest
 
-from   base import run1, Errors
+from   base import run, run1, Errors
 
 #-------------------------------------------------------------------------------
 
-def test_bad_exe():
+@pytest.mark.parametrize("spawn", ["fork", "posix-spawn", "zygote"])
+def test_bad_exe(spawn):
     """
     Tests error reporting on bad executable.
     """
     with pytest.raises(Errors) as exc_info:
-        run1({"argv": ["/usr/bin/bogus"],})
+        run1({"argv": ["/usr/bin/bogus"],}, args=("--spawn", spawn))
     assert any( "No such file or directory" in e for e in exc_info.value.errors )
 
 
+def test_bad_exe_posix_spawn():
+    """
+    Tests that a proc that posix_spawn fails to start is reported once, with
+    the posix_spawn error.
+    """
+    res = run({
+        "procs": {"test": {
+            "argv": ["/usr/bin/bogus"],
+            "fds": [["stdout", {"capture": {"mode": "memory"}}]],
+        }},
+    }, args=("--spawn", "posix-spawn"))["test"]
+    assert res["errors"] == [
+        "exec: /usr/bin/bogus: No such file or directory (os error 2)"
+    ]
+    assert res["pid"] == 0
+    assert res["status"]["exit_code"] == 71
+    assert res["fds"]["stdout"]["text"] == ""
+
+
+@pytest.mark.parametrize(
+    "spec,error",
+    [
+        ({"argv": []}, "invalid spec: empty argv"),
+        ({"argv": ["/bin/echo", "a\0b"]}, "invalid spec: data provided contains a nul byte"),
+        ({"argv": ["/bin/true"], "env": {"vars": {"X": "a\0b"}}}, "invalid spec: data provided contains a nul byte"),
+    ]
+)
+def test_invalid_spec(spec, error):
+    """
+    Tests that a proc that can't be started is reported with its error.
+    """
+    res = run({"procs": {"test": spec, "ok": {"argv": ["/bin/true"]}}})
+    assert res["ok"]["status"]["exit_code"] == 0
+    test = res["test"]
+    assert len(test["errors"]) == 1
+    assert test["errors"][0].startswith(error)
+    assert test["pid"] == 0
+    assert test["status"]["exit_code"] == 71
+
+
 @pytest.mark.xfail(reason="capture errors during startup")
 def test_bad_capture_path():
     """
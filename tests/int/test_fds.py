@@ -0,0 +1,54 @@
+import os
+import pytest
+
+from   base import run
+
+#-------------------------------------------------------------------------------
+
+@pytest.fixture
+def extra_fd():
+    """
+    An extra open fd, not close-on-exec, for Procstar to inherit.
+    """
+    read_fd, write_fd = os.pipe()
+    fd = os.dup2(write_fd, 50)
+    os.set_inheritable(fd, True)
+    yield fd
+    for f in (read_fd, write_fd, fd):
+        os.close(f)
+
+
+@pytest.mark.parametrize("spawn", ["fork", "posix-spawn", "zygote"])
+@pytest.mark.parametrize("close_fds", ["true", "false"])
+def test_close_fds(extra_fd, spawn, close_fds):
+    """
+    Tests that procs inherit only the fds in their specs with `--close-fds`.
+    """
+    procs = run(
+        {
+            "procs": {
+                f"{i}": {
+                    "argv": ["/bin/ls", "/proc/self/fd"],
+                    "fds": [
+                        ["stdout", {"capture": {"mode": "memory"}}],
+                        ["stderr", {"capture": {"mode": "tempfile"}}],
+                        ["60", {"dup": {"fd": extra_fd}}],
+                    ],
+                }
+                for i in range(4)
+            },
+        },
+        args=("--spawn", spawn, "--close-fds", close_fds),
+        pass_fds=(extra_fd, ),
+    )
+
+    for proc in procs.values():
+        assert proc["status"]["exit_code"] == 0
+        fds = { int(f) for f in proc["fds"]["stdout"]["text"].split() }
+        # fd 3 is the directory ls is listing.
+        if close_fds == "true":
+            assert fds == {0, 1, 2, 3, 60}
+        else:
+            assert fds == {0, 1, 2, 3, 60, extra_fd}
+
+
@@ -0,0 +1,765 @@
+from   base import serve, PROCSTAR_EXE
+import gzip
+import json
+import pytest
+import subprocess
+import time
+
+#-------------------------------------------------------------------------------
+
+def _post_echo(server, proc_id):
+    status, _ = server.json("POST", "/procs", {
+        "procs": {
+            proc_id: {
+                "argv": ["/bin/echo", "Hello, world."],
+                "fds": [["stdout", {"capture": {"mode": "memory"}}]],
+            },
+        },
+    })
+    assert status == 202
+
+
+def _wait_done(server, proc_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        status, jso = server.json("GET", f"/procs/{proc_id}")
+        assert status == 200
+        proc = jso["data"]["procs"][proc_id]
+        if proc["status"] is not None:
+            return proc
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+def test_post_get_delete():
+    with serve() as server:
+        _post_echo(server, "echo")
+        proc = _wait_done(server, "echo")
+        assert proc["status"]["exit_code"] == 0
+        assert proc["fds"]["stdout"]["text"] == "Hello, world.\n"
+
+        status, _ = server.json("DELETE", "/procs/echo")
+        assert status == 200
+        status, _ = server.json("GET", "/procs/echo")
+        assert status == 404
+
+
+def test_one_signal_watcher():
+    """
+    Tests that all posts share a single SIGCHLD watcher.
+    """
+    with serve() as server:
+        for i in range(16):
+            _post_echo(server, f"echo{i}")
+        for i in range(16):
+            _wait_done(server, f"echo{i}")
+
+        status, jso = server.json("GET", "/metrics")
+        assert status == 200
+        metrics = jso["data"]["metrics"]
+        assert metrics["procs"] == 16
+        assert metrics["signal_watchers"] == 1
+
+
+def test_env_refresh():
+    with serve() as server:
+        status, jso = server.json("POST", "/env/refresh")
+        assert status == 200
+        assert jso["data"]["env"]["vars"] > 0
+
+
+
+
+def _post_sleeps(server, proc_ids, duration):
+    return server.json("POST", "/procs", {
+        "procs": {
+            i: {"argv": ["/bin/sleep", str(duration)]}
+            for i in proc_ids
+        },
+    })
+
+
+def test_max_running():
+    with serve(args=("--max-running", "2")) as server:
+        start = time.monotonic()
+        status, _ = _post_sleeps(server, ["s0", "s1", "s2", "s3"], 0.2)
+        assert status == 202
+        # The response doesn't wait for queued procs to start.
+        assert time.monotonic() - start < 0.15
+
+        # Queued procs are visible.
+        status, jso = server.json("GET", "/procs?state=queued")
+        assert status == 200
+        queued = jso["data"]["procs"]
+        assert len(queued) == 2
+        assert all( p["queued"] and p["status"] is None for p in queued.values() )
+        status, jso = server.json("GET", "/metrics")
+        assert jso["data"]["metrics"]["queue"]["depth"] == 2
+
+        # Queued procs can be waited for.
+        status, jso = server.json("POST", "/wait?timeout=5", {"procs": ["s0", "s1", "s2", "s3"]})
+        assert jso["data"]["complete"]
+
+        status, jso = server.json("GET", "/metrics")
+        assert status == 200
+        queue = jso["data"]["metrics"]["queue"]
+        assert queue["running"] <= 2
+        assert queue["depth"] == 0
+        assert queue["started"] == 4
+        # The last two procs waited for the first two to complete.
+        assert queue["wait"]["max"] >= 0.15
+
+
+def test_queue_full():
+    with serve(args=("--max-running", "1", "--max-queue", "2")) as server:
+        # More procs than the queue can ever hold.
+        status, _ = _post_sleeps(server, ["s0", "s1", "s2"], 0)
+        assert status == 413
+        status, jso = server.json("GET", "/procs")
+        assert status == 200
+        assert jso["data"]["procs"] == {}
+
+        status, _ = _post_sleeps(server, ["s0", "s1"], 1)
+        assert status == 202
+        # The queue is full for now.
+        status, _ = _post_sleeps(server, ["s2", "s3"], 0)
+        assert status == 429
+        status, jso = server.json("GET", "/procs")
+        assert set(jso["data"]["procs"]) == {"s0", "s1"}
+
+
+@pytest.mark.parametrize(
+    "arg",
+    ["--max-rate=0", "--max-rate=-1", "--max-rate=nan", "--max-running=0"]
+)
+def test_invalid_limits(arg):
+    """
+    Tests that invalid queue limits are rejected at startup.
+    """
+    res = subprocess.run(
+        [str(PROCSTAR_EXE), "--serve", arg],
+        stderr=subprocess.PIPE,
+        timeout=5,
+    )
+    assert res.returncode != 0
+    assert b"must be a positive" in res.stderr
+
+
+def test_zygote_signal():
+    """
+    Tests signalling and waiting for a proc launched by the zygote.
+    """
+    with serve(args=("--spawn", "zygote")) as server:
+        status, _ = _post_sleeps(server, ["sleep"], 10)
+        assert status == 202
+        status, _ = server.json("POST", "/procs/sleep/signals/SIGTERM")
+        assert status == 200
+        proc = _wait_done(server, "sleep")
+        assert proc["status"]["signum"] == 15
+        assert proc["errors"] == []
+
+
+def test_signal_not_started():
+    """
+    Tests that a proc that never started can't be signalled.
+    """
+    with serve() as server:
+        status, _ = server.json("POST", "/procs", {
+            "procs": {"bad": {"argv": ["/nonexistent"]}},
+        })
+        assert status == 202
+        _wait_done(server, "bad")
+        status, jso = server.json("POST", "/procs/bad/signals/SIGTERM")
+        assert status == 400
+        assert "No such process" in jso["errors"][0]["detail"]
+        # The server is still up.
+        status, _ = server.json("GET", "/metrics")
+        assert status == 200
+
+
+def test_threads():
+    """
+    Tests running and capturing many procs with a multi-threaded runtime.
+    """
+    with serve(args=("--threads", "4")) as server:
+        for i in range(32):
+            _post_echo(server, f"echo{i}")
+        for i in range(32):
+            proc = _wait_done(server, f"echo{i}")
+            assert proc["status"]["exit_code"] == 0
+            assert proc["fds"]["stdout"]["text"] == "Hello, world.\n"
+
+        status, jso = server.json("GET", "/metrics")
+        assert status == 200
+        assert jso["data"]["metrics"]["signal_watchers"] == 1
+
+
+def test_threads_exec_failure():
+    """
+    Tests that, with a multi-threaded runtime, procs that fail in posix_spawn
+    don't disturb tracking of other procs.
+    """
+    with serve(args=("--threads", "4", "--spawn", "posix-spawn")) as server:
+        procs = {
+            f"proc{i}": {"argv": ["/nonexistent" if i % 2 else "/bin/true"]}
+            for i in range(64)
+        }
+        status, _ = server.json("POST", "/procs", {"procs": procs})
+        assert status == 202
+        status, jso = server.json("POST", "/wait?timeout=10", {"procs": list(procs)})
+        assert jso["data"]["complete"]
+
+        for i in range(64):
+            proc = _wait_done(server, f"proc{i}")
+            if i % 2:
+                assert proc["pid"] == 0
+                assert len(proc["errors"]) == 1
+                assert proc["status"]["exit_code"] == 71
+            else:
+                assert proc["pid"] > 0
+                assert proc["errors"] == []
+                assert proc["status"]["exit_code"] == 0
+
+
+@pytest.mark.parametrize("bounds", [{}, {"head": 1000, "tail": 2000}])
+def test_get_running_tempfile(bounds):
+    """
+    Tests that getting a running proc doesn't disturb output captured to a
+    tempfile.
+    """
+    with serve() as server:
+        status, _ = server.json("POST", "/procs", {
+            "procs": {
+                "test": {
+                    "argv": [
+                        "/bin/sh", "-c",
+                        "i=0; while [ $i -lt 20000 ]; do echo $i; i=$((i+1)); done",
+                    ],
+                    "fds": [["stdout", {"capture": {"mode": "tempfile", **bounds}}]],
+                },
+            },
+        })
+        assert status == 202
+
+        # Get the proc repeatedly while it writes output.
+        while True:
+            status, jso = server.json("GET", "/procs/test")
+            assert status == 200
+            if jso["data"]["procs"]["test"]["status"] is not None:
+                break
+
+        proc = _wait_done(server, "test")
+        output = "".join(f"{i}\n" for i in range(20000))
+        if bounds:
+            head, tail = bounds["head"], bounds["tail"]
+            output = output[: head] + output[len(output) - tail :]
+        assert proc["fds"]["stdout"]["text"] == output
+
+
+def _post_seq(server, capture, num=100000):
+    status, _ = server.json("POST", "/procs", {
+        "procs": {
+            "seq": {
+                "argv": ["/usr/bin/seq", "1", str(num)],
+                "fds": [
+                    ["stdout", {"capture": capture}],
+                    ["stderr", "inherit"],
+                ],
+            },
+        },
+    })
+    assert status == 202
+    _wait_done(server, "seq")
+    return "".join(f"{i}\n" for i in range(1, num + 1)).encode()
+
+
+@pytest.mark.parametrize("mode", ["tempfile", "memory", "spill", "memfd", "splice"])
+def test_get_output(mode):
+    """
+    Tests getting raw output, and ranges of it.
+    """
+    with serve() as server:
+        output = _post_seq(server, {"mode": mode, "spill_size": 1000})
+        path = "/procs/seq/fds/stdout"
+
+        status, headers, body = server.request("GET", path)
+        assert status == 200
+        assert headers["content-type"] == "application/octet-stream"
+        assert body == output
+
+        status, headers, body = server.request("GET", path, headers={"range": "bytes=10-19"})
+        assert status == 206
+        assert headers["content-range"] == f"bytes 10-19/{len(output)}"
+        assert body == output[10 : 20]
+
+        status, headers, body = server.request("GET", path, headers={"range": "bytes=-100"})
+        assert status == 206
+        assert body == output[-100 :]
+
+        status, headers, body = server.request("GET", path + "?offset=300000&length=1000")
+        assert status == 206
+        assert body == output[300000 : 301000]
+
+        status, headers, body = server.request("GET", path + "?offset=500000")
+        assert status == 206
+        assert body == output[500000 :]
+
+        status, headers, _ = server.request("GET", path + f"?offset={len(output)}")
+        assert status == 416
+        status, headers, _ = server.request("GET", path + "?offset=foo")
+        assert status == 400
+
+
+def test_get_output_errors():
+    with serve() as server:
+        _post_seq(server, {"mode": "memory"})
+        status, _, _ = server.request("GET", "/procs/nope/fds/stdout")
+        assert status == 404
+        status, _, _ = server.request("GET", "/procs/seq/fds/3")
+        assert status == 404
+        # Not captured.
+        status, _, _ = server.request("GET", "/procs/seq/fds/stderr")
+        assert status == 404
+
+
+def test_get_output_large():
+    """
+    Tests that a large body is sent chunked.
+    """
+    with serve() as server:
+        output = _post_seq(server, {"mode": "tempfile"}, num=1000000)
+        status, headers, body = server.request("GET", "/procs/seq/fds/stdout")
+        assert status == 200
+        assert headers["transfer-encoding"] == "chunked"
+        assert body == output
+
+
+@pytest.mark.parametrize("mode", ["tempfile", "memory", "spill", "splice"])
+def test_get_output_truncated(mode):
+    """
+    Tests getting output with a dropped range.
+    """
+    with serve() as server:
+        output = _post_seq(server, {"mode": mode, "head": 100, "tail": 200})
+        path = "/procs/seq/fds/stdout"
+        length = len(output)
+
+        status, headers, body = server.request("GET", path)
+        assert status == 200
+        assert headers["procstar-truncated"] == f"bytes 100-{length - 201}/{length}"
+        assert body == output[: 100] + output[-200 :]
+
+        # A range is clipped to output that was kept.
+        status, headers, body = server.request("GET", path, headers={"range": "bytes=50-1000"})
+        assert status == 206
+        assert headers["content-range"] == f"bytes 50-99/{length}"
+        assert body == output[50 : 100]
+
+        status, headers, body = server.request("GET", path + "?offset=1000")
+        assert status == 206
+        assert headers["content-range"] == f"bytes {length - 200}-{length - 1}/{length}"
+        assert body == output[-200 :]
+
+        status, _, _ = server.request("GET", path + "?offset=1000&length=100")
+        assert status == 416
+
+
+def test_get_output_gzip():
+    """
+    Tests getting compressed output without decompressing it.
+    """
+    with serve() as server:
+        output = _post_seq(server, {"mode": "memory", "compress": "gzip"})
+        path = "/procs/seq/fds/stdout"
+
+        status, headers, body = server.request("GET", path, headers={"accept-encoding": "gzip"})
+        assert status == 200
+        assert headers["content-encoding"] == "gzip"
+        assert len(body) < len(output) / 3
+        assert gzip.decompress(body) == output
+
+        status, headers, body = server.request("GET", path)
+        assert status == 200
+        assert "content-encoding" not in headers
+        assert body == output
+
+        status, headers, body = server.request(
+            "GET", path, headers={"accept-encoding": "gzip", "range": "bytes=200000-200099"})
+        assert status == 206
+        assert "content-encoding" not in headers
+        assert body == output[200000 : 200100]
+
+
+def _get_after(server, proc_id, after, wait):
+    start = time.monotonic()
+    status, headers, body = server.request(
+        "GET", f"/procs/{proc_id}/fds/stdout?after={after}&wait={wait}")
+    return status, headers, body, time.monotonic() - start
+
+
+@pytest.mark.parametrize("mode", ["tempfile", "memory", "splice"])
+def test_get_output_after(mode):
+    """
+    Tests long-polling for output as it's written.
+    """
+    with serve() as server:
+        status, _ = server.json("POST", "/procs", {
+            "procs": {
+                "test": {
+                    "argv": ["/bin/sh", "-c", "echo one; sleep 0.5; echo two; sleep 0.5"],
+                    "fds": [["stdout", {"capture": {"mode": mode}}]],
+                },
+            },
+        })
+        assert status == 202
+
+        status, headers, body, _ = _get_after(server, "test", 0, 5)
+        assert status == 206
+        assert body == b"one\n"
+        assert headers["procstar-eof"] == "false"
+
+        # Waits for the next output.
+        status, headers, body, elapsed = _get_after(server, "test", 4, 5)
+        assert status == 206
+        assert headers["content-range"] == "bytes 4-7/8"
+        assert body == b"two\n"
+        assert 0.2 < elapsed < 1
+
+        # Waits for EOF.
+        status, headers, body, elapsed = _get_after(server, "test", 8, 5)
+        assert status == 204
+        assert headers["procstar-eof"] == "true"
+        assert body == b""
+        assert elapsed < 2
+
+        # Returns immediately with output past the offset.
+        status, headers, body, _ = _get_after(server, "test", 0, 5)
+        assert status == 206
+        assert body == b"one\ntwo\n"
+        assert headers["procstar-eof"] == "true"
+
+
+def test_get_output_after_timeout():
+    with serve() as server:
+        status, _ = server.json("POST", "/procs", {
+            "procs": {
+                "test": {
+                    "argv": ["/bin/sleep", "2"],
+                    "fds": [["stdout", {"capture": {"mode": "memory"}}]],
+                },
+            },
+        })
+        assert status == 202
+
+        status, headers, body, elapsed = _get_after(server, "test", 0, 0.2)
+        assert status == 204
+        assert headers["procstar-eof"] == "false"
+        assert 0.15 < elapsed < 1
+
+        status, _, _ = server.request("GET", "/procs/test/fds/stdout?wait=1")
+        assert status == 400
+        status, _, _ = server.request("GET", "/procs/test/fds/stdout?after=0&wait=soon")
+        assert status == 400
+
+
+def _read_events(rsp, num):
+    """
+    Reads `num` server-sent events from a response.
+    """
+    events = []
+    event = {}
+    while len(events) < num:
+        line = rsp.readline().decode()
+        assert line.endswith("\n")
+        line = line[: -1]
+        if line == "":
+            if event:
+                events.append(event)
+                event = {}
+        elif not line.startswith(":"):
+            key, _, val = line.partition(": ")
+            event[key] = val
+    return [ {**json.loads(e["data"]), "id": e["id"], "event": e["event"]} for e in events ]
+
+
+def test_events():
+    """
+    Tests the stream of proc lifecycle events.
+    """
+    with serve() as server:
+        with server.open("/events") as rsp:
+            assert rsp.headers["content-type"] == "text/event-stream"
+            _post_echo(server, "echo")
+            _wait_done(server, "echo")
+            status, _ = server.json("POST", "/procs", {
+                "procs": {"bad": {"argv": ["/nonexistent"]}},
+            })
+            assert status == 202
+            _wait_done(server, "bad")
+            status, _ = server.json("DELETE", "/procs/echo")
+            assert status == 200
+
+            events = _read_events(rsp, 6)
+
+            status, jso = server.json("GET", "/metrics")
+            assert jso["data"]["metrics"]["event_subscribers"] == 1
+
+        # Sequence numbers are consecutive.
+        seq = events[0]["seq"]
+        assert [ e["seq"] for e in events ] == list(range(seq, seq + 6))
+        assert all( e["id"] == str(e["seq"]) and e["event"] == e["type"] for e in events )
+
+        echo = [ e for e in events if e["proc_id"] == "echo" ]
+        assert echo[0]["type"] == "started"
+        assert echo[0]["pid"] > 0
+        assert sorted( e["type"] for e in echo[1 : 3] ) == ["exited", "output_eof"]
+        assert [ e for e in echo if e["type"] == "output_eof" ][0]["fd"] == "stdout"
+        assert [ e for e in echo if e["type"] == "exited" ][0]["status"]["exit_code"] == 0
+        assert echo[3]["type"] == "deleted"
+
+        bad = [ e for e in events if e["proc_id"] == "bad" ]
+        # The proc never started.
+        assert [ e["type"] for e in bad ] == ["exec_failed", "exited"]
+        assert len(bad[0]["errors"]) > 0
+
+        # The server notices the client disconnected.
+        deadline = time.monotonic() + 5
+        while True:
+            status, jso = server.json("GET", "/metrics")
+            if jso["data"]["metrics"]["event_subscribers"] == 0:
+                break
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+
+def test_events_resume():
+    """
+    Tests resuming the event stream from the event log.
+    """
+    with serve(args=("--event-log-size", "8")) as server:
+        _post_echo(server, "echo0")
+        _wait_done(server, "echo0")
+
+        with server.open("/events?since=1") as rsp:
+            # Events from the log.
+            assert [ e["seq"] for e in _read_events(rsp, 2) ] == [2, 3]
+            # Then, live events.
+            _post_echo(server, "echo1")
+            events = _read_events(rsp, 3)
+            assert [ e["seq"] for e in events ] == [4, 5, 6]
+            assert all( e["proc_id"] == "echo1" for e in events )
+
+        # An SSE client reconnects with the last event ID it received.
+        with server.open("/events", headers={"last-event-id": "5"}) as rsp:
+            assert [ e["seq"] for e in _read_events(rsp, 1) ] == [6]
+
+        for i in range(2, 4):
+            _post_echo(server, f"echo{i}")
+            _wait_done(server, f"echo{i}")
+        # Events through 12, of which the log holds the last 8.
+        with server.open("/events?since=4") as rsp:
+            assert [ e["seq"] for e in _read_events(rsp, 8) ] == list(range(5, 13))
+
+        # The client has to resync.
+        for since in (3, 13):
+            status, _, body = server.request("GET", f"/events?since={since}")
+            assert status == 410
+            assert "unavailable" in json.loads(body)["errors"][0]["detail"]
+
+
+def _timed_json(server, method, path, jso=None):
+    start = time.monotonic()
+    status, jso = server.json(method, path, jso)
+    return status, jso, time.monotonic() - start
+
+
+def test_wait():
+    """
+    Tests waiting for a proc to complete.
+    """
+    with serve() as server:
+        status, _ = _post_sleeps(server, ["short"], 0.3)
+        assert status == 202
+        status, _ = _post_sleeps(server, ["long"], 5)
+        assert status == 202
+
+        status, jso, elapsed = _timed_json(server, "POST", "/procs/short/wait?timeout=5")
+        assert status == 200
+        assert jso["data"]["complete"]
+        proc = jso["data"]["procs"]["short"]
+        assert proc["status"]["exit_code"] == 0
+        assert proc["rusage"] is not None
+        assert elapsed < 2
+
+        # Already complete.
+        status, jso, elapsed = _timed_json(server, "POST", "/procs/short/wait")
+        assert jso["data"]["complete"]
+        assert elapsed < 0.5
+
+        # Times out.
+        status, jso, elapsed = _timed_json(server, "POST", "/procs/long/wait?timeout=0.2")
+        assert status == 200
+        assert not jso["data"]["complete"]
+        assert jso["data"]["procs"]["long"]["status"] is None
+        assert 0.15 < elapsed < 2
+
+        status, _ = server.json("POST", "/procs/nope/wait")
+        assert status == 404
+        status, _ = server.json("POST", "/procs/long/wait?mode=some")
+        assert status == 400
+
+
+def test_wait_many():
+    """
+    Tests waiting for any or all of a set of procs.
+    """
+    with serve() as server:
+        status, _ = _post_sleeps(server, ["s0"], 0.2)
+        status, _ = _post_sleeps(server, ["s1"], 0.6)
+        status, _ = _post_sleeps(server, ["s2"], 10)
+
+        status, jso, elapsed = _timed_json(
+            server, "POST", "/wait?mode=any&timeout=5", {"procs": ["s1", "s0", "s2"]})
+        assert status == 200
+        assert jso["data"]["complete"]
+        procs = jso["data"]["procs"]
+        assert procs["s0"]["status"]["exit_code"] == 0
+        assert procs["s2"]["status"] is None
+        assert elapsed < 0.5
+
+        status, jso, elapsed = _timed_json(
+            server, "POST", "/wait?timeout=5", {"procs": ["s0", "s1"]})
+        assert jso["data"]["complete"]
+        assert all( p["status"]["exit_code"] == 0 for p in jso["data"]["procs"].values() )
+
+        # Duplicate proc IDs are waited for once.
+        status, jso, elapsed = _timed_json(
+            server, "POST", "/wait?timeout=3", {"procs": ["s0", "s0"]})
+        assert status == 200
+        assert jso["data"]["complete"]
+        assert elapsed < 0.5
+
+        status, jso, elapsed = _timed_json(
+            server, "POST", "/wait?timeout=0.2", {"procs": ["s0", "s2"]})
+        assert not jso["data"]["complete"]
+        assert jso["data"]["procs"]["s0"]["status"] is not None
+
+        status, _ = server.json("POST", "/wait", {"procs": ["s0", "nope"]})
+        assert status == 404
+        status, _ = server.json("POST", "/wait", {"procs": []})
+        assert status == 400
+
+
+@pytest.mark.parametrize("mode", ["tempfile", "memory", "splice"])
+def test_get_fields(mode):
+    """
+    Tests selecting fields and fd detail in proc results.
+    """
+    with serve() as server:
+        output = _post_seq(server, {"mode": mode, "head": 100, "tail": 100})
+
+        status, jso = server.json("GET", "/procs/seq?fields=status,pid")
+        assert status == 200
+        proc = jso["data"]["procs"]["seq"]
+        assert set(proc) == {"status", "pid"}
+        assert proc["status"]["exit_code"] == 0
+
+        status, jso = server.json("GET", "/procs?fds=none")
+        assert status == 200
+        proc = jso["data"]["procs"]["seq"]
+        assert set(proc) == {"errors", "pid", "status", "rusage"}
+
+        status, jso = server.json("GET", "/procs/seq?fds=sizes&fields=fds")
+        assert status == 200
+        fds = jso["data"]["procs"]["seq"]["fds"]
+        assert fds["stdout"] == {
+            "length": len(output),
+            "truncated": {"start": 100, "length": len(output) - 200},
+        }
+        assert fds["stderr"] is None
+
+        # Full results by default.
+        status, jso = server.json("GET", "/procs/seq?fds=full")
+        text = jso["data"]["procs"]["seq"]["fds"]["stdout"]["text"]
+        assert text.encode() == output[: 100] + output[-100 :]
+
+        status, _ = server.json("GET", "/procs/seq?fields=status,nope")
+        assert status == 400
+        status, _ = server.json("GET", "/procs?fds=some")
+        assert status == 400
+
+
+def test_get_procs_filter():
+    """
+    Tests filtering procs by state, exit code, and labels.
+    """
+    with serve() as server:
+        def post(proc_id, argv, labels):
+            status, _ = server.json("POST", "/procs", {
+                "procs": {proc_id: {"argv": argv, "labels": labels}},
+            })
+            assert status == 202
+
+        post("ok", ["/bin/true"], {"env": "prod", "team": "web"})
+        post("fail", ["/bin/sh", "-c", "exit 3"], {"env": "dev"})
+        post("sleep", ["/bin/sleep", "5"], {"env": "prod"})
+        _wait_done(server, "ok")
+        _wait_done(server, "fail")
+
+        def get(query):
+            status, jso = server.json("GET", "/procs?fields=labels&" + query)
+            assert status == 200
+            return sorted(jso["data"]["procs"])
+
+        assert get("") == ["fail", "ok", "sleep"]
+        assert get("state=running") == ["sleep"]
+        assert get("state=exited") == ["fail", "ok"]
+        assert get("exit_code=0") == ["ok"]
+        assert get("exit_code!=0") == ["fail"]
+        assert get("labels=env=prod") == ["ok", "sleep"]
+        assert get("labels=env=prod,!team") == ["sleep"]
+        assert get("labels=env!=prod") == ["fail"]
+        assert get("labels=team") == ["ok"]
+        assert get("state=exited&labels=env=prod") == ["ok"]
+
+        status, jso = server.json("GET", "/procs/ok?fields=labels")
+        assert jso["data"]["procs"]["ok"] == {"labels": {"env": "prod", "team": "web"}}
+
+        for query in ["state=done", "exit_code=x", "labels=env,", "exit_code=0&exit_code!=0"]:
+            status, _ = server.json("GET", "/procs?" + query)
+            assert status == 400, query
+
+        server.json("POST", "/procs/sleep/signals/SIGKILL")
+
+
+def test_get_procs_pages():
+    """
+    Tests fetching procs in pages.
+    """
+    with serve() as server:
+        proc_ids = [ f"echo{i:02d}" for i in range(25) ]
+        for proc_id in proc_ids:
+            _post_echo(server, proc_id)
+        for proc_id in proc_ids:
+            _wait_done(server, proc_id)
+
+        pages = []
+        after = None
+        while True:
+            query = "limit=10&fds=none" + ("" if after is None else f"&after={after}")
+            status, jso = server.json("GET", "/procs?" + query)
+            assert status == 200
+            pages.append(list(jso["data"]["procs"]))
+            after = jso["data"]["next"]
+            if after is None:
+                break
+        assert [ len(p) for p in pages ] == [10, 10, 5]
+        assert sum(pages, []) == proc_ids
+
+        # The cursor needn't be a current proc ID.
+        status, jso = server.json("GET", "/procs?fds=none&after=echo19x")
+        assert list(jso["data"]["procs"]) == proc_ids[20 :]
+        assert jso["data"]["next"] is None
+
+        status, _ = server.json("GET", "/procs?limit=0")
+        assert status == 400
@@ -1,9 +1,20 @@
 from   base import run, SCRIPTS_DIR
+import pytest
 import sys
 
 #-------------------------------------------------------------------------------
 
-def test_multiple():
+@pytest.mark.parametrize(
+    "args",
+    [
+        (),
+        ("--pidfd", ),
+        ("--spawn", "fork"),
+        ("--spawn", "zygote"),
+        ("--threads", "4"),
+    ]
+)
+def test_multiple(args):
     procs = run({
         "procs": {
             f"{i}": {
@@ -14,7 +25,7 @@ def test_multiple():
             }
             for i in range(8)
         },
-    })
+    }, args=args)
 
     assert len(procs) == 8
     for i, proc in procs.items():